@@ -4,7 +4,7 @@ import sys
 import os
 import time
 import traceback # Để hiển thị traceback đầy đủ
-import re # Để trích xuất tên agent và parse suy nghĩ
+import re # Để trích xuất tên agent
 
 # --- Giao diện Streamlit ---
 # ĐẶT LỆNH NÀY LÊN ĐẦU TIÊN!
@@ -17,8 +17,10 @@ if project_root not in sys.path:
 
 # Các import này phải sau khi sys.path được sửa
 try:
-    from core.agent_manager import AgentManager
-    from core.data_pipeline import trigger_data_update, AGENT_NEWSAPI_CONFIG
+    from core.agent_manager import AgentManager, DISCUSSION_MODES
+    from core.data_pipeline import start_data_update, AGENT_NEWSAPI_CONFIG
+    from core.response_parser import parse_agent_response, StreamingResponseParser
+    from core.metrics import start_metrics_server
 except ImportError as e:
     st.error(f"Failed to import core modules. Please ensure the project structure is correct and all dependencies are installed. Error: {e}")
     st.stop() # Dừng app nếu không import được module chính
@@ -28,14 +30,26 @@ NATIONAL_PERSONA_DIR = os.path.join(project_root, "National/")
 PERSONAL_PERSONA_DIR = os.path.join(project_root, "Personal/")
 VECTOR_DB_BASE_DIR = os.path.join(project_root, "vector_stores/")
 RAW_DATA_DIR_UI = os.path.join(project_root, "data_sources/raw_news/")
+# Giới hạn số vector store của agent được giữ trong bộ nhớ (không đặt = không giới hạn, không tự unload)
+MAX_LOADED_AGENTS = int(os.getenv("MAX_LOADED_AGENTS")) if os.getenv("MAX_LOADED_AGENTS") else None
+AGENT_IDLE_TIMEOUT_S = float(os.getenv("AGENT_IDLE_TIMEOUT_S")) if os.getenv("AGENT_IDLE_TIMEOUT_S") else None
+AGENT_MEMORY_BUDGET_MB = float(os.getenv("AGENT_MEMORY_BUDGET_MB")) if os.getenv("AGENT_MEMORY_BUDGET_MB") else None
+# per_agent: một FAISS index cho mỗi agent | shared: một index chung, lọc theo agent
+VECTOR_STORE_MODE = os.getenv("VECTOR_STORE_MODE", "per_agent")
 
 # --- Khởi tạo Agent Manager (chỉ một lần) ---
 @st.cache_resource
 def load_agent_manager():
     print("Attempting to initialize Agent Manager for Streamlit app...") # Log ra console
     try:
-        manager = AgentManager(NATIONAL_PERSONA_DIR, PERSONAL_PERSONA_DIR, VECTOR_DB_BASE_DIR)
+        manager = AgentManager(
+            NATIONAL_PERSONA_DIR, PERSONAL_PERSONA_DIR, VECTOR_DB_BASE_DIR,
+            max_loaded_agents=MAX_LOADED_AGENTS, idle_timeout_s=AGENT_IDLE_TIMEOUT_S, memory_budget_mb=AGENT_MEMORY_BUDGET_MB,
+            vector_store_mode=VECTOR_STORE_MODE
+        )
         print("Agent Manager Initialized successfully for Streamlit app.") # Log ra console
+        # Prometheus /metrics và /metrics.json (chỉ khi có METRICS_PORT)
+        start_metrics_server()
         return manager
     except Exception as e:
         # Lỗi này sẽ hiển thị trên console chạy Streamlit, và UI sẽ hiển thị thông báo lỗi chung
@@ -48,61 +62,101 @@ agent_manager = load_agent_manager()
 # --- TIÊU ĐỀ CHÍNH CỦA TRANG ---
 st.title("🗣️ Multi-Agent Interaction Platform")
 
-# --- Hàm tiện ích Parse Response ---
-def parse_agent_response(response_text: str):
-    thought_match = re.search(r"<suy_nghĩ>(.*?)</suy_nghĩ>", response_text, re.DOTALL | re.IGNORECASE)
-    inner_thoughts = None
-    official_statement = response_text
-
-    if thought_match:
-        inner_thoughts = thought_match.group(1).strip()
-        official_statement = response_text[thought_match.end():].strip()
-        if not official_statement and inner_thoughts: # Nếu chỉ có suy nghĩ
-             official_statement = "(Chỉ có suy nghĩ, không có phát biểu chính thức riêng biệt)"
-        elif not official_statement and not inner_thoughts: # Nếu cả hai đều trống sau khi parse
-             official_statement = "(Không có phản hồi nội dung)"
-
-    # Fallback nếu không có tag <suy_nghĩ> nhưng có cấu trúc khác
-    elif "phát biểu chính thức:" in response_text.lower():
-        parts = re.split(r"phát biểu chính thức:", response_text, maxsplit=1, flags=re.IGNORECASE)
-        if len(parts) > 1:
-            potential_thoughts = parts[0].strip()
-            if potential_thoughts and not potential_thoughts.lower().startswith("bạn là"):
-                inner_thoughts = potential_thoughts
-            official_statement = parts[1].strip()
-    
-    return inner_thoughts, official_statement 
+def render_discussion_entry(entry: str):
+    """Hiển thị một dòng log thảo luận ("Tên: nội dung")."""
+    match = re.match(r"^(.*?):(.*)", entry, re.DOTALL)
+    if match:
+        speaker_name = match.group(1).strip()
+        raw_message_log = match.group(2).strip()
+        thoughts, statement = parse_agent_response(raw_message_log)
+        is_info_line = "Chủ đề" in speaker_name or "Bắt đầu thảo luận" in speaker_name or "Kết thúc thảo luận" in speaker_name
+
+        if is_info_line:
+            st.info(f"**{speaker_name}:** {statement if statement else raw_message_log}")
+        else:
+            speaker_avatar_discuss = get_agent_avatar_streamlit(speaker_name)
+            # Sử dụng key duy nhất cho mỗi chat_message nếu cần (ít quan trọng hơn chat_input)
+            with st.chat_message("assistant", avatar=speaker_avatar_discuss):
+                st.markdown(f"**{speaker_name}**")
+                if thoughts:
+                    with st.expander("Inner thoughts...", expanded=False):
+                        st.caption(thoughts)
+                if statement:
+                    st.write(statement)
+                elif not thoughts and raw_message_log: # Nếu không parse được gì cả
+                    st.write(raw_message_log)
+    elif entry.strip():
+        st.text(entry)
+
+
+def render_update_status():
+    """Trạng thái của lần cập nhật knowledge đang chạy (hoặc gần nhất); tự làm mới khi chạy trong fragment."""
+    status = agent_manager.get_update_status()
+    if status is None:
+        return
+    running = status["state"] in ("queued", "running")
+    label = f"Update {status['state']}" + (f" — {status['phase']}" if running and status["phase"] else "")
+    st.caption(f"{label} ({status['elapsed_s']:.0f}s)")
+    if status["progress"]:
+        st.dataframe(
+            [dict(agent=agent_id, **counts) for agent_id, counts in status["progress"].items()],
+            hide_index=True, use_container_width=True
+        )
+    if running:
+        if status["cancel_requested"]:
+            st.caption("Cancelling after the current step...")
+        elif st.button("✖ Cancel update", key="cancel_update_button"):
+            agent_manager.cancel_knowledge_update()
+    elif status["state"] == "failed":
+        st.error(f"Update failed: {status['error']}")
+    elif status["state"] == "succeeded" and status["result"]:
+        st.caption(f"Articles processed: {status['result'].get('articles_processed', 0)}")
+        if status["result"].get("ingest_failures"):
+            st.warning(f"Ingestion {status['result']['status']}: failed for {', '.join(status['result']['ingest_failures'])}")
+
+# Poll the worker every 2s without rerunning the whole page (st.fragment needs Streamlit >= 1.37)
+if hasattr(st, "fragment"):
+    render_update_status = st.fragment(run_every=2)(render_update_status)
 
 
 # --- Sidebar ---
 st.sidebar.header("Controls")
 
 if agent_manager:
-    if st.sidebar.button("🔄 Update Agents' Knowledge Now", key="update_knowledge_button"):
-        with st.spinner("Updating knowledge bases... This may take a few minutes."):
-            try:
-                trigger_data_update(
-                    manager_instance=agent_manager,
-                    raw_data_dir_base_path=RAW_DATA_DIR_UI,
-                    agent_news_config_dict_param=AGENT_NEWSAPI_CONFIG
-                )
-                st.sidebar.success("Knowledge update process triggered!")
-                st.toast("Knowledge update started. This runs in the background.", icon="🔄")
-            except Exception as e:
-                st.sidebar.error(f"Error during manual update trigger: {e}")
-                st.sidebar.text(traceback.format_exc())
+    update_running = agent_manager.update_worker.busy
+    if st.sidebar.button("🔄 Update Agents' Knowledge Now", key="update_knowledge_button", disabled=update_running):
+        try:
+            start_data_update(
+                manager_instance=agent_manager,
+                raw_data_dir_base_path=RAW_DATA_DIR_UI,
+                agent_news_config_dict_param=AGENT_NEWSAPI_CONFIG
+            )
+            st.toast("Knowledge update started. This runs in the background.", icon="🔄")
+        except Exception as e:
+            st.sidebar.error(f"Error during manual update trigger: {e}")
+            st.sidebar.text(traceback.format_exc())
+    with st.sidebar:
+        render_update_status()
 else:
     st.sidebar.error("Agent Manager failed to load. Update functionality disabled. Please check console for errors.")
 
 st.sidebar.subheader("Available Agents")
 agent_ids_list = []
 agent_name_map = {}
-if agent_manager and agent_manager.agents:
-    agent_ids_list = sorted(list(agent_manager.agents.keys()))
+if agent_manager and agent_manager.list_agent_ids():
+    agent_ids_list = agent_manager.list_agent_ids()
     for aid in agent_ids_list:
-        agent_name = agent_manager.agents[aid].persona.get('full_name', aid)
+        agent_name = agent_manager.get_agent_name(aid)
         agent_name_map[aid] = agent_name
         st.sidebar.markdown(f"- **{aid}** (*{agent_name}*)")
+    with st.sidebar.expander("Agent memory stats", expanded=False):
+        st.json(agent_manager.get_agent_stats())
+    with st.sidebar.expander("LLM response cache stats", expanded=False):
+        st.json(agent_manager.get_llm_cache_stats())
+    with st.sidebar.expander("Embedding stats", expanded=False):
+        st.json(agent_manager.get_embedding_stats())
+    with st.sidebar.expander("Pipeline metrics", expanded=False):
+        st.json(agent_manager.get_metrics())
 else:
     st.sidebar.markdown("No agents available or Agent Manager not loaded.")
 
@@ -132,7 +186,7 @@ if not agent_manager:
 
 interaction_mode = st.selectbox(
     "Select Interaction Mode:",
-    ("Chat with a Single Agent", "Observe Multi-Agent Discussion"),
+    ("Chat with a Single Agent", "Observe Multi-Agent Discussion", "Poll Agents"),
     key="interaction_mode_select"
 )
 
@@ -165,9 +219,8 @@ if interaction_mode == "Chat with a Single Agent":
                     for i, (user_msg, ai_data_or_msg) in enumerate(st.session_state[session_key_chat_hist]):
                         st.chat_message("user", avatar="🧑‍💻").write(user_msg)
                         if isinstance(ai_data_or_msg, dict): # Format mới với thoughts/statement
-                            if ai_data_or_msg.get("thinking"):
-                                st.chat_message("assistant", avatar=agent_avatar_chat).write("🤔 Thinking...")
-                            else:
+                            # Câu trả lời đang "thinking" được stream ngay bên dưới
+                            if not ai_data_or_msg.get("thinking"):
                                 if ai_data_or_msg.get("thoughts"):
                                     with st.expander(f"Inner thoughts...", expanded=False):
                                         st.caption(ai_data_or_msg["thoughts"])
@@ -192,27 +245,38 @@ if interaction_mode == "Chat with a Single Agent":
                     
                     current_user_query_for_ai, _ = st.session_state[session_key_chat_hist][-1]
                     
-                    history_for_agent = []
-                    # Lấy tối đa 3 cặp hội thoại (user, ai_statement) gần nhất
-                    for h_user, h_ai_data_or_msg in reversed(st.session_state[session_key_chat_hist][:-1]):
-                        ai_statement_for_history = None
-                        if isinstance(h_ai_data_or_msg, dict) and h_ai_data_or_msg.get("statement"):
-                            ai_statement_for_history = h_ai_data_or_msg["statement"]
-                        elif isinstance(h_ai_data_or_msg, str):
-                            ai_statement_for_history = h_ai_data_or_msg
-                        
-                        if ai_statement_for_history:
-                             history_for_agent.insert(0, (h_user, ai_statement_for_history))
-                        if len(history_for_agent) >= 3:
-                            break
-                    
-                    raw_ai_response = agent_manager.ask_single_agent(
+                    # Bộ nhớ hội thoại: các lượt gần nhất giữ nguyên văn, các lượt cũ hơn được tóm tắt dần
+                    session_key_chat_memory = f"chat_memory_{selected_agent_id_chat}"
+                    if session_key_chat_memory not in st.session_state:
+                        st.session_state[session_key_chat_memory] = agent_manager.get_agent(selected_agent_id_chat).new_conversation_memory()
+                    chat_memory = st.session_state[session_key_chat_memory]
+                    history_for_agent = chat_memory.history()
+
+                    # Hiển thị suy nghĩ và phát biểu dần dần khi Gemini stream về
+                    with chat_display_container:
+                        thoughts_placeholder = st.empty()
+                        with st.chat_message("assistant", avatar=agent_avatar_chat):
+                            statement_placeholder = st.empty()
+                            statement_placeholder.write("🤔 Thinking...")
+                    stream_parser = StreamingResponseParser()
+                    raw_chunks = []
+                    for chunk in agent_manager.ask_single_agent_stream(
                         selected_agent_id_chat,
                         current_user_query_for_ai,
                         conversation_history=history_for_agent
-                    )
-                    thoughts, statement = parse_agent_response(raw_ai_response)
+                    ):
+                        raw_chunks.append(chunk)
+                        events = stream_parser.feed(chunk)
+                        if any(kind == "thought" for kind, _ in events):
+                            with thoughts_placeholder.expander("Inner thoughts...", expanded=True):
+                                st.caption(stream_parser.thoughts)
+                        if any(kind == "statement" for kind, _ in events):
+                            statement_placeholder.markdown(stream_parser.statement + "▌")
+                    stream_parser.finish()
+                    # Parse lại toàn bộ câu trả lời để giữ nguyên các fallback của parse_agent_response
+                    thoughts, statement = parse_agent_response("".join(raw_chunks))
                     st.session_state[session_key_chat_hist][-1] = (current_user_query_for_ai, {"thinking": False, "thoughts": thoughts, "statement": statement})
+                    chat_memory.add_turn(current_user_query_for_ai, statement)
                     
                     if len(st.session_state[session_key_chat_hist]) > 10: # Giới hạn lịch sử
                         st.session_state[session_key_chat_hist].pop(0)
@@ -233,10 +297,20 @@ elif interaction_mode == "Observe Multi-Agent Discussion":
         )
         discussion_topic_input = st.text_input("Enter the discussion topic:", key="discuss_topic_input")
         max_turns_per_agent_discuss = st.slider("Max turns per agent in discussion:", 1, 3, 1, key="discuss_max_turns_slider")
+        discussion_mode = st.selectbox(
+            "Turn scheduling:",
+            DISCUSSION_MODES,
+            format_func=lambda m: {"sequential": "Sequential (one speaker at a time)",
+                                   "parallel_opening": "Parallel opening statements",
+                                   "rounds": "Parallel rounds"}.get(m, m),
+            key="discuss_mode_select"
+        )
+        use_cached_replies_discuss = st.checkbox("Reuse cached replies", value=True, key="discuss_use_cache_checkbox",
+                                                 help="Untick to ask every agent again even if the same prompt was answered before.")
 
         # Tạo key session state dựa trên các lựa chọn hiện tại để lưu log thảo luận
         # Điều này giúp nếu người dùng thay đổi topic/agents thì sẽ có log mới
-        current_discussion_params_str = "_".join(sorted(selected_agent_ids_discuss)) + "_" + discussion_topic_input + "_" + str(max_turns_per_agent_discuss)
+        current_discussion_params_str = "_".join(sorted(selected_agent_ids_discuss)) + "_" + discussion_topic_input + "_" + str(max_turns_per_agent_discuss) + "_" + discussion_mode
         current_discussion_log_key = f"discussion_log_{hash(current_discussion_params_str)}"
 
         if st.button("Start/Refresh Discussion", key="discuss_start_button"):
@@ -257,49 +331,102 @@ elif interaction_mode == "Observe Multi-Agent Discussion":
             # Chỉ chạy simulate nếu thực sự có yêu cầu (đã nhấn nút và đủ điều kiện)
             # Điều kiện này cần được kiểm tra lại cẩn thận, có thể button click là đủ
             if len(selected_agent_ids_discuss) >= 2 and discussion_topic_input: # Đảm bảo vẫn đủ điều kiện
-                with st.spinner("Agents are discussing... Please wait."):
-                    try:
-                        discussion_log_str = agent_manager.simulate_discussion(
+                st.subheader("Discussion Log:")
+                live_discussion_container = st.container(height=700)
+                discussion_entries = []
+                try:
+                    with st.spinner("Agents are discussing... Please wait."):
+                        # Mỗi lượt phát biểu được hiển thị ngay khi agent trả lời xong
+                        for event in agent_manager.simulate_discussion_stream(
                             selected_agent_ids_discuss,
                             discussion_topic_input,
-                            max_turns_per_agent=max_turns_per_agent_discuss
-                        )
-                        st.session_state[current_discussion_log_key] = discussion_log_str.split("\n")
-                        st.session_state[f"{current_discussion_log_key}_params"] = current_discussion_params_str # Cập nhật params đã xử lý
-                        st.rerun() # Rerun để hiển thị kết quả
-                    except Exception as e:
-                        st.error(f"Error during discussion simulation: {e}")
-                        st.text(traceback.format_exc())
-                        st.session_state[current_discussion_log_key] = [f"Error: {e}"] # Lưu lỗi vào log
+                            max_turns_per_agent=max_turns_per_agent_discuss,
+                            mode=discussion_mode,
+                            use_cache=use_cached_replies_discuss
+                        ):
+                            if event["type"] == "start":
+                                discussion_entries.append(f"Chủ đề: {event['topic']}")
+                            elif event["type"] == "turn":
+                                discussion_entries.append(event["statement"])
+                            elif event["type"] == "error":
+                                discussion_entries.append(f"Error: {event['message']}")
+                            else:
+                                continue
+                            with live_discussion_container:
+                                render_discussion_entry(discussion_entries[-1])
+                    st.session_state[current_discussion_log_key] = discussion_entries
+                    st.session_state[f"{current_discussion_log_key}_params"] = current_discussion_params_str # Cập nhật params đã xử lý
+                    st.rerun() # Rerun để hiển thị kết quả
+                except Exception as e:
+                    st.error(f"Error during discussion simulation: {e}")
+                    st.text(traceback.format_exc())
+                    st.session_state[current_discussion_log_key] = discussion_entries + [f"Error: {e}"] # Lưu lỗi vào log
 
         # Hiển thị log thảo luận nếu đã có
         if isinstance(st.session_state.get(current_discussion_log_key), list):
             st.subheader("Discussion Log:")
             discussion_display_container = st.container(height=700) # Tăng chiều cao
             with discussion_display_container:
-                for entry_idx, entry in enumerate(st.session_state[current_discussion_log_key]):
-                    match = re.match(r"^(.*?):(.*)", entry, re.DOTALL)
-                    if match:
-                        speaker_name = match.group(1).strip()
-                        raw_message_log = match.group(2).strip()
-                        thoughts, statement = parse_agent_response(raw_message_log)
-                        is_info_line = "Chủ đề" in speaker_name or "Bắt đầu thảo luận" in speaker_name or "Kết thúc thảo luận" in speaker_name
-                        
-                        if is_info_line:
-                            st.info(f"**{speaker_name}:** {statement if statement else raw_message_log}")
-                        else:
-                            speaker_avatar_discuss = get_agent_avatar_streamlit(speaker_name)
-                            # Sử dụng key duy nhất cho mỗi chat_message nếu cần (ít quan trọng hơn chat_input)
-                            with st.chat_message("assistant", avatar=speaker_avatar_discuss):
-                                st.markdown(f"**{speaker_name}**")
-                                if thoughts:
-                                    # Sử dụng key duy nhất cho expander để tránh lỗi state
-                                    expander_key = f"thoughts_{current_discussion_log_key}_{entry_idx}"
-                                    with st.expander("Inner thoughts...", expanded=False):
-                                        st.caption(thoughts)
-                                if statement:
-                                    st.write(statement)
-                                elif not thoughts and raw_message_log: # Nếu không parse được gì cả
-                                    st.write(raw_message_log)
-                    elif entry.strip():
-                        st.text(entry)
\ No newline at end of file
+                for entry in st.session_state[current_discussion_log_key]:
+                    render_discussion_entry(entry)
+
+elif interaction_mode == "Poll Agents":
+    st.header("📊 Poll Agents")
+    if not agent_ids_list:
+         st.warning("No agents available to poll.")
+    else:
+        selected_agent_ids_poll = st.multiselect(
+            "Choose agents to poll:",
+            options=list(agent_ids_list),
+            default=list(agent_ids_list),
+            format_func=lambda x: agent_name_map.get(x, x),
+            key="poll_agents_multiselect"
+        )
+        poll_question_input = st.text_input("Question for every selected agent:", key="poll_question_input")
+        use_cached_replies_poll = st.checkbox("Reuse cached replies", value=True, key="poll_use_cache_checkbox",
+                                              help="Untick to ask every agent again even if the same prompt was answered before.")
+
+        def render_poll_result(result):
+            with st.chat_message(name=result["name"], avatar=get_agent_avatar_streamlit(result["agent_id"])):
+                timings = result["timings"]
+                st.caption(f"{result['name']} · answered after {result['elapsed_s']:.2f}s · "
+                           + " · ".join(f"{stage} {timings[stage] * 1000:.0f} ms"
+                                        for stage in ("queued_s", "retrieval", "llm_call", "turn_total") if stage in timings))
+                if result["error"]:
+                    st.error(result["error"])
+                    return
+                thoughts, statement = parse_agent_response(result["text"])
+                if thoughts:
+                    with st.expander("Suy nghĩ nội tâm", expanded=False):
+                        st.markdown(f"_{thoughts}_")
+                st.markdown(statement)
+
+        if st.button("Poll", key="poll_start_button"):
+            if selected_agent_ids_poll and poll_question_input:
+                poll_results = []
+                # Câu trả lời hiện ra theo thứ tự agent nào xong trước
+                with st.spinner(f"Polling {len(selected_agent_ids_poll)} agents..."):
+                    for event in agent_manager.poll_agents_stream(selected_agent_ids_poll, poll_question_input,
+                                                                  use_cache=use_cached_replies_poll):
+                        if event["type"] == "result":
+                            poll_results.append(event)
+                            render_poll_result(event)
+                        elif event["type"] == "end":
+                            st.session_state.poll_last = {"question": poll_question_input, "results": poll_results,
+                                                          "elapsed_s": event["elapsed_s"]}
+                st.rerun()
+            else:
+                st.warning("Please select at least one agent and enter a question.")
+
+        poll_last = st.session_state.get("poll_last")
+        if poll_last:
+            st.subheader(f"Answers to: {poll_last['question']}")
+            st.caption(f"{len(poll_last['results'])} agents answered in {poll_last['elapsed_s']:.2f}s (in completion order).")
+            for result in poll_last["results"]:
+                render_poll_result(result)
+            with st.expander("Per-agent timing", expanded=False):
+                st.dataframe([
+                    {"agent": result["name"], "answered_after_s": round(result["elapsed_s"], 3),
+                     **{stage: round(value, 3) for stage, value in result["timings"].items()}}
+                    for result in poll_last["results"]
+                ])
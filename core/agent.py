@@ -1,175 +1,458 @@
 import yaml
 import os
+import asyncio
+import pickle
+import shutil
+import time
+import threading
+import logging
+from contextlib import contextmanager
+import random
+import numpy as np
+from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from core.utils import clean_text
-import google.generativeai as genai
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from core.utils import clean_text, num_tokens_from_string
+from core.embeddings import get_shared_embeddings, DEFAULT_EMBEDDING_MODEL_NAME
+from core.ingestion_manifest import IngestionManifest
+from core.near_dedup import NearDuplicateIndex, simhash, word_count, NEAR_DUP_MIN_WORDS
+from core.response_cache import get_response_cache, prompt_fingerprint
+from core.vector_index import (
+    resolve_index_profile, target_index_type, index_type_of, create_index, apply_search_params,
+    needs_rebuild, load_profile_state, save_profile_state, benchmark_index_types, documents_in_index_order,
+    measure_search_latency, clone_vector_store, IndexSnapshot, search_retriever
+)
+from core.retention import resolve_retention_policy, select_expired
+from core.context_packer import pack_context, format_rag_context
+from core.chunker import get_shared_chunker
+from core.metrics import metrics, get_logger, log_sampled
+from core.llm_backend import resolve_llm_config, create_backend
+from core.llm_dispatcher import get_llm_dispatcher
+from core.conversation_memory import ConversationMemory, LLMSummarizer
 from dotenv import load_dotenv
 
 load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in .env file or environment variables.")
+logger = get_logger(__name__)
 
-genai.configure(api_key=GEMINI_API_KEY)
+LLM_ERROR_REPLY = "Xin lỗi, tôi gặp sự cố khi xử lý yêu cầu của bạn với mô hình ngôn ngữ."
 
 class CharacterAgent:
-    def __init__(self, agent_id: str, persona_file_path: str, vector_db_dir: str, knowledge_text_files: list = None, general_retriever=None):
+    def __init__(self, agent_id: str, persona_file_path: str, vector_db_dir: str, knowledge_text_files: list = None, general_retriever=None,
+                 shared_store=None):
         self.agent_id = agent_id
         with open(persona_file_path, 'r', encoding='utf-8') as f:
             self.persona = yaml.safe_load(f)
 
         self.vector_db_path = os.path.join(vector_db_dir, f"{self.agent_id}_db")
+        self._write_lock = threading.Lock()
         
-        # --- LLM Configuration (Gemini) ---
-        self.gemini_model_name = "gemini-1.5-flash-latest"
-        self.llm = genai.GenerativeModel(
-            model_name=self.gemini_model_name,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7,
-            )
-        )
-        print(f"Agent {self.agent_id} initialized with Gemini model: {self.gemini_model_name}")
-
-        # --- Embedding Model (Local Sentence Transformer) ---
-        self.embedding_model_name = 'all-MiniLM-L6-v2'
-        print(f"Initializing local embedding model: {self.embedding_model_name}...")
-        try:
-            self.embeddings_model = HuggingFaceEmbeddings(
-                model_name=self.embedding_model_name,
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
-            print(f"Local embedding model {self.embedding_model_name} initialized.")
-        except Exception as e:
-            print(f"Error initializing local embedding model {self.embedding_model_name}: {e}")
-            print("Falling back to a very basic tokenizer for RAG (suboptimal).")
-            class BasicEmbedder:
-                def embed_documents(self, texts): return [[float(ord(c)) for c in t[:10]] for t in texts]
-                def embed_query(self, text): return [float(ord(c)) for c in text[:10]]
-            self.embeddings_model = BasicEmbedder()
+        # --- LLM Configuration ---
+        # Gemini or the local stub, from the persona's `llm` section or LLM_BACKEND / LLM_MODEL
+        self.llm_config = resolve_llm_config(self.persona)
+        self.llm = create_backend(self.llm_config)
+        self.llm_model_name = self.llm.model_name
+        self.generation_config = self.llm.generation_config
+        # Shared by all agents: concurrency caps, timeouts, retries, hedging and circuit breaking
+        self.llm_dispatcher = get_llm_dispatcher()
+        # Replies are cached on disk by prompt fingerprint (None when LLM_CACHE_ENABLED is off)
+        self.response_cache = get_response_cache()
+        # Folds old turns of long chats/discussions into a rolling summary (see new_conversation_memory)
+        self.summarizer = LLMSummarizer(self.llm, self.llm_dispatcher, self.response_cache)
+        logger.debug("Agent %s initialized with %s model: %s", self.agent_id, self.llm.name, self.llm_model_name)
 
+        # --- Embedding Model (Local Sentence Transformer, shared by all agents) ---
+        self.embedding_model_name = DEFAULT_EMBEDDING_MODEL_NAME
+        self.embeddings_model = get_shared_embeddings(self.embedding_model_name)
 
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=100,
-            length_function=len
-        )
+        # Token-aware, sentence-respecting splitter shared by all agents (CHUNK_TOKENS / CHUNK_OVERLAP_TOKENS)
+        self.text_splitter = get_shared_chunker()
 
         # --- Vector Store (FAISS) ---
-        if os.path.exists(self.vector_db_path) and os.listdir(self.vector_db_path):
-            try:
-                print(f"Loading existing VectorDB for {self.agent_id} from {self.vector_db_path}")
-                self.vector_store = FAISS.load_local(self.vector_db_path, self.embeddings_model, allow_dangerous_deserialization=True)
-            except Exception as e:
-                print(f"Error loading VectorDB for {self.agent_id}: {e}. Recreating...")
-                self._create_and_save_empty_vector_store()
-        else:
-            self._create_and_save_empty_vector_store()
-            
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 3})
+        # AgentManager may unload the index of an idle agent; it is reloaded from disk on next use.
+        # Writers never modify the published IndexSnapshot: they build a new one and swap the reference.
+        # With a shared_store (SharedKnowledgeStore) the agent has no index of its own and searches its slice of the shared one.
+        self.shared_store = shared_store
+        manifest_path = shared_store.manifest_path(agent_id) if shared_store else os.path.join(self.vector_db_path, "ingest_manifest.json")
+        self.ingestion_manifest = IngestionManifest(manifest_path)
+        # flat / HNSW / IVF-Flat / IVF-PQ, from the persona's `vector_index` section or the global default
+        self.index_profile = resolve_index_profile(self.persona)
+        # max_age_days / keep_latest_per_source / max_chunks, applied by compact_knowledge()
+        self.retention_policy = resolve_retention_policy(self.persona)
+        self._index_trained_on = 0
+        self._reindexing = False  # a re-index is running outside the write lock (see _reindex_and_swap)
+        self._snapshot = None
+        # Size of the persisted index, refreshed whenever it is loaded or rewritten (see knowledge_size_bytes)
+        self.knowledge_bytes = 0
+        self._shared_retriever = None
+        self.last_used = time.monotonic()
+        self._load_vector_store()
 
         self.general_retriever = general_retriever
         if self.general_retriever:
-            print(f"Agent '{self.agent_id}' has been given access to the general knowledge base.")
+            logger.debug("Agent %s has been given access to the general knowledge base.", self.agent_id)
 
 
         if knowledge_text_files:
-            for file_path in knowledge_text_files:
-                self.add_knowledge_from_file(file_path)
+            self.add_knowledge_from_files(knowledge_text_files)
 
         # System prompt
         self.system_prompt_content = self.persona.get('system_prompt', "You are a helpful AI assistant.")
         if not isinstance(self.system_prompt_content, str):
-            print(f"Warning: system_prompt for {self.agent_id} is not a string. Using default.")
+            logger.warning("system_prompt for %s is not a string. Using default.", self.agent_id)
             self.system_prompt_content = "You are a helpful AI assistant."
 
+    def _load_vector_store(self):
+        if self.shared_store is not None:
+            self._shared_retriever = self.shared_store.retriever_for(self.agent_id)
+            return
+        if os.path.exists(os.path.join(self.vector_db_path, "index.faiss")):
+            try:
+                logger.debug("Loading existing VectorDB for %s from %s", self.agent_id, self.vector_db_path)
+                vector_store = FAISS.load_local(self.vector_db_path, self.embeddings_model, allow_dangerous_deserialization=True)
+                if vector_store.index.ntotal != len(vector_store.index_to_docstore_id):
+                    raise ValueError("index.faiss and index.pkl are out of sync")
+                self._index_trained_on = load_profile_state(self.vector_db_path).get("trained_on", vector_store.index.ntotal)
+                apply_search_params(vector_store.index, self.index_profile)
+                # The profile may have changed since the index was written
+                reindexed = self._maybe_reindex(vector_store)
+                if reindexed is not vector_store:
+                    self._index_trained_on = reindexed.index.ntotal
+                    self._save_vector_store(reindexed)
+                else:
+                    self.knowledge_bytes = self.knowledge_size_bytes()
+                self._publish(reindexed)
+            except Exception as e:
+                logger.error("Error loading VectorDB for %s: %s. Rebuilding from the stored documents...", self.agent_id, e)
+                if not self._rebuild_from_docstore_file():
+                    self._create_and_save_empty_vector_store()
+        else:
+            self._create_and_save_empty_vector_store()
+
+    def _publish(self, vector_store):
+        """Makes vector_store the snapshot new queries search; queries already running finish on the one they started with."""
+        previous = self._snapshot
+        self._snapshot = IndexSnapshot(vector_store, version=previous.version + 1 if previous else 1)
+
+    @property
+    def vector_store(self):
+        """FAISS store of the current snapshot (None while unloaded, and always in shared mode)."""
+        snapshot = self._snapshot
+        return snapshot.vector_store if snapshot else None
+
+    @property
+    def retriever(self):
+        if self.shared_store is not None:
+            return self._shared_retriever
+        snapshot = self._snapshot
+        return snapshot.retriever if snapshot else None
+
+    @property
+    def knowledge_loaded(self) -> bool:
+        return self.vector_store is not None or self.shared_store is not None
+
+    def ensure_knowledge_loaded(self):
+        """Reloads the vector store if it was unloaded and returns the current retriever."""
+        self.last_used = time.monotonic()
+        retriever = self.retriever
+        if retriever is not None:
+            return retriever
+        with self._write_lock:
+            if self.retriever is None:
+                self._load_vector_store()
+            return self.retriever
+
+    def unload_knowledge(self) -> bool:
+        """Drops the in-memory vector store, keeping persona, LLM and manifest. Returns False if it was not loaded."""
+        with self._write_lock:
+            # The shared store is owned by the AgentManager, not by any one agent
+            if self._snapshot is None or self.shared_store is not None:
+                return False
+            self._snapshot = None
+            logger.debug("Unloaded VectorDB for %s from memory.", self.agent_id)
+            return True
+
+    def knowledge_size_bytes(self) -> int:
+        """Approximate in-memory size of the vector store, taken from the persisted index files.
+
+        Stats the files on every call; use the cached knowledge_bytes on hot paths.
+        """
+        if self.shared_store is not None:
+            return 0
+        total = 0
+        for file_name in ("index.faiss", "index.pkl"):
+            try:
+                total += os.path.getsize(os.path.join(self.vector_db_path, file_name))
+            except OSError:
+                pass
+        return total
+
     def _create_and_save_empty_vector_store(self):
-        print(f"Creating new VectorDB for {self.agent_id} at {self.vector_db_path}")
+        logger.info("Creating new VectorDB for %s at %s", self.agent_id, self.vector_db_path)
         os.makedirs(self.vector_db_path, exist_ok=True)
         initial_texts = ["Initial knowledge placeholder for " + self.persona.get('full_name', self.agent_id)]
         try:
-            self.vector_store = FAISS.from_texts(initial_texts, self.embeddings_model)
-            self.vector_store.save_local(self.vector_db_path)
+            vector_store = FAISS.from_texts(initial_texts, self.embeddings_model)
+            self._save_vector_store(vector_store)
+            self._publish(vector_store)
+            # A fresh index holds none of the previously ingested files
+            self.ingestion_manifest.reset()
         except Exception as e:
-            print(f"CRITICAL: Failed to create initial vector store for {self.agent_id}: {e}")
+            logger.critical("Failed to create initial vector store for %s: %s", self.agent_id, e)
             raise
 
-    def add_knowledge_from_text(self, text_content: str, source_name: str = "generic_text"):
-        if not self.vector_store:
-            print(f"Cannot add knowledge for {self.agent_id}: No vector store.")
-            return
-        cleaned_text_content = clean_text(text_content)
-        if not cleaned_text_content:
-            print(f"Skipping empty or invalid text for {self.agent_id} from {source_name}")
-            return
-        chunks = self.text_splitter.split_text(cleaned_text_content)
-        if chunks:
-            print(f"Adding {len(chunks)} chunks from {source_name} to {self.agent_id}'s knowledge base.")
+    def _build_vector_store(self, documents: list, index_type: str = None):
+        """Builds a fresh FAISS store over documents, trained on all of them.
+
+        The vectors come from embeddings_model.embed_documents over each document's page_content. With the
+        SharedEmbeddingService that means each text's vector is read from the on-disk chunk embedding cache
+        (keyed by model name and normalized text) and only texts missing from it run through the model; the
+        index, docstore and metadata are always built here from documents. Touches no agent state, so it can
+        run without the write lock; the caller records _index_trained_on when it installs the result.
+        """
+        texts = [doc.page_content for doc in documents]
+        embeddings = self.embeddings_model.embed_documents(texts)
+        index_type = index_type or target_index_type(self.index_profile, len(documents))
+        index = create_index(index_type, self.index_profile, np.asarray(embeddings, dtype=np.float32))
+        vector_store = FAISS(embedding_function=self.embeddings_model, index=index,
+                             docstore=InMemoryDocstore(), index_to_docstore_id={})
+        vector_store.add_embeddings(list(zip(texts, embeddings)), metadatas=[doc.metadata for doc in documents])
+        return vector_store
+
+    def _maybe_reindex(self, vector_store):
+        """Returns vector_store, or a rebuilt store when its chunk count calls for another index type (or an IVF retrain).
+
+        Only reads vector_store (a published snapshot is never modified); the caller saves and publishes the result.
+        """
+        index = vector_store.index
+        if not needs_rebuild(self.index_profile, index, self._index_trained_on):
+            return vector_store
+        target = target_index_type(self.index_profile, index.ntotal)
+        logger.info("Re-indexing %s: %s -> %s (%d chunks)...", self.agent_id, index_type_of(index), target, index.ntotal)
+        started = time.perf_counter()
+        documents = documents_in_index_order(vector_store.docstore, vector_store.index_to_docstore_id)
+        rebuilt = self._build_vector_store(documents, target)
+        logger.info("Re-indexed %s as %s in %.2fs.", self.agent_id, target, time.perf_counter() - started)
+        return rebuilt
+
+    def index_report(self, n_queries: int = 200, k: int = 3) -> list:
+        """Recall@k / latency / memory of every index type on this agent's vectors, compared to the exact flat index."""
+        if self.shared_store is not None:
+            return self.shared_store.index_report(n_queries=n_queries, k=k)
+        vector_store = self.vector_store or FAISS.load_local(self.vector_db_path, self.embeddings_model, allow_dangerous_deserialization=True)
+        documents = documents_in_index_order(vector_store.docstore, vector_store.index_to_docstore_id)
+        vectors = np.asarray(self.embeddings_model.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        return benchmark_index_types(vectors, self.index_profile, n_queries=n_queries, k=k)
+
+    def _rebuild_from_docstore_file(self) -> bool:
+        """Recovers from a broken index.faiss by re-indexing the documents kept in index.pkl. Returns False if that is not possible."""
+        pkl_path = os.path.join(self.vector_db_path, "index.pkl")
+        try:
+            with open(pkl_path, 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            documents = documents_in_index_order(docstore, index_to_docstore_id)
+            if not documents:
+                return False
+            vector_store = self._build_vector_store(documents)
+            self._index_trained_on = len(documents)
+            self._save_vector_store(vector_store)
+            self._publish(vector_store)
+        except Exception as e:
+            logger.error("Could not rebuild VectorDB for %s from %s: %s", self.agent_id, pkl_path, e)
+            return False
+        # The same chunks are indexed again, so the ingestion manifest stays valid
+        logger.info("Rebuilt VectorDB for %s from %d stored documents.", self.agent_id, len(documents))
+        return True
+
+    def rebuild_vector_store(self) -> int:
+        """Re-indexes every document of the current store into a fresh index and persists it. Returns the document count."""
+        if self.shared_store is not None:
+            return self.shared_store.rebuild()
+        with self._write_lock:
+            if self.vector_store is None:
+                self._load_vector_store()
+            documents = documents_in_index_order(self.vector_store.docstore, self.vector_store.index_to_docstore_id)
+            started = time.perf_counter()
+            vector_store = self._build_vector_store(documents, target_index_type(self.index_profile, len(documents)))
+            self._index_trained_on = len(documents)
+            self._save_vector_store(vector_store)
+            self._publish(vector_store)
+        logger.info("Rebuilt VectorDB for %s: %d documents in %.2fs.", self.agent_id, len(documents), time.perf_counter() - started)
+        return len(documents)
+
+    def _placeholder_document(self) -> Document:
+        return Document(page_content="Initial knowledge placeholder for " + self.persona.get('full_name', self.agent_id))
+
+    def compact_knowledge(self, now=None, latency_queries: int = 50) -> dict:
+        """Removes chunks the retention policy no longer keeps, rebuilding the index off to the side and swapping it in.
+
+        Returns a report with chunk counts, index size on disk and mean search latency before and after.
+        """
+        if self.shared_store is not None:
+            return self.shared_store.compact({self.agent_id: self.retention_policy}, now=now, latency_queries=latency_queries,
+                                             manifests={self.agent_id: self.ingestion_manifest})
+        report = {"agent_id": self.agent_id, "policy": self.retention_policy}
+        with self._write_lock:
+            if self.vector_store is None:
+                self._load_vector_store()
+            started = time.perf_counter()
+            old_store = self.vector_store
+            documents = documents_in_index_order(old_store.docstore, old_store.index_to_docstore_id)
+            expired = select_expired([doc.metadata for doc in documents], self.retention_policy, now)
+            report.update(chunks_before=len(documents), expired=len(expired), bytes_before=self.knowledge_bytes)
+            if not expired:
+                report.update(chunks_after=len(documents), bytes_after=report["bytes_before"])
+                return report
+            kept = [doc for position, doc in enumerate(documents) if position not in expired] or [self._placeholder_document()]
+            new_store = self._build_vector_store(kept, target_index_type(self.index_profile, len(kept)))
+
+            sample = random.sample(kept, min(latency_queries, len(kept)))
+            queries = np.asarray(self.embeddings_model.embed_documents([doc.page_content for doc in sample]), dtype=np.float32)
+            report["latency_ms_before"] = measure_search_latency(old_store.index, queries)
+            report["latency_ms_after"] = measure_search_latency(new_store.index, queries)
+
+            self._index_trained_on = len(kept)
+            self._save_vector_store(new_store)
+            self._publish(new_store)
+            self.ingestion_manifest.forget_expired([documents[position].metadata for position in expired], [doc.metadata for doc in kept])
+            self.ingestion_manifest.save()
+            report.update(chunks_after=len(kept), bytes_after=self.knowledge_bytes, seconds=time.perf_counter() - started)
+        logger.info("Compacted %s: %d -> %d chunks, %.0f -> %.0f KB, %.3f -> %.3f ms/query.", self.agent_id,
+                    report['chunks_before'], report['chunks_after'], report['bytes_before'] / 1024, report['bytes_after'] / 1024,
+                    report['latency_ms_before'], report['latency_ms_after'])
+        return report
+
+    def _save_vector_store(self, vector_store=None):
+        """Writes the index next to the live one and moves it into place, so a crash never leaves a half-written index."""
+        vector_store = vector_store or self.vector_store
+        tmp_dir = f"{self.vector_db_path}.tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        vector_store.save_local(tmp_dir)
+        os.makedirs(self.vector_db_path, exist_ok=True)
+        for file_name in ("index.faiss", "index.pkl"):
+            os.replace(os.path.join(tmp_dir, file_name), os.path.join(self.vector_db_path, file_name))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        save_profile_state(self.vector_db_path, index_type_of(vector_store.index), self._index_trained_on or vector_store.index.ntotal)
+        self.knowledge_bytes = self.knowledge_size_bytes()
+
+    def _commit_chunks(self, pending_chunks: list, embed_batch_size: int = 256) -> int:
+        """Embeds (text, chunk_hash, metadata) triples in large batches, adds them in one call and persists once."""
+        if not pending_chunks:
+            return 0
+        if self.shared_store is not None:
+            # Chunks another agent already stored are only claimed, not embedded again
+            added = self.shared_store.add_chunks(self.agent_id, pending_chunks, embed_batch_size=embed_batch_size)
+            self.last_used = time.monotonic()
+            self.ingestion_manifest.record_chunks([chunk_hash for _, chunk_hash, _ in pending_chunks])
+            metrics.inc("chunks_ingested_total", added, agent=self.agent_id)
+            logger.info("Committed %d chunks to %s's slice of the shared knowledge base (%d already stored).",
+                        added, self.agent_id, len(pending_chunks) - added)
+            return added
+        texts = [text for text, _, _ in pending_chunks]
+        embeddings = []
+        for start in range(0, len(texts), embed_batch_size):
+            embeddings.extend(self.embeddings_model.embed_documents(texts[start:start + embed_batch_size]))
+        with self._write_lock:
+            self.last_used = time.monotonic()
+            if self.vector_store is None:
+                self._load_vector_store()
             try:
-                self.vector_store.add_texts(texts=chunks, metadatas=[{"source": source_name}] * len(chunks))
-                self.vector_store.save_local(self.vector_db_path)
-                self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 3})
+                # Copy-on-write: queries keep searching the published snapshot while the copy is extended
+                vector_store = clone_vector_store(self.vector_store)
+                vector_store.add_embeddings(
+                    text_embeddings=list(zip(texts, embeddings)),
+                    metadatas=[metadata for _, _, metadata in pending_chunks]
+                )
+                self._save_vector_store(vector_store)
+                self._publish(vector_store)
             except Exception as e:
-                print(f"Error adding texts to vector store for {self.agent_id}: {e}")
-        else:
-            print(f"No chunks generated from {source_name} for {self.agent_id}.")
+                logger.error("Error adding %d chunks to the vector store of %s: %s", len(pending_chunks), self.agent_id, e)
+                metrics.inc("ingestion_errors_total", agent=self.agent_id, stage="commit")
+                raise
+            self.ingestion_manifest.record_chunks([chunk_hash for _, chunk_hash, _ in pending_chunks])
+            # Crossing the profile's chunk threshold switches the agent to its ANN index (or retrains IVF)
+            reindex_from = None
+            if not self._reindexing and needs_rebuild(self.index_profile, vector_store.index, self._index_trained_on):
+                self._reindexing = True
+                reindex_from = vector_store
+        metrics.inc("chunks_ingested_total", len(pending_chunks), agent=self.agent_id)
+        logger.info("Committed %d chunks to %s's knowledge base.", len(pending_chunks), self.agent_id)
+        if reindex_from is not None:
+            self._reindex_and_swap(reindex_from)
+        return len(pending_chunks)
+
+    def _reindex_and_swap(self, vector_store):
+        """Rebuilds the published vector_store without holding the write lock, then swaps the result in.
 
-    def add_knowledge_from_file(self, file_path: str):
+        Queries and commits go on meanwhile. If a commit published a newer store in the meantime, the
+        rebuild is thrown away and done again from that store (still needed, since it only grew).
+        """
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.add_knowledge_from_text(content, source_name=os.path.basename(file_path))
+            while True:
+                rebuilt = self._maybe_reindex(vector_store)
+                with self._write_lock:
+                    current = self.vector_store
+                    if current is vector_store:
+                        if rebuilt is not vector_store:
+                            self._index_trained_on = rebuilt.index.ntotal
+                            self._save_vector_store(rebuilt)
+                            self._publish(rebuilt)
+                        self._reindexing = False
+                        return
+                    if current is None or not needs_rebuild(self.index_profile, current.index, self._index_trained_on):
+                        self._reindexing = False
+                        return
+                    vector_store = current
+                logger.debug("Re-index of %s raced a commit; rebuilding from the newer store.", self.agent_id)
         except Exception as e:
-            print(f"Error reading or processing file {file_path} for {self.agent_id}: {e}")
+            with self._write_lock:
+                self._reindexing = False
+            logger.error("Error re-indexing the vector store of %s: %s. Keeping the current index.", self.agent_id, e)
+            metrics.inc("ingestion_errors_total", agent=self.agent_id, stage="reindex")
 
-    def _build_gemini_chat_history(self, conversation_history: list = None):
-        gemini_history = []
-        if conversation_history:
-            for user_msg, ai_msg in conversation_history:
-                gemini_history.append({'role': 'user', 'parts': [{'text': user_msg}]})
-                gemini_history.append({'role': 'model', 'parts': [{'text': ai_msg}]})
-        return gemini_history
+    @contextmanager
+    def bulk_ingest(self, embed_batch_size: int = 256, near_dedup: bool = True):
+        """Collects chunks from many texts/files and commits them on exit with one index write.
 
-    def think_and_respond(self, user_query: str, conversation_history: list = None):
-        print(f"\n--- {self.persona.get('full_name', self.agent_id)} responding to: '{user_query}' (using Gemini & Local Embeddings) ---")
+        with agent.bulk_ingest() as batch:
+            for path in paths:
+                batch.add_file(path)
 
-        # --- Lấy context từ RAG ---
-        rag_context_str = ""
-        try:
-            # Lấy context từ retriever của chính agent
-            own_docs = self.retriever.invoke(user_query)
-            print(f"Retrieved {len(own_docs)} docs from own knowledge base.")
+        With near_dedup, chunks that are SimHash near-duplicates of indexed or queued chunks are dropped.
+        """
+        batch = KnowledgeBatch(self, embed_batch_size=embed_batch_size, near_dedup=near_dedup)
+        yield batch
+        batch.commit()
 
-            # Lấy context từ retriever chung nếu có
-            general_docs = []
-            if self.general_retriever:
-                general_docs = self.general_retriever.invoke(user_query)
-                print(f"Retrieved {len(general_docs)} docs from general knowledge base.")
-            
-            # Kết hợp và loại bỏ các context trùng lặp
-            all_docs_content = [doc.page_content for doc in own_docs + general_docs]
-            unique_content = list(dict.fromkeys(all_docs_content)) # Giữ lại thứ tự và loại bỏ trùng lặp
-            
-            if unique_content:
-                rag_context_str = "\n\n---\nRelevant Information:\n" + "\n\n".join(unique_content) + "\n---"
-                print(f"Combined RAG context (first 100 chars): {rag_context_str[:100]}...")
-            else:
-                 rag_context_str = "\n\n(No relevant information found)"
+    def add_knowledge_from_text(self, text_content: str, source_name: str = "generic_text") -> int:
+        """Chunks, embeds and indexes text_content, skipping chunks already indexed. Returns the number of chunks added."""
+        with self.bulk_ingest() as batch:
+            batch.add_text(text_content, source_name=source_name)
+        return batch.chunks_added
+
+    def add_knowledge_from_file(self, file_path: str) -> int:
+        return self.add_knowledge_from_files([file_path])
 
+    def add_knowledge_from_files(self, file_paths: list) -> int:
+        """Ingests many files with a single embedding pass and a single index write. Returns the number of chunks added."""
+        try:
+            with self.bulk_ingest() as batch:
+                for file_path in file_paths:
+                    batch.add_file(file_path)
+            return batch.chunks_added
         except Exception as e:
-            print(f"Error during RAG retrieval for {self.agent_id}: {e}")
-            rag_context_str = "\n\n(Error retrieving relevant information)"
-        
-        # --- Xây dựng Prompt ---
-        chat_session = self.llm.start_chat(
-            history=self._build_gemini_chat_history(conversation_history)
-        )
-        
-        system_prompt_with_instructions = f"""
-        {self.system_prompt_content}
+            logger.error("Error ingesting %d files for %s: %s", len(file_paths), self.agent_id, e)
+            metrics.inc("ingestion_errors_total", agent=self.agent_id, stage="batch")
+            return 0
+
+    def new_conversation_memory(self, **settings) -> ConversationMemory:
+        """Memory for one chat or discussion with this agent; settings override MEMORY_RECENT_TURNS etc."""
+        return ConversationMemory(self.summarizer, labels=("Người dùng", self.persona.get('full_name', self.agent_id)), **settings)
+
+    def _build_turn_message(self, system_prompt: str, rag_context_str: str, user_query: str) -> str:
+        return f"""
+        {system_prompt}
 
         Câu trả lời của bạn nên tuân theo các bước:
         1. Phân tích bối cảnh sau:
@@ -186,29 +469,313 @@ class CharacterAgent:
            Tránh lặp lại câu hỏi hoặc thông tin không cần thiết từ RAG.
         """
 
-        # Gán prompt đã xây dựng để gửi đi
-        full_user_message_for_turn = system_prompt_with_instructions
-    
+    def _prepare_turn(self, user_query: str, conversation_history: list = None, token_budget: int = None,
+                      query_vector=None, timings: dict = None):
+        """Retrieves RAG context, packs it with the system prompt and history into token_budget tokens
+        (default CONTEXT_TOKEN_BUDGET) and builds the message to send.
 
-        print(f"Sending to Gemini (first 200 chars): {full_user_message_for_turn[:200].strip()}...")
-        
+        query_vector is user_query already embedded (with this agent's embedding model), e.g. once for
+        all agents of a poll; stage durations are also written to timings if a dict is given.
+
+        Returns (message, packed); packed.history is the part of conversation_history to send along with it.
+        """
+        log_sampled(logger, logging.INFO, "%s responding to: %r", self.agent_id, user_query)
+
+        # --- Lấy context từ RAG ---
+        unique_content = []
+        rag_error = False
         try:
-            response = chat_session.send_message(full_user_message_for_turn)
-            ai_response_text = response.text
-            print(f"Gemini Raw Response (first 200 chars): {ai_response_text[:200]}...")
+            # Lấy context từ retriever của chính agent
+            with metrics.timer("retrieval", self.agent_id, into=timings):
+                own_docs = search_retriever(self.ensure_knowledge_loaded(), user_query, query_vector)
+            log_sampled(logger, logging.DEBUG, "%s: retrieved %d docs from own knowledge base.", self.agent_id, len(own_docs))
+
+            # Lấy context từ retriever chung nếu có
+            general_docs = []
+            if self.general_retriever:
+                with metrics.timer("general_retrieval", self.agent_id, into=timings):
+                    general_docs = search_retriever(self.general_retriever, user_query, query_vector)
+                log_sampled(logger, logging.DEBUG, "%s: retrieved %d docs from general knowledge base.", self.agent_id, len(general_docs))
+
+            # Xen kẽ theo thứ hạng (độ liên quan giảm dần) và loại bỏ các context trùng lặp
+            ranked_docs = [doc for rank in range(max(len(own_docs), len(general_docs)))
+                           for doc in (own_docs[rank:rank + 1] + general_docs[rank:rank + 1])]
+            unique_content = list(dict.fromkeys(doc.page_content for doc in ranked_docs))
         except Exception as e:
-            print(f"Error calling Gemini API for {self.agent_id}: {e}")
-            if hasattr(e, 'response') and e.response: 
-                try:
-                    error_details = e.response.json() if hasattr(e.response, 'json') else e.response.text
-                    print(f"Gemini API Error Response: {error_details}")
-                except:
-                    print(f"Gemini API Error Response (raw): {e.response.text if hasattr(e.response, 'text') else 'No text'}")
-            elif hasattr(e, 'message'):
-                print(f"Error message: {e.message}")
+            logger.error("Error during RAG retrieval for %s: %s", self.agent_id, e)
+            metrics.inc("retrieval_errors_total", agent=self.agent_id)
+            rag_error = True
+
+        with metrics.timer("prompt_build", self.agent_id, into=timings):
+            # --- Chia ngân sách token: system prompt, RAG (theo độ liên quan), lịch sử (mới nhất trước) ---
+            packed = pack_context(self.system_prompt_content, self._build_turn_message("", "", user_query),
+                                  unique_content, conversation_history, budget=token_budget)
+            log_sampled(logger, logging.INFO, "Context for %s: %s", self.agent_id, packed.summary())
+
+            if rag_error:
+                rag_context_str = "\n\n(Error retrieving relevant information)"
+            elif packed.chunks:
+                rag_context_str = format_rag_context(packed.chunks)
             else:
-                print(f"Full error: {e}")
-            ai_response_text = "Xin lỗi, tôi gặp sự cố khi xử lý yêu cầu của bạn với Gemini."
+                rag_context_str = "\n\n(No relevant information found)"
+
+            # --- Xây dựng Prompt ---
+            full_user_message_for_turn = self._build_turn_message(packed.system_prompt, rag_context_str, user_query)
+
+        log_sampled(logger, logging.DEBUG, "Sending to %s for %s:\n%s", self.llm.name, self.agent_id, full_user_message_for_turn)
+        return full_user_message_for_turn, packed
+
+    def _log_llm_error(self, e: Exception):
+        details = e
+        if hasattr(e, 'response') and e.response:
+            try:
+                details = e.response.json() if hasattr(e.response, 'json') else e.response.text
+            except Exception:
+                details = e.response.text if hasattr(e.response, 'text') else 'No text'
+        elif hasattr(e, 'message'):
+            details = e.message
+        logger.error("Error calling %s LLM backend for %s: %s (%s)", self.llm.name, self.agent_id, type(e).__name__, details)
+
+    def _cache_key(self, full_user_message_for_turn: str, conversation_history: list = None) -> str:
+        return prompt_fingerprint(self.llm.cache_model_name, self.generation_config, self.system_prompt_content,
+                                  full_user_message_for_turn, conversation_history)
+
+    def _lookup_cached_reply(self, full_user_message_for_turn: str, packed, use_cache: bool) -> tuple:
+        """(cache, cache_key, cached_text); cache and cache_key are None when caching is off, cached_text on a miss."""
+        cache = self.response_cache if use_cache else None
+        cache_key = self._cache_key(full_user_message_for_turn, packed.history) if cache else None
+        cached_text = cache.get(cache_key) if cache else None
+        if cached_text is not None:
+            metrics.inc("llm_cache_hits_total", agent=self.agent_id)
+            log_sampled(logger, logging.INFO, "LLM cache hit for %s.", self.agent_id)
+        else:
+            metrics.inc("llm_cache_misses_total", agent=self.agent_id)
+        return cache, cache_key, cached_text
+
+    def _record_reply(self, packed, ai_response_text: str, cache, cache_key: str):
+        metrics.inc("llm_tokens_in_total", packed.total_tokens, agent=self.agent_id)
+        metrics.inc("llm_tokens_out_total", num_tokens_from_string(ai_response_text), agent=self.agent_id)
+        if cache:
+            cache.put(cache_key, ai_response_text, self.llm.cache_model_name)
+
+    def think_and_respond(self, user_query: str, conversation_history: list = None, use_cache: bool = True,
+                          token_budget: int = None, query_vector=None, timings: dict = None):
+        """Returns the agent's reply; identical prompts are served from the response cache unless use_cache is False.
+
+        The prompt (system prompt, RAG context and history) is packed into token_budget tokens (default CONTEXT_TOKEN_BUDGET).
+        The LLM call goes through the shared LLMDispatcher (concurrency caps, timeout, retries, circuit breaker).
+        query_vector and timings are passed on to _prepare_turn; timings also gets llm_call and turn_total.
+        """
+        with metrics.timer("turn_total", self.agent_id, into=timings):
+            full_user_message_for_turn, packed = self._prepare_turn(user_query, conversation_history, token_budget,
+                                                                    query_vector, timings)
+            cache, cache_key, ai_response_text = self._lookup_cached_reply(full_user_message_for_turn, packed, use_cache)
+            if ai_response_text is None:
+                try:
+                    with metrics.timer("llm_call", self.agent_id, into=timings):
+                        ai_response_text = self.llm_dispatcher.generate(self.llm, full_user_message_for_turn, packed.history)
+                    self._record_reply(packed, ai_response_text, cache, cache_key)
+                except Exception as e:
+                    metrics.inc("llm_api_errors_total", agent=self.agent_id)
+                    self._log_llm_error(e)
+                    ai_response_text = LLM_ERROR_REPLY
+
+        log_sampled(logger, logging.DEBUG, "%s: %s", self.persona.get('full_name', self.agent_id), ai_response_text)
+        return ai_response_text
+
+    async def athink_and_respond(self, user_query: str, conversation_history: list = None, use_cache: bool = True,
+                                 token_budget: int = None, query_vector=None, timings: dict = None):
+        """Async think_and_respond: retrieval and packing run in a worker thread, the LLM call awaits the dispatcher."""
+        with metrics.timer("turn_total", self.agent_id, into=timings):
+            full_user_message_for_turn, packed = await asyncio.to_thread(
+                self._prepare_turn, user_query, conversation_history, token_budget, query_vector, timings)
+            cache, cache_key, ai_response_text = self._lookup_cached_reply(full_user_message_for_turn, packed, use_cache)
+            if ai_response_text is None:
+                try:
+                    with metrics.timer("llm_call", self.agent_id, into=timings):
+                        ai_response_text = await self.llm_dispatcher.agenerate(self.llm, full_user_message_for_turn, packed.history)
+                    self._record_reply(packed, ai_response_text, cache, cache_key)
+                except Exception as e:
+                    metrics.inc("llm_api_errors_total", agent=self.agent_id)
+                    self._log_llm_error(e)
+                    ai_response_text = LLM_ERROR_REPLY
+
+        log_sampled(logger, logging.DEBUG, "%s: %s", self.persona.get('full_name', self.agent_id), ai_response_text)
+        return ai_response_text
+
+    def think_and_respond_stream(self, user_query: str, conversation_history: list = None, use_cache: bool = True,
+                                 token_budget: int = None):
+        """Same as think_and_respond, but yields the reply text chunk by chunk as the LLM produces it.
+
+        A cached reply is yielded as a single chunk; a streamed reply is cached only if the stream completed.
+        """
+        turn_started = time.perf_counter()
+        full_user_message_for_turn, packed = self._prepare_turn(user_query, conversation_history, token_budget)
+        cache, cache_key, cached_text = self._lookup_cached_reply(full_user_message_for_turn, packed, use_cache)
+        if cached_text is not None:
+            metrics.observe("agent_stage_seconds", time.perf_counter() - turn_started, agent=self.agent_id, stage="turn_total")
+            yield cached_text
+            return
+
+        received_chunks = []
+        llm_started = time.perf_counter()
+        try:
+            for chunk_text in self.llm_dispatcher.stream(self.llm, full_user_message_for_turn, packed.history):
+                if chunk_text:
+                    if not received_chunks:
+                        metrics.observe("agent_stage_seconds", time.perf_counter() - llm_started, agent=self.agent_id, stage="llm_first_chunk")
+                    received_chunks.append(chunk_text)
+                    yield chunk_text
+        except Exception as e:
+            metrics.inc("llm_api_errors_total", agent=self.agent_id)
+            self._log_llm_error(e)
+            # Keep whatever was already shown; only fall back to the apology if nothing arrived
+            if not received_chunks:
+                yield LLM_ERROR_REPLY
+            return
+        # Durations include the time the consumer spent between chunks
+        metrics.observe("agent_stage_seconds", time.perf_counter() - llm_started, agent=self.agent_id, stage="llm_call")
+        metrics.observe("agent_stage_seconds", time.perf_counter() - turn_started, agent=self.agent_id, stage="turn_total")
+        if received_chunks:
+            self._record_reply(packed, "".join(received_chunks), cache, cache_key)
+
+    async def athink_and_respond_stream(self, user_query: str, conversation_history: list = None, use_cache: bool = True,
+                                        token_budget: int = None):
+        """Async think_and_respond_stream (an async generator of reply chunks)."""
+        turn_started = time.perf_counter()
+        full_user_message_for_turn, packed = await asyncio.to_thread(
+            self._prepare_turn, user_query, conversation_history, token_budget)
+        cache, cache_key, cached_text = self._lookup_cached_reply(full_user_message_for_turn, packed, use_cache)
+        if cached_text is not None:
+            metrics.observe("agent_stage_seconds", time.perf_counter() - turn_started, agent=self.agent_id, stage="turn_total")
+            yield cached_text
+            return
+
+        received_chunks = []
+        llm_started = time.perf_counter()
+        try:
+            async for chunk_text in self.llm_dispatcher.astream(self.llm, full_user_message_for_turn, packed.history):
+                if chunk_text:
+                    if not received_chunks:
+                        metrics.observe("agent_stage_seconds", time.perf_counter() - llm_started, agent=self.agent_id, stage="llm_first_chunk")
+                    received_chunks.append(chunk_text)
+                    yield chunk_text
+        except Exception as e:
+            metrics.inc("llm_api_errors_total", agent=self.agent_id)
+            self._log_llm_error(e)
+            if not received_chunks:
+                yield LLM_ERROR_REPLY
+            return
+        metrics.observe("agent_stage_seconds", time.perf_counter() - llm_started, agent=self.agent_id, stage="llm_call")
+        metrics.observe("agent_stage_seconds", time.perf_counter() - turn_started, agent=self.agent_id, stage="turn_total")
+        if received_chunks:
+            self._record_reply(packed, "".join(received_chunks), cache, cache_key)
+
+
+class KnowledgeBatch:
+    """Pending chunks for one CharacterAgent.bulk_ingest() transaction."""
+
+    def __init__(self, agent: CharacterAgent, embed_batch_size: int = 256, near_dedup: bool = True):
+        self.agent = agent
+        self.embed_batch_size = embed_batch_size
+        self.near_dedup = near_dedup
+        self.pending_chunks = [] # (text, chunk_hash, metadata)
+        self.pending_files = [] # (file_path, content, chunks_queued)
+        self._pending_hashes = set()
+        # Fingerprints of what this batch queued; merged into the manifest only once the batch is committed
+        self._pending_document_fingerprints = NearDuplicateIndex()
+        self._pending_chunk_fingerprints = NearDuplicateIndex()
+        self._pending_duplicate_links = {}
+        self.chunks_added = 0
+        self.stats = {"documents": 0, "documents_near_duplicate": 0, "chunks": 0,
+                      "chunks_exact_duplicate": 0, "chunks_near_duplicate": 0, "chunks_queued": 0}
+
+    def near_duplicate_of(self, document_key: str, text: str) -> str | None:
+        """Key of an already ingested (or queued) document that text near-duplicates, else None.
+
+        A novel document is remembered under document_key, so later copies of it are caught.
+        """
+        self.stats["documents"] += 1
+        if not self.near_dedup or word_count(text) < NEAR_DUP_MIN_WORDS:
+            return None
+        fingerprint = simhash(text)
+        representative = (self.agent.ingestion_manifest.article_fingerprints.find(fingerprint)
+                          or self._pending_document_fingerprints.find(fingerprint))
+        if representative is not None and representative != document_key:
+            self._pending_duplicate_links[document_key] = representative
+            self.stats["documents_near_duplicate"] += 1
+            return representative
+        self._pending_document_fingerprints.add(document_key, fingerprint)
+        return None
+
+    def _is_near_duplicate_chunk(self, chunk: str, chunk_hash: str) -> bool:
+        if not self.near_dedup or word_count(chunk) < NEAR_DUP_MIN_WORDS:
+            return False
+        fingerprint = simhash(chunk)
+        if (self.agent.ingestion_manifest.chunk_fingerprints.find(fingerprint) is not None
+                or self._pending_chunk_fingerprints.find(fingerprint) is not None):
+            return True
+        self._pending_chunk_fingerprints.add(chunk_hash, fingerprint)
+        return False
+
+    def add_text(self, text_content: str, source_name: str = "generic_text", metadata: dict = None) -> int:
+        cleaned_text_content = clean_text(text_content)
+        if not cleaned_text_content:
+            log_sampled(logger, logging.INFO, "Skipping empty or invalid text for %s from %s.", self.agent.agent_id, source_name)
+            return 0
+        chunks = self.agent.text_splitter.split_text(cleaned_text_content)
+        new_chunks = [
+            (chunk, chunk_hash) for chunk, chunk_hash in self.agent.ingestion_manifest.filter_new_chunks(chunks)
+            if chunk_hash not in self._pending_hashes
+        ]
+        unique_chunks = [(chunk, chunk_hash) for chunk, chunk_hash in new_chunks if not self._is_near_duplicate_chunk(chunk, chunk_hash)]
+        self.stats["chunks"] += len(chunks)
+        self.stats["chunks_exact_duplicate"] += len(chunks) - len(new_chunks)
+        self.stats["chunks_near_duplicate"] += len(new_chunks) - len(unique_chunks)
+        self.stats["chunks_queued"] += len(unique_chunks)
+        new_chunks = unique_chunks
+        for chunk, chunk_hash in new_chunks:
+            chunk_metadata = dict(metadata or {})
+            chunk_metadata.update({"source": source_name, "chunk_hash": chunk_hash})
+            self.pending_chunks.append((chunk, chunk_hash, chunk_metadata))
+            self._pending_hashes.add(chunk_hash)
+        if not chunks:
+            log_sampled(logger, logging.INFO, "No chunks generated from %s for %s.", source_name, self.agent.agent_id)
+        elif len(new_chunks) < len(chunks):
+            log_sampled(logger, logging.DEBUG, "Queued %d chunks from %s for %s (%d already indexed or near-duplicates).",
+                        len(new_chunks), source_name, self.agent.agent_id, len(chunks) - len(new_chunks))
+        return len(new_chunks)
+
+    def add_file(self, file_path: str) -> int:
+        # Unchanged files are skipped on their size/mtime (or content hash) without being chunked
+        if not self.agent.ingestion_manifest.needs_ingest(file_path):
+            return 0
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            logger.error("Error reading file %s for %s: %s", file_path, self.agent.agent_id, e)
+            metrics.inc("ingestion_errors_total", agent=self.agent.agent_id, stage="read")
+            return 0
+        chunks_queued = self.add_text(content, source_name=os.path.basename(file_path))
+        self.pending_files.append((file_path, content, chunks_queued))
+        return chunks_queued
+
+    def dedup_ratio(self) -> float:
+        """Share of generated chunks that were not embedded because they were exact or near duplicates."""
+        return 1 - self.stats["chunks_queued"] / self.stats["chunks"] if self.stats["chunks"] else 0.0
 
-        print(f"{self.persona.get('full_name', self.agent_id)}: {ai_response_text}")
-        return ai_response_text
\ No newline at end of file
+    def commit(self) -> int:
+        self.chunks_added = self.agent._commit_chunks(self.pending_chunks, embed_batch_size=self.embed_batch_size)
+        manifest = self.agent.ingestion_manifest
+        for file_path, content, chunks_queued in self.pending_files:
+            manifest.record_file(file_path, content, chunks_queued)
+        manifest.record_fingerprints(self._pending_document_fingerprints.fingerprints,
+                                     self._pending_chunk_fingerprints.fingerprints, self._pending_duplicate_links)
+        manifest.save()
+        self.pending_chunks, self.pending_files = [], []
+        self._pending_hashes = set()
+        self._pending_document_fingerprints = NearDuplicateIndex()
+        self._pending_chunk_fingerprints = NearDuplicateIndex()
+        self._pending_duplicate_links = {}
+        return self.chunks_added
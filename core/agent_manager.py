@@ -1,62 +1,485 @@
 import os
+import time
+import logging
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yaml
 from core.agent import CharacterAgent
+from core.embeddings import get_embedding_stats, get_shared_embeddings, DEFAULT_EMBEDDING_MODEL_NAME
+from core.shared_store import SharedKnowledgeStore
+from core.response_cache import get_response_cache
+from core.retention import policy_is_unlimited, resolve_retention_policy
+from core.ingestion_manifest import IngestionManifest
+from core.update_worker import KnowledgeUpdateWorker
+from core.metrics import metrics, get_logger, log_sampled
+from core.llm_dispatcher import get_llm_dispatcher
+from core.conversation_memory import RollingSummary
+
+VECTOR_STORE_MODES = ("per_agent", "shared")
+# Agents of one poll that retrieve and wait on the LLM at the same time (the LLM dispatcher caps calls globally too)
+POLL_MAX_CONCURRENCY = int(os.getenv("POLL_MAX_CONCURRENCY", "8"))
+DISCUSSION_MODES = ("sequential", "parallel_opening", "rounds")
+
+logger = get_logger(__name__)
 
 class AgentManager:
-    def __init__(self, national_persona_dir: str, personal_persona_dir: str, vector_db_base_dir: str):
-        self.agents = {}
+    def __init__(self, national_persona_dir: str, personal_persona_dir: str, vector_db_base_dir: str,
+                 max_loaded_agents: int = None, idle_timeout_s: float = None, memory_budget_mb: float = None,
+                 vector_store_mode: str = "per_agent"):
+        """Agents are registered from a cheap scan of the persona directories and built on first get_agent().
+
+        max_loaded_agents / idle_timeout_s / memory_budget_mb bound how many vector stores stay in memory
+        (None = unlimited); least recently used agents have their vector store unloaded first.
+        vector_store_mode="shared" keeps every agent's chunks in one SharedKnowledgeStore under
+        <vector_db_base_dir>/shared_db instead of one index per agent.
+        """
+        self.agents = OrderedDict() # Agents đã được khởi tạo, theo thứ tự sử dụng gần nhất (LRU)
+        self.agent_specs = {} # agent_id -> {"persona_path", "kind", "full_name", "retention_policy"}
         self.national_persona_dir = national_persona_dir
         self.personal_persona_dir = personal_persona_dir
         self.vector_db_base_dir = vector_db_base_dir
+        self.max_loaded_agents = max_loaded_agents
+        self.idle_timeout_s = idle_timeout_s
+        self.memory_budget_mb = memory_budget_mb
+        self._lock = threading.RLock()
+        self._agent_init_locks = {}
+        self.stats = {"agents_materialized": 0, "knowledge_loads": 0, "knowledge_evictions": 0}
         os.makedirs(self.vector_db_base_dir, exist_ok=True)
+        if vector_store_mode not in VECTOR_STORE_MODES:
+            raise ValueError(f"Unknown vector_store_mode '{vector_store_mode}'. Expected one of {VECTOR_STORE_MODES}.")
+        self.vector_store_mode = vector_store_mode
+        self.shared_store = None
+        if vector_store_mode == "shared":
+            self.shared_store = SharedKnowledgeStore(os.path.join(self.vector_db_base_dir, "shared_db"),
+                                                     get_shared_embeddings(DEFAULT_EMBEDDING_MODEL_NAME))
+        # Background knowledge updates (see core.data_pipeline.start_data_update), one at a time
+        self.update_worker = KnowledgeUpdateWorker()
         self._load_agents()
 
     def _load_agents(self):
-        # Load national agents
-        for persona_file in os.listdir(self.national_persona_dir):
-            if persona_file.endswith(".yaml"):
-                agent_id = persona_file.replace(".yaml", "")
-                persona_path = os.path.join(self.national_persona_dir, persona_file)
-                self.agents[agent_id] = CharacterAgent(agent_id, persona_path, self.vector_db_base_dir)
-                print(f"Loaded National Agent: {self.agents[agent_id].persona.get('full_name', agent_id)}")
-
-        # Load personal agents
-        for persona_file in os.listdir(self.personal_persona_dir):
-            if persona_file.endswith(".yaml"):
-                agent_id = persona_file.replace(".yaml", "")
-                persona_path = os.path.join(self.personal_persona_dir, persona_file)
-                self.agents[agent_id] = CharacterAgent(agent_id, persona_path, self.vector_db_base_dir)
-                print(f"Loaded Personal Agent: {self.agents[agent_id].persona.get('full_name', agent_id)}")
-        
+        """Registers every persona YAML without building the agents."""
+        for kind, persona_dir in (("national", self.national_persona_dir), ("personal", self.personal_persona_dir)):
+            for persona_file in sorted(os.listdir(persona_dir)):
+                if persona_file.endswith(".yaml"):
+                    agent_id = persona_file.replace(".yaml", "")
+                    persona_path = os.path.join(persona_dir, persona_file)
+                    persona = {}
+                    try:
+                        with open(persona_path, 'r', encoding='utf-8') as f:
+                            persona = yaml.safe_load(f) or {}
+                    except Exception as e:
+                        logger.warning("Could not read persona %s: %s", persona_path, e)
+                    full_name = persona.get('full_name', agent_id)
+                    # Kept with the spec so compaction can skip unlimited agents without building them
+                    self.agent_specs[agent_id] = {"persona_path": persona_path, "kind": kind, "full_name": full_name,
+                                                  "retention_policy": resolve_retention_policy(persona)}
+                    logger.debug("Registered %s agent: %s", kind, full_name)
+
+    def list_agent_ids(self) -> list:
+        return sorted(self.agent_specs.keys())
+
+    def has_agent(self, agent_id: str) -> bool:
+        return agent_id in self.agent_specs
+
+    def get_agent_name(self, agent_id: str) -> str:
+        spec = self.agent_specs.get(agent_id)
+        return spec["full_name"] if spec else agent_id
+
     def get_agent(self, agent_id: str) -> CharacterAgent | None:
-        return self.agents.get(agent_id)
+        spec = self.agent_specs.get(agent_id)
+        if spec is None:
+            return None
+        with self._lock:
+            agent = self.agents.get(agent_id)
+            if agent is not None:
+                self.agents.move_to_end(agent_id)
+            init_lock = self._agent_init_locks.setdefault(agent_id, threading.Lock())
+
+        if agent is None:
+            # Build outside the manager lock so other agents stay available while this one loads
+            with init_lock:
+                agent = self.agents.get(agent_id)
+                if agent is None:
+                    agent = CharacterAgent(agent_id, spec["persona_path"], self.vector_db_base_dir, shared_store=self.shared_store)
+                    log_sampled(logger, logging.INFO, "Loaded %s agent: %s", spec['kind'], agent.persona.get('full_name', agent_id))
+                    with self._lock:
+                        self.agents[agent_id] = agent
+                        self.stats["agents_materialized"] += 1
+                        self.stats["knowledge_loads"] += 1
+        elif not agent.knowledge_loaded:
+            agent.ensure_knowledge_loaded()
+            with self._lock:
+                self.stats["knowledge_loads"] += 1
+
+        agent.last_used = time.monotonic()
+        self._enforce_memory_policy(keep_agent_id=agent_id)
+        return agent
+
+    def _enforce_memory_policy(self, keep_agent_id: str = None):
+        """Unloads vector stores of idle agents, then of least recently used ones while over budget."""
+        with self._lock:
+            now = time.monotonic()
+            loaded = [(aid, agent) for aid, agent in self.agents.items() if agent.knowledge_loaded and aid != keep_agent_id]
+            to_evict = []
+            if self.idle_timeout_s is not None:
+                to_evict = [(aid, agent) for aid, agent in loaded if now - agent.last_used > self.idle_timeout_s]
+                loaded = [item for item in loaded if item not in to_evict]
+
+            # `loaded` is in LRU order (oldest first); the agent being used always counts as resident
+            resident_count = len(loaded) + (1 if keep_agent_id in self.agents else 0)
+            resident_bytes = sum(agent.knowledge_bytes for agent in self.agents.values() if agent.knowledge_loaded)
+            resident_bytes -= sum(agent.knowledge_bytes for _, agent in to_evict)
+            for aid, agent in loaded:
+                over_count = self.max_loaded_agents is not None and resident_count > self.max_loaded_agents
+                over_budget = self.memory_budget_mb is not None and resident_bytes > self.memory_budget_mb * 1024 * 1024
+                if not (over_count or over_budget):
+                    break
+                to_evict.append((aid, agent))
+                resident_count -= 1
+                resident_bytes -= agent.knowledge_bytes
+
+        for aid, agent in to_evict:
+            if agent.unload_knowledge():
+                with self._lock:
+                    self.stats["knowledge_evictions"] += 1
+
+    def get_agent_stats(self) -> dict:
+        """Registered/materialized/resident agent counts plus load and eviction counters."""
+        with self._lock:
+            resident = [aid for aid, agent in self.agents.items() if agent.knowledge_loaded]
+            return dict(
+                self.stats,
+                agents_registered=len(self.agent_specs),
+                agents_materialized_now=len(self.agents),
+                knowledge_resident=len(resident),
+                knowledge_resident_mb=sum(self.agents[aid].knowledge_bytes for aid in resident) / (1024 * 1024),
+                vector_store_mode=self.vector_store_mode,
+                shared_store=self.shared_store.get_stats() if self.shared_store else None,
+            )
+
+    def get_embedding_stats(self) -> dict:
+        """Loaded embedding models and batch sizes of the shared embedding service."""
+        return get_embedding_stats()
+
+    def get_llm_cache_stats(self) -> dict:
+        """Hit/miss/eviction counters and size of the LLM response cache."""
+        cache = get_response_cache()
+        return cache.get_stats() if cache else {"enabled": False}
+
+    def get_metrics(self) -> dict:
+        """JSON snapshot of the pipeline metrics (stage latency histograms, token/cache/error/ingestion counters)."""
+        return metrics.snapshot()
 
-    def ask_single_agent(self, agent_id: str, question: str, conversation_history: list = None):
+    def get_llm_stats(self) -> dict:
+        """Calls in flight, limits and circuit breaker state per model of the shared LLM dispatcher."""
+        return get_llm_dispatcher().get_stats()
+
+    def get_index_report(self, agent_id: str, n_queries: int = 200, k: int = 3) -> list | None:
+        """Recall-vs-latency comparison of the ANN index types on one agent's knowledge base (None if unknown)."""
         agent = self.get_agent(agent_id)
+        return agent.index_report(n_queries=n_queries, k=k) if agent else None
+
+    def get_update_status(self) -> dict | None:
+        """State and per-agent progress of the running (or last finished) knowledge update; None if there was none."""
+        job = self.update_worker.current_job
+        return job.to_dict() if job else None
+
+    def cancel_knowledge_update(self) -> bool:
+        """Asks the running knowledge update to stop. Returns False if no update is running."""
+        job = self.update_worker.current_job
+        return job.cancel() if job else False
+
+    def shutdown(self, timeout: float = 30.0):
+        """Cancels a running knowledge update and waits for it to stop."""
+        self.update_worker.shutdown(timeout)
+
+    def compact_knowledge(self, agent_ids: list = None, now=None) -> list:
+        """Applies the retention policy of each agent (default: all registered) and rebuilds the affected indexes.
+
+        Policies come from the registered persona specs, so agents without any retention limit
+        are neither built nor loaded. In shared mode the store is compacted once for all agents
+        without building any; otherwise an agent whose index was not resident is unloaded again
+        afterwards. Returns the compaction reports.
+        """
+        policies = {}
+        for agent_id in agent_ids or self.list_agent_ids():
+            spec = self.agent_specs.get(agent_id)
+            if spec is not None and not policy_is_unlimited(spec["retention_policy"]):
+                policies[agent_id] = spec["retention_policy"]
+        if not policies:
+            logger.info("Compaction: no agent has a retention policy.")
+            return []
+        if self.shared_store is not None:
+            return [self.shared_store.compact(policies, now=now, manifests={agent_id: self._ingestion_manifest(agent_id) for agent_id in policies})]
+        reports = []
+        for agent_id in policies:
+            with self._lock:
+                agent = self.agents.get(agent_id)
+                was_resident = agent is not None and agent.knowledge_loaded
+            try:
+                reports.append(self.get_agent(agent_id).compact_knowledge(now=now))
+            except Exception as e:
+                logger.error("Error compacting knowledge of %s: %s", agent_id, e)
+                metrics.inc("compaction_errors_total", agent=agent_id)
+            agent = self.agents.get(agent_id)
+            if not was_resident and agent is not None and agent.unload_knowledge():
+                with self._lock:
+                    self.stats["knowledge_evictions"] += 1
+        return reports
+
+    def _ingestion_manifest(self, agent_id: str) -> IngestionManifest:
+        """The live manifest of a built agent, else the one on disk."""
+        with self._lock:
+            agent = self.agents.get(agent_id)
+        if agent is not None:
+            return agent.ingestion_manifest
+        if self.shared_store is not None:
+            return IngestionManifest(self.shared_store.manifest_path(agent_id))
+        return IngestionManifest(os.path.join(self.vector_db_base_dir, f"{agent_id}_db", "ingest_manifest.json"))
+
+    def ingested_store_offset(self, agent_id: str) -> int:
+        """Last article store seq ingested by agent_id, read without building the agent or loading its index."""
+        return self._ingestion_manifest(agent_id).store_offset
+
+    def ask_single_agent(self, agent_id: str, question: str, conversation_history: list = None, use_cache: bool = True):
+        agent = self.get_agent(agent_id)
+        if agent:
+            return agent.think_and_respond(question, conversation_history, use_cache=use_cache)
+        else:
+            logger.warning("Agent with ID %r not found.", agent_id)
+            return f"Agent '{agent_id}' không tồn tại."
+
+    async def aask_single_agent(self, agent_id: str, question: str, conversation_history: list = None, use_cache: bool = True):
+        agent = await asyncio.to_thread(self.get_agent, agent_id)
         if agent:
-            return agent.think_and_respond(question, conversation_history)
+            return await agent.athink_and_respond(question, conversation_history, use_cache=use_cache)
         else:
-            print(f"Error: Agent with ID '{agent_id}' not found.")
+            logger.warning("Agent with ID %r not found.", agent_id)
             return f"Agent '{agent_id}' không tồn tại."
 
+    def ask_single_agent_stream(self, agent_id: str, question: str, conversation_history: list = None, use_cache: bool = True):
+        """Yields the agent's reply chunk by chunk."""
+        agent = self.get_agent(agent_id)
+        if agent:
+            yield from agent.think_and_respond_stream(question, conversation_history, use_cache=use_cache)
+        else:
+            logger.warning("Agent with ID %r not found.", agent_id)
+            yield f"Agent '{agent_id}' không tồn tại."
+
+    def run_load_test(self, agent_ids: list, n_requests: int = 50, concurrency: int = 4,
+                      question: str = "Quan điểm của bạn về tình hình thương mại hiện nay là gì?") -> dict:
+        """Sends n_requests uncached turns, round-robin over agent_ids, from `concurrency` threads.
+
+        Meant for the stub LLM backend (LLM_BACKEND=stub or `llm: {backend: stub}` in a persona), so
+        retrieval, packing and scheduling throughput can be measured offline. Each request gets a
+        distinct question so the response cache stays out of the way. Per-stage latency ends up in
+        get_metrics(); the returned dict has overall throughput and turn latency percentiles.
+        """
+        agent_ids = [agent_id for agent_id in agent_ids if self.get_agent(agent_id) is not None]
+        if not agent_ids:
+            return {"requests": 0}
+
+        def one_request(index):
+            started = time.perf_counter()
+            self.ask_single_agent(agent_ids[index % len(agent_ids)], f"{question} (#{index})", use_cache=False)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            latencies = sorted(executor.map(one_request, range(n_requests)))
+        elapsed = time.perf_counter() - started
+        return {
+            "requests": n_requests,
+            "agents": len(agent_ids),
+            "concurrency": concurrency,
+            "seconds": elapsed,
+            "requests_per_s": n_requests / elapsed if elapsed else float("inf"),
+            "p50_s": latencies[len(latencies) // 2],
+            "p95_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "max_s": latencies[-1],
+        }
+
+    def poll_agents_stream(self, agent_ids: list, question: str, max_concurrency: int = POLL_MAX_CONCURRENCY,
+                           use_cache: bool = True):
+        """Asks every agent the same question concurrently, yielding events as answers come in:
+
+        {"type": "start", "question", "agents": [(agent_id, name), ...], "embedding_s"}
+        {"type": "result", "agent_id", "name", "text", "error", "timings", "elapsed_s"}  in completion order
+        {"type": "end", "elapsed_s", "results": {agent_id: text}}
+
+        The question is embedded once (per embedding model) and every agent searches with that vector.
+        At most max_concurrency agents are in flight; their LLM calls also share the dispatcher's limits.
+        timings has the agent's stages (retrieval, general_retrieval, prompt_build, llm_call, turn_total;
+        no llm_call on a cache hit) plus queued_s, the wait for a free slot after submission. elapsed_s counts from the start.
+        """
+        poll_started = time.perf_counter()
+        agent_ids = [agent_id for agent_id in dict.fromkeys(agent_ids) if self.has_agent(agent_id)]
+        start_event = {"type": "start", "question": question,
+                       "agents": [(agent_id, self.get_agent_name(agent_id)) for agent_id in agent_ids]}
+        if not agent_ids:
+            yield dict(start_event, embedding_s=0.0)
+            yield {"type": "end", "elapsed_s": time.perf_counter() - poll_started, "results": {}}
+            return
+
+        # Every agent currently embeds with the shared default model; group by model all the same
+        query_vectors = {}
+        embedding_started = time.perf_counter()
+        for model_name in {self._embedding_model_name(agent_id) for agent_id in agent_ids}:
+            try:
+                query_vectors[model_name] = get_shared_embeddings(model_name).embed_query(question)
+            except Exception as e:
+                logger.warning("Error embedding poll question with %s: %s. Agents will embed it themselves.", model_name, e)
+        yield dict(start_event, embedding_s=time.perf_counter() - embedding_started)
+
+        def ask(agent_id, submitted):
+            started = time.perf_counter()
+            timings = {"queued_s": started - submitted}
+            try:
+                agent = self.get_agent(agent_id)
+                text = agent.think_and_respond(question, use_cache=use_cache, timings=timings,
+                                               query_vector=query_vectors.get(agent.embedding_model_name))
+                return text, None, timings
+            except Exception as e:
+                logger.error("Error polling agent %s: %s", agent_id, e)
+                metrics.inc("poll_errors_total", agent=agent_id)
+                timings["turn_total"] = time.perf_counter() - started
+                return None, str(e), timings
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(agent_ids)))) as executor:
+            futures = {executor.submit(ask, agent_id, time.perf_counter()): agent_id for agent_id in agent_ids}
+            for future in as_completed(futures):
+                agent_id = futures[future]
+                text, error, timings = future.result()
+                results[agent_id] = text
+                yield {"type": "result", "agent_id": agent_id, "name": self.get_agent_name(agent_id), "text": text,
+                       "error": error, "timings": timings, "elapsed_s": time.perf_counter() - poll_started}
+        yield {"type": "end", "elapsed_s": time.perf_counter() - poll_started, "results": results}
+
+    def poll_agents(self, agent_ids: list, question: str, max_concurrency: int = POLL_MAX_CONCURRENCY,
+                    use_cache: bool = True) -> dict:
+        """Concurrent fan-out of one question; returns {agent_id: reply} (None for agents that failed)."""
+        for event in self.poll_agents_stream(agent_ids, question, max_concurrency, use_cache):
+            if event["type"] == "end":
+                return event["results"]
+
+    def _embedding_model_name(self, agent_id: str) -> str:
+        with self._lock:
+            agent = self.agents.get(agent_id)
+        return agent.embedding_model_name if agent is not None else DEFAULT_EMBEDDING_MODEL_NAME
+
     def ask_multiple_agents_sequentially(self, agent_ids: list, question: str):
         responses = {}
-        print(f"\n=== Câu hỏi cho nhiều agent: '{question}' ===")
+        log_sampled(logger, logging.INFO, "Asking %d agents: %r", len(agent_ids), question)
         for agent_id in agent_ids:
             agent_response = self.ask_single_agent(agent_id, question)
             if agent_response: # Check if agent exists and responded
                  responses[agent_id] = agent_response
         return responses
 
-    def simulate_discussion(self, agent_ids: list, topic: str, max_turns_per_agent: int = 1):
+    def _build_discussion_question(self, participant: dict, participants: list, topic: str, discussion_memory: RollingSummary,
+                                   opening: bool = False, concurrent_opening: bool = False, previous_round: list = None) -> str:
+        current_agent_name = participant["name"]
+        # Những gì đã nói trước cửa sổ gần nhất chỉ còn trong bản tóm tắt
+        earlier_summary_str = (f"Tóm tắt những gì đã được thảo luận trước đó:\n{discussion_memory.summary}\n\n"
+                               if discussion_memory.summary else "")
+
+        # Identify other participants for the prompt
+        other_participant_names = [p_info["name"] for p_info in participants if p_info["id"] != participant["id"]]
+        if other_participant_names:
+            other_participants_str = ", ".join(other_participant_names)
+            participants_context_str = f"Bạn ({current_agent_name}) đang trong một cuộc thảo luận cùng với: {other_participants_str}."
+        else:
+            # This case should ideally not happen if len(participants) >= 2
+            participants_context_str = f"Bạn ({current_agent_name}) đang phát biểu (không có người tham gia nào khác được liệt kê)."
+
+        if concurrent_opening: # Everyone opens at the same time, nobody has spoken yet
+            return (
+                f"{participants_context_str}\n"
+                f"Chủ đề thảo luận là: '{topic}'.\n"
+                f"Tất cả người tham gia đang cùng lúc nêu quan điểm mở đầu. Xin mời bạn ({current_agent_name}) trình bày quan điểm mở đầu của mình."
+            )
+        if opening: # First turn for the first agent in the (potentially filtered) list
+            return (
+                f"{participants_context_str}\n"
+                f"Chủ đề thảo luận là: '{topic}'.\n"
+                f"Xin mời bạn ({current_agent_name}) bắt đầu cuộc thảo luận."
+            )
+
+        recent_statements = []
+        if previous_round is not None:
+            # Round-based mode: react to everything the others said in the previous round
+            recent_statements = [statement for speaker_id, statement in previous_round if speaker_id != participant["id"]]
+        else:
+            # Everything others said inside the memory's verbatim window (older statements are in the summary)
+            recent_statements = [statement for statement in discussion_memory.recent_entries()
+                                 if not statement.startswith(current_agent_name + ":")]
+
+        if recent_statements:
+            context_str = "\n".join(recent_statements)
+            return (
+                f"{participants_context_str}\n"
+                f"Chủ đề thảo luận là: '{topic}'.\n"
+                f"{earlier_summary_str}"
+                f"Đây là những ý kiến gần nhất từ những người khác trong cuộc thảo luận:\n{context_str}\n\n"
+                f"Dựa trên những ý kiến này, bạn ({current_agent_name}) hãy phân tích và đưa ra phản hồi của mình. "
+                f"Hãy trình bày rõ ràng."
+            )
+        # No recent statements from others, or it's this agent's first turn after the very first speaker
+        return (
+            f"{participants_context_str}\n"
+            f"Chủ đề thảo luận là: '{topic}'.\n"
+            f"{earlier_summary_str}"
+            f"Hiện tại chưa có ý kiến nào trước đó từ người khác (trong những lượt gần nhất) hoặc bạn là người tiếp theo sau lượt mở đầu.\n"
+            f"Bạn ({current_agent_name}), bạn có muốn bổ sung, làm rõ thêm điều gì, hoặc đưa ra ý kiến tiếp theo của mình không?"
+        )
+
+    def _plan_discussion_batches(self, participants: list, max_turns_per_agent: int, mode: str) -> list:
+        """Splits the discussion into (round, batch) pairs; speakers in the same batch answer concurrently.
+
+        Every participant speaks once per round, and rounds are numbered from 1 in all modes.
+        sequential:       one speaker per batch, round-robin (the original behaviour)
+        parallel_opening: everyone answers the opening prompt together, then round-robin
+        rounds:           every round is one batch reacting to the previous round's transcript
+        """
+        if mode == "sequential":
+            return [(round_number, [p]) for round_number in range(1, max_turns_per_agent + 1) for p in participants]
+        if mode == "parallel_opening":
+            return [(1, list(participants))] + [(round_number, [p]) for round_number in range(2, max_turns_per_agent + 1) for p in participants]
+        if mode == "rounds":
+            return [(round_number, list(participants)) for round_number in range(1, max_turns_per_agent + 1)]
+        raise ValueError(f"Unknown discussion mode '{mode}'. Expected one of {DISCUSSION_MODES}.")
+
+    def simulate_discussion(self, agent_ids: list, topic: str, max_turns_per_agent: int = 1,
+                            mode: str = "sequential", max_concurrency: int = 4, use_cache: bool = True):
+        """Runs a discussion and returns the joined log (see simulate_discussion_stream)."""
+        for event in self.simulate_discussion_stream(agent_ids, topic, max_turns_per_agent, mode, max_concurrency, use_cache):
+            if event["type"] == "error":
+                return event["message"]
+            if event["type"] == "end":
+                return event["log"]
+
+    def simulate_discussion_stream(self, agent_ids: list, topic: str, max_turns_per_agent: int = 1,
+                                   mode: str = "sequential", max_concurrency: int = 4, use_cache: bool = True):
+        """Runs a discussion, yielding events as it goes:
+
+        {"type": "start", "topic", "mode", "participants": [(agent_id, name), ...]}
+        {"type": "turn", "round", "agent_id", "name", "text", "statement"}  once per finished turn (round counts from 1)
+        {"type": "end", "log"}  or  {"type": "error", "message"}
+
+        mode is one of DISCUSSION_MODES; in the concurrent modes at most max_concurrency
+        LLM calls run at once and turns are yielded in the participants' order within each batch.
+        With use_cache=False every turn goes to the LLM even if an identical prompt was answered before.
+        """
         if len(agent_ids) < 2:
-            return "Cần ít nhất 2 agent để thảo luận."
+            yield {"type": "error", "message": "Cần ít nhất 2 agent để thảo luận."}
+            return
 
-        print(f"\n=== Bắt đầu thảo luận về: '{topic}' ===")
+        log_sampled(logger, logging.INFO, "Starting discussion on %r (mode: %s)", topic, mode)
         discussion_log = [f"Chủ đề: {topic}"]
         
-        # Initialize conversation histories for each agent ID provided
-        agent_conversation_histories = {agent_id: [] for agent_id in agent_ids}
-        
         # Gather all valid participating agents and their names
         active_participants_info = [] # Will store dicts: {"object": agent, "id": agent_id, "name": agent_name}
         for agent_id_in_discussion in agent_ids:
@@ -69,79 +492,60 @@ class AgentManager:
                     "name": agent_name
                 })
             else:
-                print(f"Cảnh báo: Agent với ID '{agent_id_in_discussion}' không tìm thấy và sẽ bị bỏ qua trong thảo luận.")
+                logger.warning("Agent %r not found; leaving it out of the discussion.", agent_id_in_discussion)
         
         if len(active_participants_info) < 2:
-            return "Cần ít nhất 2 agent hợp lệ để thảo luận sau khi lọc các agent không tồn tại."
-
-        for turn in range(max_turns_per_agent * len(active_participants_info)):
-            current_participant_data = active_participants_info[turn % len(active_participants_info)]
-            current_agent_object = current_participant_data["object"]
-            current_agent_id = current_participant_data["id"]
-            current_agent_name = current_participant_data["name"]
-
-            # Identify other participants for the prompt
-            other_participant_names = [
-                p_info["name"] for p_info in active_participants_info if p_info["id"] != current_agent_id
-            ]
-            
-            if other_participant_names:
-                other_participants_str = ", ".join(other_participant_names)
-                participants_context_str = f"Bạn ({current_agent_name}) đang trong một cuộc thảo luận cùng với: {other_participants_str}."
-            else:
-                # This case should ideally not happen if len(active_participants_info) >= 2
-                participants_context_str = f"Bạn ({current_agent_name}) đang phát biểu (không có người tham gia nào khác được liệt kê)." 
-
-            # Construct the prompt for the current agent
-            if turn == 0: # First turn for the first agent in the (potentially filtered) list
-                question_for_agent = (
-                    f"{participants_context_str}\n"
-                    f"Chủ đề thảo luận là: '{topic}'.\n"
-                    f"Xin mời bạn ({current_agent_name}) bắt đầu cuộc thảo luận."
-                )
-            else:
-                recent_statements = []
-                if len(discussion_log) > 1: 
-                    context_statements_count = 0
-                    # Iterate backwards from the last statement in the general discussion_log
-                    for i in range(len(discussion_log) - 1, 0, -1): 
-                        # Ensure the statement is not from the current agent
-                        if not discussion_log[i].startswith(current_agent_name + ":"):
-                             recent_statements.insert(0, discussion_log[i]) # Prepend to keep chronological order
-                             context_statements_count +=1
-                        if context_statements_count >= 2 : # Get up to 2 prior statements from OTHERS
-                            break
-                
-                if recent_statements:
-                    context_str = "\n".join(recent_statements)
-                    question_for_agent = (
-                        f"{participants_context_str}\n"
-                        f"Chủ đề thảo luận là: '{topic}'.\n"
-                        f"Đây là những ý kiến gần nhất từ những người khác trong cuộc thảo luận:\n{context_str}\n\n"
-                        f"Dựa trên những ý kiến này, bạn ({current_agent_name}) hãy phân tích và đưa ra phản hồi của mình. "
-                        f"Hãy trình bày rõ ràng."
-                    )
-                else: # No recent statements from others, or it's this agent's first turn after the very first speaker
-                    question_for_agent = (
-                        f"{participants_context_str}\n"
-                        f"Chủ đề thảo luận là: '{topic}'.\n"
-                        f"Hiện tại chưa có ý kiến nào trước đó từ người khác (trong những lượt gần nhất) hoặc bạn là người tiếp theo sau lượt mở đầu.\n"
-                        f"Bạn ({current_agent_name}), bạn có muốn bổ sung, làm rõ thêm điều gì, hoặc đưa ra ý kiến tiếp theo của mình không?"
+            yield {"type": "error", "message": "Cần ít nhất 2 agent hợp lệ để thảo luận sau khi lọc các agent không tồn tại."}
+            return
+        # Mỗi agent nhớ các lượt của mình (gần nhất nguyên văn, cũ hơn được tóm tắt); cả cuộc thảo luận cũng vậy
+        # (the questions already quote the others, so each agent keeps fewer of its own turns verbatim)
+        agent_memories = {p_info["id"]: p_info["object"].new_conversation_memory(recent=2) for p_info in active_participants_info}
+        discussion_memory = RollingSummary(active_participants_info[0]["object"].summarizer,
+                                           recent=max(len(active_participants_info), 2))
+        yield {"type": "start", "topic": topic, "mode": mode,
+               "participants": [(p_info["id"], p_info["name"]) for p_info in active_participants_info]}
+
+        batches = self._plan_discussion_batches(active_participants_info, max_turns_per_agent, mode)
+        previous_round = None
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(active_participants_info)))) as executor:
+            for batch_index, (round_number, batch) in enumerate(batches):
+                # Prompts are built from the log as it stood before the batch, so concurrent speakers see the same transcript
+                turn_requests = []
+                for participant in batch:
+                    question_for_agent = self._build_discussion_question(
+                        participant, active_participants_info, topic, discussion_memory,
+                        opening=(batch_index == 0 and len(batch) == 1),
+                        concurrent_opening=(batch_index == 0 and len(batch) > 1),
+                        previous_round=previous_round if mode == "rounds" else None
                     )
+                    # Use the agent's own conversation history for context specific to it
+                    history_for_agent = agent_memories[participant["id"]].history()
+                    turn_requests.append((participant, question_for_agent, history_for_agent))
+
+                if len(turn_requests) == 1:
+                    participant, question_for_agent, history_for_agent = turn_requests[0]
+                    pending_responses = [participant["object"].think_and_respond(question_for_agent, history_for_agent, use_cache=use_cache)]
+                else:
+                    futures = [
+                        executor.submit(participant["object"].think_and_respond, question_for_agent, history_for_agent, use_cache=use_cache)
+                        for participant, question_for_agent, history_for_agent in turn_requests
+                    ]
+                    # Waiting on the futures in submission order keeps the log deterministic
+                    pending_responses = (future.result() for future in futures)
+
+                previous_round = []
+                for (participant, question_for_agent, _), response_text in zip(turn_requests, pending_responses):
+                    # Update logs
+                    full_statement = f"{participant['name']}: {response_text}"
+                    discussion_log.append(full_statement)
+                    discussion_memory.add(full_statement)
+                    previous_round.append((participant["id"], full_statement))
+
+                    # Update this agent's specific history for next time it speaks
+                    agent_memories[participant["id"]].add_turn(question_for_agent, response_text)
+
+                    yield {"type": "turn", "round": round_number, "agent_id": participant["id"], "name": participant["name"],
+                           "text": response_text, "statement": full_statement}
 
-            # Use the agent's own conversation history for context specific to it
-            history_for_current_agent = agent_conversation_histories[current_agent_id]
-            
-            response_text = current_agent_object.think_and_respond(question_for_agent, history_for_current_agent)
-            
-            # Update logs
-            full_statement = f"{current_agent_name}: {response_text}"
-            discussion_log.append(full_statement)
-            
-            # Update this agent's specific history for next time it speaks
-            agent_conversation_histories[current_agent_id].append((question_for_agent, response_text))
-            if len(agent_conversation_histories[current_agent_id]) > 3: # Keep history short (e.g., last 3 exchanges)
-                agent_conversation_histories[current_agent_id].pop(0)
-
-        print("\n=== Kết thúc thảo luận ===")
-        return "\n".join(discussion_log)
\ No newline at end of file
+        log_sampled(logger, logging.INFO, "Discussion on %r finished.", topic)
+        yield {"type": "end", "log": "\n".join(discussion_log)}
@@ -0,0 +1,271 @@
+import os
+import json
+import datetime
+import threading
+from core.fetch_state import article_key
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+
+class ArticleStore:
+    """Append-only store of raw articles: one JSONL segment per agent per day.
+
+    Layout under base_dir:
+        <agent_id>/segments/<YYYY-MM-DD>.jsonl  one record per line, each with a monotonically increasing "seq"
+        <agent_id>/meta.json                    next_seq, and the seq range and size of every segment
+        <agent_id>/keys.txt                     append-only primary key index
+
+    Records are keyed by article_key (sha1 of the URL); appending an article whose key
+    is already stored is a no-op. Readers stream records after a given seq, skipping
+    whole segments that only hold older records.
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._meta = {}
+        self._keys = {}
+
+    def _lock_for(self, agent_id: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(agent_id, threading.Lock())
+
+    def _agent_dir(self, agent_id: str) -> str:
+        return os.path.join(self.base_dir, agent_id)
+
+    def _segments_dir(self, agent_id: str) -> str:
+        return os.path.join(self._agent_dir(agent_id), "segments")
+
+    def agent_ids(self) -> list:
+        return sorted(name for name in os.listdir(self.base_dir) if os.path.isdir(os.path.join(self.base_dir, name)))
+
+    # --- Metadata / key index ---
+    def _load(self, agent_id: str):
+        """Loads meta and the key index for agent_id, rescanning any segment that meta does not account for."""
+        if agent_id in self._meta:
+            return
+        meta_path = os.path.join(self._agent_dir(agent_id), "meta.json")
+        meta = {"next_seq": 1, "segments": {}}
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except Exception as e:
+                logger.error("Error reading article store meta for %s: %s. Rebuilding from segments.", agent_id, e)
+                meta = {"next_seq": 1, "segments": {}}
+        keys = set()
+        keys_path = os.path.join(self._agent_dir(agent_id), "keys.txt")
+        if os.path.exists(keys_path):
+            with open(keys_path, 'r', encoding='utf-8') as f:
+                keys.update(line.strip() for line in f if line.strip())
+
+        # A crash between the segment write and the meta write (or a partial write) leaves meta behind; the segments are the truth
+        segments_dir = self._segments_dir(agent_id)
+        recovered_keys = []
+        if os.path.isdir(segments_dir):
+            for segment_name in sorted(os.listdir(segments_dir)):
+                segment_path = os.path.join(segments_dir, segment_name)
+                if not segment_name.endswith(".jsonl"):
+                    continue
+                if meta["segments"].get(segment_name, {}).get("bytes") == os.path.getsize(segment_path):
+                    continue
+                self._trim_torn_tail(segment_path)
+                segment = None
+                for record in self._read_segment(segment_path):
+                    if record["key"] not in keys:
+                        keys.add(record["key"])
+                        recovered_keys.append(record["key"])
+                    if segment is None:
+                        segment = {"first_seq": record["seq"], "last_seq": record["seq"]}
+                    segment["last_seq"] = record["seq"]
+                    meta["next_seq"] = max(meta["next_seq"], record["seq"] + 1)
+                if segment is not None:
+                    segment["bytes"] = os.path.getsize(segment_path)
+                    meta["segments"][segment_name] = segment
+        self._meta[agent_id] = meta
+        self._keys[agent_id] = keys
+        if recovered_keys:
+            logger.warning("Article store for %s: recovered %d records missing from meta.", agent_id, len(recovered_keys))
+            self._append_keys(agent_id, recovered_keys)
+            self._save_meta(agent_id)
+
+    def _append_keys(self, agent_id: str, keys: list):
+        with open(os.path.join(self._agent_dir(agent_id), "keys.txt"), 'a', encoding='utf-8') as f:
+            f.write("".join(key + "\n" for key in keys))
+
+    def _save_meta(self, agent_id: str):
+        meta_path = os.path.join(self._agent_dir(agent_id), "meta.json")
+        tmp_path = meta_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._meta[agent_id], f)
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def _trim_torn_tail(segment_path: str):
+        """Drops a last line left without its newline by an interrupted write, so the next append starts on a fresh line."""
+        with open(segment_path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                f.seek(max(0, end - 4096))
+                block = f.read(end - max(0, end - 4096))
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    end = max(0, end - 4096) + newline + 1
+                    break
+                end = max(0, end - 4096)
+            if end < size:
+                f.truncate(end)
+
+    @staticmethod
+    def _read_segment(segment_path: str):
+        with open(segment_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line after a crash
+                    continue
+
+    # --- Writes ---
+    def append_many(self, agent_id: str, articles: list, day: str = None) -> list:
+        """Appends articles not already stored for agent_id. Returns the records actually written."""
+        if not articles:
+            return []
+        day = day or datetime.date.today().strftime("%Y-%m-%d")
+        with self._lock_for(agent_id):
+            self._load(agent_id)
+            meta, keys = self._meta[agent_id], self._keys[agent_id]
+            records, batch_keys = [], set()
+            for article in articles:
+                key = article_key(article)
+                if key in keys or key in batch_keys:
+                    continue
+                batch_keys.add(key)
+                records.append(dict(article, key=key, seq=meta["next_seq"] + len(records)))
+            if not records:
+                return []
+
+            os.makedirs(self._segments_dir(agent_id), exist_ok=True)
+            segment_name = f"{day}.jsonl"
+            segment_path = os.path.join(self._segments_dir(agent_id), segment_name)
+            offset = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            try:
+                with open(segment_path, 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            except Exception:
+                self._undo_partial_append(agent_id, segment_path, offset)
+                raise
+            # Only claim keys and seqs once the records are on disk, so a failed write can be retried
+            keys.update(batch_keys)
+            meta["next_seq"] += len(records)
+            self._append_keys(agent_id, [record["key"] for record in records])
+            segment = meta["segments"].setdefault(segment_name, {"first_seq": records[0]["seq"], "last_seq": records[0]["seq"]})
+            segment["last_seq"] = records[-1]["seq"]
+            segment["bytes"] = os.path.getsize(segment_path)
+            self._save_meta(agent_id)
+            return records
+
+    def _undo_partial_append(self, agent_id: str, segment_path: str, offset: int):
+        """Cuts a failed append back to offset; if that fails too, the next _load recovers what did reach the segment."""
+        try:
+            os.truncate(segment_path, offset)
+        except OSError as e:
+            logger.error("Error rolling back a partial append to %s: %s. Recovering from the segment on next access.", segment_path, e)
+        # Forget the cached meta and keys so they are re-derived from the segments, never reusing a seq already on disk
+        self._meta.pop(agent_id, None)
+        self._keys.pop(agent_id, None)
+
+    def contains(self, agent_id: str, article: dict) -> bool:
+        with self._lock_for(agent_id):
+            self._load(agent_id)
+            return article_key(article) in self._keys[agent_id]
+
+    # --- Reads ---
+    def last_seq(self, agent_id: str) -> int:
+        with self._lock_for(agent_id):
+            self._load(agent_id)
+            return self._meta[agent_id]["next_seq"] - 1
+
+    def iter_records(self, agent_id: str, after_seq: int = 0):
+        """Yields agent_id's records with seq > after_seq, oldest first."""
+        with self._lock_for(agent_id):
+            self._load(agent_id)
+            segments = sorted(self._meta[agent_id]["segments"].items(), key=lambda item: item[1]["first_seq"])
+            upper_seq = self._meta[agent_id]["next_seq"] - 1
+        for segment_name, segment in segments:
+            if segment["last_seq"] <= after_seq:
+                continue
+            for record in self._read_segment(os.path.join(self._segments_dir(agent_id), segment_name)):
+                # Records appended while we were reading get picked up by the next run
+                if after_seq < record["seq"] <= upper_seq:
+                    yield record
+
+
+def format_article_text(record: dict) -> str:
+    """Text that gets chunked and embedded for one article (same layout as the legacy .txt files)."""
+    fetch_date = record.get('fetch_date') or datetime.date.today().strftime("%Y-%m-%d")
+    return (f"Title: {record.get('title', '')}\nSource: {record.get('source', '')}\nLink: {record.get('link', '')}\n"
+            f"Published At: {record.get('published_at') or 'N/A'}\nFetch Date: {fetch_date}\n\n"
+            f"{record.get('content', '')}\n\n--- FETCHED VIA NEWSAPI ON {fetch_date} ---")
+
+
+def _parse_legacy_article_file(file_path: str) -> dict | None:
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    header, _, body = content.partition("\n\n")
+    fields = {}
+    for line in header.splitlines():
+        name, sep, value = line.partition(": ")
+        if sep:
+            fields[name.strip()] = value.strip()
+    if "Title" not in fields:
+        return None
+    body = body.rsplit("\n\n--- FETCHED VIA NEWSAPI ON", 1)[0]
+    published_at = fields.get("Published At")
+    return {
+        "title": fields.get("Title", ""),
+        "source": fields.get("Source", ""),
+        "link": fields.get("Link") or None,
+        "published_at": None if published_at in (None, "", "N/A", "None") else published_at,
+        "fetch_date": fields.get("Fetch Date"),
+        "content": body.strip(),
+    }
+
+
+def migrate_raw_news_tree(raw_data_dir_base: str, store: ArticleStore) -> int:
+    """One-time import of the legacy data_sources/raw_news/<agent_id>/*.txt files into the store.
+
+    Writes a marker file into raw_data_dir_base once done, so later calls return immediately.
+    """
+    marker_path = os.path.join(raw_data_dir_base, ".migrated_to_article_store")
+    if not os.path.isdir(raw_data_dir_base) or os.path.exists(marker_path):
+        return 0
+    migrated = 0
+    for agent_id in sorted(os.listdir(raw_data_dir_base)):
+        agent_dir = os.path.join(raw_data_dir_base, agent_id)
+        if not os.path.isdir(agent_dir):
+            continue
+        records_by_day = {}
+        for file_name in sorted(os.listdir(agent_dir)):
+            if not file_name.endswith(".txt"):
+                continue
+            try:
+                record = _parse_legacy_article_file(os.path.join(agent_dir, file_name))
+            except Exception as e:
+                logger.error("Error migrating %s for %s: %s", file_name, agent_id, e)
+                continue
+            if record:
+                records_by_day.setdefault(record.get("fetch_date") or file_name[:10], []).append(record)
+        for day in sorted(records_by_day):
+            migrated += len(store.append_many(agent_id, records_by_day[day], day=day))
+    with open(marker_path, 'w', encoding='utf-8') as f:
+        f.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    logger.info("Migrated %d legacy raw news files from %s into the article store.", migrated, raw_data_dir_base)
+    return migrated
@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import threading
+import tiktoken
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from core.utils import get_token_encoding
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# ~500 characters of English, the size the agents used to split at, with ~100 characters of overlap
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "128"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "24"))
+# A break after ., ! or ? (plus closing quotes/brackets) followed by whitespace, or a run of newlines
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])[\"')\]]*\s+|\n+")
+
+
+def _sentences(text: str) -> list:
+    """text cut into contiguous sentences, each keeping its trailing whitespace ("".join gives text back)."""
+    sentences, start = [], 0
+    for match in _SENTENCE_BREAK.finditer(text):
+        if match.end() > start:
+            sentences.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        sentences.append(text[start:])
+    return sentences
+
+
+class TokenChunker:
+    """Splits text into chunks of at most chunk_tokens tokens that end on sentence boundaries.
+
+    The text is encoded once (sentence by sentence, in one batch call) and chunks are cut
+    on the resulting token counts. Consecutive chunks share up to overlap_tokens tokens of
+    whole sentences; a sentence longer than chunk_tokens is cut on token offsets.
+    """
+
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 encoding_name: str = "cl100k_base"):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) must be smaller than chunk_tokens ({chunk_tokens}).")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding_name = encoding_name
+
+    def _units(self, text: str) -> list:
+        """(text, token count) pieces of text, none longer than chunk_tokens."""
+        encoding = get_token_encoding(self.encoding_name)
+        sentences = _sentences(text)
+        units = []
+        for sentence, tokens in zip(sentences, encoding.encode_ordinary_batch(sentences)):
+            if len(tokens) <= self.chunk_tokens:
+                units.append((sentence, len(tokens)))
+                continue
+            for start in range(0, len(tokens), self.chunk_tokens):
+                window = tokens[start:start + self.chunk_tokens]
+                units.append((encoding.decode(window), len(window)))
+        return units
+
+    def split_text(self, text: str) -> list:
+        chunks = []
+        window, window_tokens = [], 0
+        for unit in self._units(text):
+            if window and window_tokens + unit[1] > self.chunk_tokens:
+                chunks.append("".join(piece for piece, _ in window).strip())
+                # Carry the last sentences (up to overlap_tokens) into the next chunk
+                kept, kept_tokens = [], 0
+                for piece, tokens in reversed(window):
+                    if kept_tokens + tokens > self.overlap_tokens or kept_tokens + tokens + unit[1] > self.chunk_tokens:
+                        break
+                    kept.insert(0, (piece, tokens))
+                    kept_tokens += tokens
+                window, window_tokens = kept, kept_tokens
+            window.append(unit)
+            window_tokens += unit[1]
+        if window:
+            chunks.append("".join(piece for piece, _ in window).strip())
+        return [chunk for chunk in chunks if chunk]
+
+
+_chunkers = {}
+_chunkers_lock = threading.Lock()
+
+
+def get_shared_chunker(chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                       encoding_name: str = "cl100k_base") -> TokenChunker:
+    """Process-wide chunker for these settings, shared by every agent."""
+    key = (chunk_tokens, overlap_tokens, encoding_name)
+    with _chunkers_lock:
+        if key not in _chunkers:
+            _chunkers[key] = TokenChunker(chunk_tokens, overlap_tokens, encoding_name)
+        return _chunkers[key]
+
+
+def _legacy_num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
+    """The original core.utils.num_tokens_from_string: looks the encoding up with tiktoken.get_encoding on every call."""
+    encoding = tiktoken.get_encoding(encoding_name)
+    return len(encoding.encode(string))
+
+
+def _legacy_split_text_into_chunks(text: str, max_tokens_per_chunk: int = 400, overlap: int = 50):
+    """The per-word implementation core.utils.split_text_into_chunks used to have, kept as the benchmark baseline."""
+    words = text.split()
+    chunks = []
+    current_chunk_words = []
+    current_tokens = 0
+    for word in words:
+        word_tokens = _legacy_num_tokens_from_string(word + " ")
+        if current_tokens + word_tokens <= max_tokens_per_chunk:
+            current_chunk_words.append(word)
+            current_tokens += word_tokens
+        else:
+            chunks.append(" ".join(current_chunk_words))
+            overlap_words = current_chunk_words[-int(len(current_chunk_words) * (overlap / max_tokens_per_chunk)):] if overlap > 0 else []
+            current_chunk_words = overlap_words + [word]
+            current_tokens = _legacy_num_tokens_from_string(" ".join(current_chunk_words) + " ")
+    if current_chunk_words:
+        chunks.append(" ".join(current_chunk_words))
+    return chunks
+
+
+def benchmark_chunkers(texts: list, repeat: int = 3) -> list:
+    """Throughput (MB/s of input text) of the shared token chunker against the splitters it replaced.
+
+    Each implementation chunks all texts `repeat` times; the best run is reported.
+    """
+    character_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100, length_function=len)
+    token_chunker = get_shared_chunker()
+    candidates = [
+        ("token_chunker", token_chunker.split_text),
+        ("recursive_character_500_100", character_splitter.split_text),
+    ]
+    try:
+        # The legacy splitter needs the real tiktoken encoding; load it outside the timed runs
+        tiktoken.get_encoding(token_chunker.encoding_name)
+        candidates.append(("legacy_per_word_tokens", lambda text: _legacy_split_text_into_chunks(
+            text, token_chunker.chunk_tokens, token_chunker.overlap_tokens)))
+    except Exception as e:
+        logger.warning("Skipping the legacy per-word splitter: tiktoken encoding %s unavailable (%s).", token_chunker.encoding_name, e)
+    megabytes = sum(len(text.encode('utf-8')) for text in texts) / (1024 * 1024)
+    get_token_encoding(token_chunker.encoding_name)  # load the encoding outside the timed runs
+    report = []
+    for name, split in candidates:
+        best, chunk_count = None, 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            chunk_count = sum(len(split(text)) for text in texts)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        report.append({"splitter": name, "chunks": chunk_count, "seconds": best,
+                       "mb_per_s": megabytes / best if best else float("inf")})
+    return report
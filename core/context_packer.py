@@ -0,0 +1,128 @@
+import os
+from core.utils import num_tokens_from_string, truncate_to_tokens
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Token budget for one LLM call (system prompt + instructions + RAG + history), counted with cl100k_base;
+# Gemini's own tokenizer differs a little, so keep some headroom below the model's real limit
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+# The persona system prompt is cut beyond this share of the budget
+SYSTEM_PROMPT_MAX_SHARE = float(os.getenv("CONTEXT_SYSTEM_PROMPT_MAX_SHARE", "0.3"))
+# ...but never below this many tokens (or the whole prompt, if shorter), even when the instructions are long
+SYSTEM_PROMPT_MIN_TOKENS = int(os.getenv("CONTEXT_SYSTEM_PROMPT_MIN_TOKENS", "64"))
+# Share of what is left (after the system prompt and the instructions) reserved for RAG; history gets the rest
+RAG_SHARE = float(os.getenv("CONTEXT_RAG_SHARE", "0.6"))
+# A chunk is only truncated if at least this many tokens of it would be kept; otherwise it is dropped
+MIN_PARTIAL_TOKENS = 48
+# Framing put around the packed chunks in the prompt (see format_rag_context); counted with the instructions
+RAG_HEADER = "\n\n---\nRelevant Information:\n"
+RAG_SEPARATOR = "\n\n"
+RAG_FOOTER = "\n---"
+
+
+def format_rag_context(chunks: list) -> str:
+    return RAG_HEADER + RAG_SEPARATOR.join(chunks) + RAG_FOOTER
+
+
+class PackedContext:
+    """What fits in the budget: the (possibly truncated) system prompt, RAG chunks and history turns, plus token counts."""
+
+    def __init__(self, system_prompt: str, chunks: list, history: list, tokens: dict, dropped: dict, budget: int):
+        self.system_prompt = system_prompt
+        self.chunks = chunks
+        self.history = history
+        self.tokens = tokens    # section -> tokens used
+        self.dropped = dropped  # section -> pieces dropped entirely
+        self.budget = budget
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.tokens.values())
+
+    def summary(self) -> str:
+        return (f"system {self.tokens['system']} + instructions {self.tokens['instructions']} + "
+                f"RAG {self.tokens['rag']} ({len(self.chunks)} chunks, {self.dropped['rag']} dropped) + "
+                f"history {self.tokens['history']} ({len(self.history)} turns, {self.dropped['history']} dropped) = "
+                f"{self.total_tokens}/{self.budget} tokens")
+
+
+def _fit(text: str, available: int) -> tuple:
+    """(text, tokens), with text cut down to available tokens if needed; (None, 0) if too little of it would remain."""
+    tokens = num_tokens_from_string(text)
+    if tokens <= available:
+        return text, tokens
+    if available < MIN_PARTIAL_TOKENS:
+        return None, 0
+    truncated = truncate_to_tokens(text, available)
+    return truncated, num_tokens_from_string(truncated)
+
+
+def _fill_chunks(chunks: list, available: int, packed: list) -> int:
+    """Appends chunks (most relevant first) to packed while they fit; the first one that does not fit is truncated.
+
+    Every chunk after the first also pays for the separator in front of it. Returns tokens used.
+    """
+    used = 0
+    separator_tokens = num_tokens_from_string(RAG_SEPARATOR)
+    for chunk in chunks:
+        overhead = separator_tokens if packed else 0
+        text, tokens = _fit(chunk, available - used - overhead)
+        if text is None:
+            break
+        packed.append(text)
+        used += tokens + overhead
+        if text is not chunk:
+            break
+    return used
+
+
+def pack_context(system_prompt: str, instructions: str, chunks: list, history: list = None,
+                 budget: int = None, rag_share: float = RAG_SHARE) -> PackedContext:
+    """Fits one turn's prompt pieces into budget tokens.
+
+    instructions (the turn's instructions and question) are always kept whole, and counted together
+    with the RAG framing of format_rag_context. The system prompt is capped at SYSTEM_PROMPT_MAX_SHARE
+    of the budget but keeps at least SYSTEM_PROMPT_MIN_TOKENS, so the budget can only be exceeded when
+    the instructions alone leave less than that. What remains is split between RAG chunks,
+    taken in the given order (most relevant first), and history (user, ai) turns, newest first;
+    whichever section needs less than its share leaves the rest to the other. Chunks that do not
+    fit are dropped, except that the last one to be added may be truncated; history turns are
+    only kept whole.
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    history = history or []
+    instructions_tokens = num_tokens_from_string(instructions) + num_tokens_from_string(RAG_HEADER + RAG_FOOTER)
+
+    system_tokens = num_tokens_from_string(system_prompt)
+    system_floor = min(SYSTEM_PROMPT_MIN_TOKENS, system_tokens)
+    system_cap = max(system_floor, min(int(budget * SYSTEM_PROMPT_MAX_SHARE), budget - instructions_tokens))
+    if instructions_tokens + system_floor > budget:
+        logger.warning("Instructions (%d tokens) leave no room in the %d-token budget; the prompt will exceed it.",
+                       instructions_tokens, budget)
+    if system_tokens > system_cap:
+        system_prompt = truncate_to_tokens(system_prompt, system_cap)
+        logger.warning("System prompt truncated from %d to %d tokens to fit the %d-token budget.",
+                       system_tokens, system_cap, budget)
+        system_tokens = num_tokens_from_string(system_prompt)
+
+    remaining = max(0, budget - instructions_tokens - system_tokens)
+    turn_tokens = [num_tokens_from_string(user_msg) + num_tokens_from_string(ai_msg) for user_msg, ai_msg in history]
+    # RAG gets its share, plus whatever part of the history's share the history does not need
+    packed_chunks = []
+    rag_tokens = _fill_chunks(chunks, max(int(remaining * rag_share), remaining - sum(turn_tokens)), packed_chunks)
+
+    packed_history = []
+    history_tokens = 0
+    for (user_msg, ai_msg), tokens in zip(reversed(history), reversed(turn_tokens)):
+        if history_tokens + tokens > remaining - rag_tokens:
+            break
+        packed_history.insert(0, (user_msg, ai_msg))
+        history_tokens += tokens
+
+    return PackedContext(
+        system_prompt, packed_chunks, packed_history,
+        tokens={"system": system_tokens, "instructions": instructions_tokens, "rag": rag_tokens, "history": history_tokens},
+        dropped={"rag": len(chunks) - len(packed_chunks), "history": len(history) - len(packed_history)},
+        budget=budget,
+    )
@@ -0,0 +1,177 @@
+import os
+import threading
+from core.utils import num_tokens_from_string, truncate_to_tokens
+from core.response_cache import prompt_fingerprint
+from core.response_parser import strip_thoughts
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Turns (or discussion statements) kept verbatim; older ones are folded into the rolling summary
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "4"))
+# Refresh frequency: the summary is updated once this many turns have aged out of the recent window
+MEMORY_SUMMARY_EVERY = int(os.getenv("MEMORY_SUMMARY_EVERY", "2"))
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "300"))
+# Stand-in user message of the history turn that carries the summary
+SUMMARY_TURN_PROMPT = "(Tóm tắt phần trước của cuộc trò chuyện)"
+# Each turn is cut to this many tokens when the summary has to be built without the LLM
+_FALLBACK_TOKENS_PER_LINE = 40
+
+
+def extractive_summary(previous_summary: str, lines: list, max_tokens: int) -> str:
+    """LLM-free fallback: the previous summary plus the start of each new line, keeping the newest max_tokens tokens."""
+    parts = [previous_summary] if previous_summary else []
+    parts += [truncate_to_tokens(" ".join(line.split()), _FALLBACK_TOKENS_PER_LINE) for line in lines]
+    return truncate_to_tokens("\n".join(parts), max_tokens, keep_end=True)
+
+
+class LLMSummarizer:
+    """Folds new lines into a running summary with one LLM call through the dispatcher.
+
+    The update is incremental (previous summary + only the lines that aged out), and replies are
+    kept in the response cache, so replaying the same conversation costs no LLM calls. If the
+    call fails the extractive fallback is used, so memory never blocks a conversation.
+    """
+
+    def __init__(self, backend, dispatcher, cache=None, language: str = "tiếng Việt"):
+        self.backend = backend
+        self.dispatcher = dispatcher
+        self.cache = cache
+        self.language = language
+        self.stats = {"calls": 0, "cache_hits": 0, "fallbacks": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _prompt(self, previous_summary: str, lines: list, max_tokens: int) -> str:
+        return (
+            f"Bạn đang duy trì bản tóm tắt của một cuộc trò chuyện dài.\n"
+            f"Bản tóm tắt hiện tại:\n{previous_summary or '(chưa có)'}\n\n"
+            f"Các lượt mới cần được gộp vào:\n" + "\n".join(lines) + "\n\n"
+            f"Hãy viết lại bản tóm tắt bằng {self.language}, tối đa khoảng {int(max_tokens * 0.6)} từ, "
+            f"giữ lại các sự kiện, quan điểm, cam kết và câu hỏi còn bỏ ngỏ của từng bên. "
+            f"Chỉ trả về bản tóm tắt, không có suy nghĩ hay lời dẫn."
+        )
+
+    def __call__(self, previous_summary: str, lines: list, max_tokens: int) -> str:
+        prompt = self._prompt(previous_summary, lines, max_tokens)
+        cache_key = prompt_fingerprint(self.backend.cache_model_name, self.backend.generation_config,
+                                       "conversation_summary", prompt) if self.cache else None
+        cached = self.cache.get(cache_key) if self.cache else None
+        if cached is not None:
+            self._count("cache_hits")
+            return cached
+        try:
+            self._count("calls")
+            summary = strip_thoughts(self.dispatcher.generate(self.backend, prompt))
+            if not summary:
+                raise ValueError("empty summary")
+        except Exception as e:
+            logger.warning("Could not update conversation summary with %s: %s. Using an extractive summary.", self.backend.name, e)
+            self._count("fallbacks")
+            return extractive_summary(previous_summary, lines, max_tokens)
+        summary = truncate_to_tokens(summary, max_tokens)
+        if self.cache:
+            self.cache.put(cache_key, summary, self.backend.cache_model_name)
+        return summary
+
+
+class RollingSummary:
+    """Recent entries kept verbatim plus a rolling summary of everything older.
+
+    Once summary_every entries have aged out of the recent window they are folded into the summary
+    with a single summarizer(previous_summary, lines, max_tokens) call, so the summarizer runs
+    once every summary_every entries and, outside a running summary update, the verbatim part never
+    exceeds recent + summary_every - 1 entries. With the summary capped at summary_max_tokens, what this
+    adds to a prompt stays bounded however long the conversation gets.
+
+    add never waits for the summarizer: it runs on a background thread, readers keep seeing the
+    folded entries verbatim (next to the previous summary) until the new summary is swapped in,
+    and adds arriving meanwhile are folded on a later add. wait_idle() waits for a running update.
+    """
+
+    def __init__(self, summarizer, recent: int = MEMORY_RECENT_TURNS, summary_every: int = MEMORY_SUMMARY_EVERY,
+                 summary_max_tokens: int = MEMORY_SUMMARY_MAX_TOKENS):
+        self.summarizer = summarizer
+        self.recent = max(0, recent)
+        self.summary_every = max(1, summary_every)
+        self.summary_max_tokens = summary_max_tokens
+        self.entries = []
+        self.summary = ""
+        self.entries_summarized = 0
+        self._summarizing = False
+        self._generation = 0  # bumped by clear(), so a summary started before it is dropped
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def _format(self, entry) -> str:
+        return str(entry)
+
+    def add(self, entry):
+        with self._lock:
+            self.entries.append(entry)
+            aged = len(self.entries) - self.recent
+            if aged < self.summary_every or self._summarizing:
+                return
+            self._summarizing = True
+            to_fold, previous_summary, generation = self.entries[:aged], self.summary, self._generation
+        threading.Thread(target=self._fold, args=(to_fold, previous_summary, generation),
+                         name="rolling-summary", daemon=True).start()
+
+    def _fold(self, to_fold: list, previous_summary: str, generation: int):
+        summary = None
+        try:
+            summary = self.summarizer(previous_summary, [self._format(entry) for entry in to_fold], self.summary_max_tokens)
+        except Exception as e:
+            logger.error("Conversation summary update failed: %s. Keeping the turns verbatim for now.", e)
+        finally:
+            with self._lock:
+                self._summarizing = False
+                if summary is not None and generation == self._generation:
+                    self.summary = summary
+                    self.entries = self.entries[len(to_fold):]
+                    self.entries_summarized += len(to_fold)
+                self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Waits for a running summary update to be swapped in; False if it is still running after timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._summarizing, timeout)
+
+    def recent_entries(self) -> list:
+        with self._lock:
+            return list(self.entries)
+
+    def clear(self):
+        with self._lock:
+            self.entries, self.summary, self.entries_summarized = [], "", 0
+            self._generation += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"verbatim": len(self.entries), "summarized": self.entries_summarized,
+                    "summary_tokens": num_tokens_from_string(self.summary) if self.summary else 0}
+
+
+class ConversationMemory(RollingSummary):
+    """RollingSummary of (user_msg, ai_msg) turns; history() is what to pass as conversation_history."""
+
+    def __init__(self, summarizer, recent: int = MEMORY_RECENT_TURNS, summary_every: int = MEMORY_SUMMARY_EVERY,
+                 summary_max_tokens: int = MEMORY_SUMMARY_MAX_TOKENS, labels: tuple = ("Người dùng", "Trợ lý")):
+        super().__init__(summarizer, recent, summary_every, summary_max_tokens)
+        self.labels = labels
+
+    def _format(self, entry) -> str:
+        user_msg, ai_msg = entry
+        return f"{self.labels[0]}: {user_msg}\n{self.labels[1]}: {ai_msg}"
+
+    def add_turn(self, user_msg: str, ai_msg: str):
+        self.add((user_msg, ai_msg))
+
+    def history(self) -> list:
+        """The summary (as one leading turn, if there is one) followed by the recent turns verbatim."""
+        with self._lock:
+            summary_turn = [(SUMMARY_TURN_PROMPT, self.summary)] if self.summary else []
+            return summary_turn + list(self.entries)
@@ -1,19 +1,54 @@
-import requests
-from bs4 import BeautifulSoup
 import os
 import datetime
-from core.utils import clean_text 
 import time
-from newsapi import NewsApiClient
+from core.news_fetcher import NewsFetchEngine
+from core.fetch_state import FetchStateStore
+from core.article_store import ArticleStore, format_article_text, migrate_raw_news_tree
+from core.near_dedup import word_count, NEAR_DUP_MIN_WORDS
+from core.update_worker import UpdateJob, UpdateCancelled
+from core.metrics import get_logger
 from dotenv import load_dotenv
 import asyncio
 
 # Load API key from .env
 load_dotenv()
+logger = get_logger(__name__)
 NEWS_API_KEY = os.getenv("NEWS_API_KEY")
 
 if not NEWS_API_KEY:
-    print("Warning: NEWS_API_KEY not found. NewsAPI functionality will be limited.")
+    logger.warning("NEWS_API_KEY not found. NewsAPI functionality will be limited.")
+
+# Giới hạn tốc độ gọi NewsAPI (token bucket) và số request chạy song song
+NEWSAPI_RATE_LIMIT_PER_SEC = float(os.getenv("NEWSAPI_RATE_LIMIT_PER_SEC", "5"))
+NEWSAPI_MAX_CONCURRENCY = int(os.getenv("NEWSAPI_MAX_CONCURRENCY", "8"))
+# Mốc thời gian cho lần fetch đầu tiên của một truy vấn (chưa có watermark)
+NEWSAPI_DEFAULT_FROM = os.getenv("NEWSAPI_DEFAULT_FROM", "2025-01-01")
+
+_news_fetch_engine = None
+
+def get_news_fetch_engine() -> NewsFetchEngine:
+    """Process-wide fetch engine, so every update run reuses the same pooled HTTP session."""
+    global _news_fetch_engine
+    if _news_fetch_engine is None:
+        _news_fetch_engine = NewsFetchEngine(
+            api_key=NEWS_API_KEY,
+            rate_per_sec=NEWSAPI_RATE_LIMIT_PER_SEC,
+            max_concurrency=NEWSAPI_MAX_CONCURRENCY
+        )
+    return _news_fetch_engine
+
+def get_fetch_state_dir(raw_data_dir_base: str) -> str:
+    """Watermarks and seen URLs live next to the raw news tree (e.g. data_sources/fetch_state)."""
+    return os.path.join(os.path.dirname(os.path.normpath(raw_data_dir_base)), "fetch_state")
+
+_article_stores = {}
+
+def get_article_store(raw_data_dir_base: str) -> ArticleStore:
+    """Article store next to the legacy raw news tree (e.g. data_sources/article_store), one instance per directory."""
+    store_dir = os.path.join(os.path.dirname(os.path.normpath(raw_data_dir_base)), "article_store")
+    if store_dir not in _article_stores:
+        _article_stores[store_dir] = ArticleStore(store_dir)
+    return _article_stores[store_dir]
 
 # Cập nhật cấu hình NewsAPI với các truy vấn mới
 AGENT_NEWSAPI_CONFIG = {
@@ -57,145 +92,220 @@ AGENT_NEWSAPI_CONFIG = {
 
 async def fetch_news_from_newsapi(query: str = None, sources: str = None, category: str = None, language: str = 'en', country: str = None, page_size: int = 20):
     if not NEWS_API_KEY:
-        print("NEWS_API_KEY is not configured. Cannot fetch news from NewsAPI.")
+        logger.error("NEWS_API_KEY is not configured. Cannot fetch news from NewsAPI.")
         return []
-    newsapi = NewsApiClient(api_key=NEWS_API_KEY)
-    articles_data = []
+    if not (query or sources or category or country):
+        logger.warning("NewsAPI: Must provide query, sources, category, or country.")
+        return []
+    config_item = {"query": query, "sources": sources, "category": category, "language": language,
+                   "country": country, "page_size": page_size, "from_param": NEWSAPI_DEFAULT_FROM}
+    return await get_news_fetch_engine().fetch(config_item)
+
+def save_crawled_data(articles_data: list, raw_data_dir_base: str, agent_id_context: str = None):
+    """Appends articles to the agent's segment in the article store. Returns the records actually written.
+
+    A failed write is raised to the caller (an empty list only ever means "nothing new").
+    """
+    store = get_article_store(raw_data_dir_base)
+    agent_id = agent_id_context if agent_id_context else "general_newsapi_feed"
     try:
-        print(f"Fetching news from NewsAPI with query='{query}', sources='{sources}', category='{category}', country='{country}', page_size={page_size}")
-        if query:
-            api_response = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: newsapi.get_everything(q=query, sources=sources, language=language, sort_by='publishedAt', page_size=page_size, from_param="2025-01-01")
-            )
-        elif sources or category or country:
-            api_response = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: newsapi.get_top_headlines(q=query, sources=sources, category=category, language=language, country=country, page_size=page_size)
-            )
-        else:
-            print("NewsAPI: Must provide query, sources, category, or country.")
-            return []
-
-        if api_response['status'] == 'ok':
-            for article_newsapi in api_response['articles']:
-                content_for_rag = article_newsapi.get('content', '') or article_newsapi.get('description', '')
-                if content_for_rag and "[+" in content_for_rag and " chars]" in content_for_rag:
-                    content_for_rag = content_for_rag.split("[+")[0].strip()
-                articles_data.append({
-                    "title": clean_text(article_newsapi['title'] or ""),
-                    "link": article_newsapi['url'],
-                    "content": clean_text(content_for_rag or ""),
-                    "source": article_newsapi['source']['name'] if article_newsapi.get('source') else "NewsAPI",
-                    "published_at": article_newsapi.get('publishedAt'),
-                    "fetch_date": datetime.date.today().strftime("%Y-%m-%d")
-                })
-            print(f"NewsAPI fetched {len(articles_data)} articles.")
-        else:
-            print(f"Error from NewsAPI: {api_response.get('code')} - {api_response.get('message')}")
+        records = store.append_many(agent_id, articles_data)
     except Exception as e:
-        print(f"An error occurred while fetching from NewsAPI: {e}")
-        import traceback
-        traceback.print_exc()
-    return articles_data
+        logger.error("Error saving articles for %s: %s", agent_id, e)
+        raise
+    logger.info("Saved %d articles for %s to the article store (%d already stored).", len(records), agent_id, len(articles_data) - len(records))
+    return records
 
-def save_crawled_data(articles_data: list, raw_data_dir_base: str, agent_id_context: str = None):
-    today_str = datetime.date.today().strftime("%Y-%m-%d")
-    for i, article in enumerate(articles_data):
-        content_to_save = f"Title: {article['title']}\nSource: {article['source']}\nLink: {article['link']}\nPublished At: {article.get('published_at', 'N/A')}\nFetch Date: {article.get('fetch_date', today_str)}\n\n{article['content']}\n\n--- FETCHED VIA NEWSAPI ON {today_str} ---"
-        target_dir = os.path.join(raw_data_dir_base, agent_id_context if agent_id_context else "general_newsapi_feed")
-        os.makedirs(target_dir, exist_ok=True)
-        safe_title = "".join(c if c.isalnum() or c in (' ', '_') else '_' for c in article['title'][:50]).rstrip()
-        filename = os.path.join(target_dir, f"{today_str}_{safe_title.replace(' ', '_')}_{i+1}.txt")
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(content_to_save)
-            print(f"Saved news to: {filename}")
-        except Exception as e:
-            print(f"Error saving file {filename}: {e}")
+def _article_body_for_dedup(record: dict) -> str:
+    """Text compared for near-duplicate detection: the body, plus the title when NewsAPI truncated the body to a stub."""
+    content = record.get("content") or ""
+    if word_count(content) >= NEAR_DUP_MIN_WORDS:
+        return content
+    return f"{record.get('title') or ''}\n{content}"
 
-def update_agents_knowledge_from_raw_data(agent_manager_instance, raw_data_dir_base: str):
-    print("\n=== Updating agents' knowledge from crawled & saved data ===")
-    if not os.path.exists(raw_data_dir_base):
-        print(f"Raw data base directory not found: {raw_data_dir_base}. Skipping knowledge update.")
-        return {"status": "failed", "articles_processed": 0, "last_updated": None}
+def update_agents_knowledge_from_raw_data(agent_manager_instance, raw_data_dir_base: str, job: UpdateJob = None):
+    """Ingests every stored article an agent has not indexed yet. job (optional) receives chunked/embedded progress.
+
+    A cancelled job stops before the next article; the agent being ingested keeps its previous index and offset.
+    An agent whose ingestion fails keeps its offset too and is listed in ingest_failures; status is "partial"
+    if other agents were ingested, "failed" if none were.
+    """
+    logger.info("Updating agents' knowledge from crawled & saved data...")
+    if job:
+        job.set_phase("embedding")
+    store = get_article_store(raw_data_dir_base)
+    migrate_raw_news_tree(raw_data_dir_base, store)
 
     articles_processed = 0
     last_updated = None
-    for agent_id_folder_name in os.listdir(raw_data_dir_base):
-        agent_specific_raw_data_dir = os.path.join(raw_data_dir_base, agent_id_folder_name)
-        if os.path.isdir(agent_specific_raw_data_dir):
-            agent_instance = agent_manager_instance.get_agent(agent_id_folder_name)
-            if agent_instance:
-                print(f"Processing data for agent '{agent_instance.persona.get('full_name', agent_id_folder_name)}' from {agent_specific_raw_data_dir}")
-                files_processed_count = 0
-                for news_file_name in os.listdir(agent_specific_raw_data_dir):
-                    if news_file_name.endswith(".txt"):
-                        file_path = os.path.join(agent_specific_raw_data_dir, news_file_name)
-                        print(f"  Adding knowledge from: {news_file_name}")
-                        try:
-                            agent_instance.add_knowledge_from_file(file_path)
-                            files_processed_count += 1
-                            articles_processed += 1
-                            last_updated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        except Exception as e:
-                            print(f"    Error processing file {file_path} for agent {agent_id_folder_name}: {e}")
-                if files_processed_count == 0:
-                    print(f"  No new .txt files found to process for {agent_id_folder_name} in this run.")
-            else:
-                print(f"Warning: Found data folder '{agent_id_folder_name}' but no corresponding agent loaded in AgentManager.")
-    print("=== Knowledge update process finished. ===")
-    return {"status": "success", "articles_processed": articles_processed, "last_updated": last_updated}
-
-async def _perform_data_update_logic(manager_instance, raw_data_dir_base_path, agent_news_config_dict):
-    print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] Performing data update logic...")
+    agents_ingested = 0
+    ingest_failures = []
+    dedup_totals = {"documents": 0, "documents_near_duplicate": 0, "chunks": 0,
+                    "chunks_exact_duplicate": 0, "chunks_near_duplicate": 0, "chunks_queued": 0}
+    for agent_id in store.agent_ids():
+        if job:
+            job.check_cancelled()
+        if not agent_manager_instance.has_agent(agent_id):
+            logger.warning("Found stored articles for %r but no corresponding agent in AgentManager.", agent_id)
+            continue
+        # Checked on the manifest alone, so agents with nothing new are not built or reloaded into memory
+        if store.last_seq(agent_id) <= agent_manager_instance.ingested_store_offset(agent_id):
+            logger.debug("No new articles to process for %s in this run.", agent_id)
+            continue
+        agent_instance = agent_manager_instance.get_agent(agent_id)
+        manifest = agent_instance.ingestion_manifest
+        logger.info("Processing data for agent %r from article #%d", agent_instance.persona.get('full_name', agent_id), manifest.store_offset + 1)
+        try:
+            records_read, last_seq = 0, manifest.store_offset
+            with agent_instance.bulk_ingest() as batch:
+                for record in store.iter_records(agent_id, after_seq=manifest.store_offset):
+                    if job:
+                        # Raising inside bulk_ingest discards the uncommitted batch
+                        job.check_cancelled()
+                    records_read += 1
+                    last_seq = record["seq"]
+                    # The same wire story comes back from many outlets: embed only the first copy
+                    if batch.near_duplicate_of(record.get("key"), _article_body_for_dedup(record)):
+                        continue
+                    batch.add_text(format_article_text(record), source_name=record.get("source") or "NewsAPI", metadata={
+                        "title": record.get("title"),
+                        "link": record.get("link"),
+                        "published_at": record.get("published_at"),
+                        "article_key": record.get("key"),
+                    })
+            manifest.set_store_offset(last_seq)
+            manifest.save()
+            if job:
+                job.report(agent_id, chunked=batch.stats["chunks"], embedded=batch.chunks_added)
+            articles_processed += records_read
+            agents_ingested += 1
+            last_updated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for name in dedup_totals:
+                dedup_totals[name] += batch.stats[name]
+            logger.info("Ingested %d articles for %s: %d near-duplicate articles skipped, %d exact and %d near-duplicate chunks dropped, "
+                        "%d chunks embedded (chunk dedup ratio %.1f%%).", records_read, agent_id, batch.stats['documents_near_duplicate'],
+                        batch.stats['chunks_exact_duplicate'], batch.stats['chunks_near_duplicate'], batch.stats['chunks_queued'],
+                        batch.dedup_ratio() * 100)
+        except UpdateCancelled:
+            logger.info("Ingestion for %s cancelled; its uncommitted chunks were discarded.", agent_id)
+            raise
+        except Exception as e:
+            ingest_failures.append(agent_id)
+            logger.error("Error ingesting articles for agent %s: %s", agent_id, e)
+    dedup_report = dict(
+        dedup_totals,
+        article_dedup_ratio=dedup_totals["documents_near_duplicate"] / dedup_totals["documents"] if dedup_totals["documents"] else 0.0,
+        chunk_dedup_ratio=1 - dedup_totals["chunks_queued"] / dedup_totals["chunks"] if dedup_totals["chunks"] else 0.0,
+    )
+    if dedup_totals["documents"]:
+        logger.info("Dedup this run: %.1f%% of articles were near-duplicates, %.1f%% of the remaining chunks were not embedded.",
+                    dedup_report['article_dedup_ratio'] * 100, dedup_report['chunk_dedup_ratio'] * 100)
+    if ingest_failures:
+        logger.error("Could not ingest articles for: %s. They will be retried next run.", ", ".join(ingest_failures))
+    status = "success" if not ingest_failures else "partial" if agents_ingested else "failed"
+    logger.info("Knowledge update process finished.")
+    return {"status": status, "ingest_failures": ingest_failures, "articles_processed": articles_processed, "last_updated": last_updated, "dedup": dedup_report}
+
+async def _perform_data_update_logic(manager_instance, raw_data_dir_base_path, agent_news_config_dict, job: UpdateJob = None):
+    logger.info("Performing data update logic...")
     any_new_articles_fetched_overall = False
     update_status = {"status": "failed", "articles_processed": 0, "last_updated": None}
+    save_failures = []
 
+    fetch_state = FetchStateStore(get_fetch_state_dir(raw_data_dir_base_path))
+    jobs = []
     for agent_id_config, search_configs_list in agent_news_config_dict.items():
-        if agent_id_config not in manager_instance.agents:
-            print(f"Skipping news fetch for agent_id '{agent_id_config}' from config as it's not loaded in AgentManager.")
+        if not manager_instance.has_agent(agent_id_config):
+            logger.warning("Skipping news fetch for agent_id %r from config as it is not registered in AgentManager.", agent_id_config)
             continue
-
-        agent_display_name = manager_instance.agents[agent_id_config].persona.get('full_name', agent_id_config)
-        print(f"\nFetching news for agent: {agent_display_name} ({agent_id_config})")
-        
-        agent_specific_articles_this_run = []
         for config_item in search_configs_list:
-            query = config_item.get('query')
-            sources = config_item.get('sources')
-            category = config_item.get('category')
-            country = config_item.get('country')
-            page_size = config_item.get('page_size', 10)
-            language = config_item.get('language', 'en')
-
-            if not (query or sources or category or country):
-                print(f"Skipping invalid NewsAPI config for {agent_id_config}: {config_item}")
+            if not (config_item.get('query') or config_item.get('sources') or config_item.get('category') or config_item.get('country')):
+                logger.warning("Skipping invalid NewsAPI config for %s: %s", agent_id_config, config_item)
                 continue
-            
-            fetched_articles_for_this_config = await fetch_news_from_newsapi(
-                query=query, sources=sources, category=category, language=language, country=country, page_size=page_size
-            )
-            if fetched_articles_for_this_config:
-                agent_specific_articles_this_run.extend(fetched_articles_for_this_config)
-                print(f"Fetched {len(fetched_articles_for_this_config)} articles for {agent_id_config} with config: {config_item}")
-            await asyncio.sleep(0.5)
+            # Only ask for articles newer than the newest one already seen for this query
+            watermark = fetch_state.get_watermark(agent_id_config, config_item)
+            jobs.append((agent_id_config, dict(config_item, from_param=watermark or NEWSAPI_DEFAULT_FROM)))
 
+    if not NEWS_API_KEY:
+        logger.error("NEWS_API_KEY is not configured. Cannot fetch news from NewsAPI.")
+        jobs = []
+
+    if job:
+        job.set_phase("fetching")
+    engine = get_news_fetch_engine()
+    logger.info("Fetching %d NewsAPI configs for %d agents concurrently...", len(jobs), len({agent_id for agent_id, _ in jobs}))
+    fetch_started = time.perf_counter()
+    results = await engine.fetch_configs(jobs)
+    logger.info("NewsAPI sweep finished in %.2fs. Latency: %s", time.perf_counter() - fetch_started, engine.latency_summary())
+    if job:
+        # Nothing has been written yet, so a cancel here leaves no trace
+        job.check_cancelled()
+        job.set_phase("saving")
+
+    results_by_agent = {}
+    for (agent_id_config, config_item), fetched_articles in zip(jobs, results):
+        results_by_agent.setdefault(agent_id_config, []).append((config_item, fetched_articles))
+
+    for agent_id_config, config_results in results_by_agent.items():
+        if job and job.cancel_requested:
+            # Agents saved so far keep their articles and watermarks; the rest are fetched again next run
+            break
+        fetched_articles = [article for _, articles in config_results for article in articles]
+        if job:
+            job.report(agent_id_config, fetched=len(fetched_articles))
+        agent_specific_articles_this_run = fetch_state.filter_unseen(agent_id_config, fetched_articles)
+        if len(agent_specific_articles_this_run) < len(fetched_articles):
+            logger.debug("Dropped %d already-seen articles for %s.", len(fetched_articles) - len(agent_specific_articles_this_run), agent_id_config)
         if agent_specific_articles_this_run:
-            print(f"Saving {len(agent_specific_articles_this_run)} articles for {agent_id_config}...")
-            save_crawled_data(agent_specific_articles_this_run, raw_data_dir_base_path, agent_id_context=agent_id_config)
-            any_new_articles_fetched_overall = True
+            logger.debug("Saving %d articles for %s...", len(agent_specific_articles_this_run), agent_id_config)
+            try:
+                saved_records = save_crawled_data(agent_specific_articles_this_run, raw_data_dir_base_path, agent_id_context=agent_id_config)
+            except Exception:
+                # Remember only what did reach the store; keep the watermarks so the rest is fetched again next run
+                store = get_article_store(raw_data_dir_base_path)
+                stored_articles = [a for a in agent_specific_articles_this_run if store.contains(agent_id_config, a)]
+                fetch_state.mark_seen(agent_id_config, stored_articles)
+                save_failures.append(agent_id_config)
+                logger.warning("Keeping watermarks for %s: %d articles were not saved.", agent_id_config, len(agent_specific_articles_this_run) - len(stored_articles))
+                continue
+            fetch_state.mark_seen(agent_id_config, agent_specific_articles_this_run)
+            if job:
+                job.report(agent_id_config, saved=len(saved_records))
+            if saved_records:
+                any_new_articles_fetched_overall = True
         else:
-            print(f"No new articles fetched for {agent_id_config} in this run.")
+            logger.debug("No new articles fetched for %s in this run.", agent_id_config)
+        # Advance watermarks only once this agent's articles are on disk
+        for config_item, articles in config_results:
+            fetch_state.update_watermark(agent_id_config, config_item, articles)
+    fetch_state.save()
+    if job:
+        job.check_cancelled()
 
     if any_new_articles_fetched_overall:
-        print("\nUpdating all agent knowledge bases from newly saved files...")
-        update_status = update_agents_knowledge_from_raw_data(manager_instance, raw_data_dir_base_path)
-        print("Knowledge bases updated.")
+        logger.info("Updating all agent knowledge bases from newly stored articles...")
+        update_status = update_agents_knowledge_from_raw_data(manager_instance, raw_data_dir_base_path, job=job)
+        logger.info("Knowledge bases updated.")
     else:
-        print("No new articles were fetched overall in this run to update knowledge bases.")
-    
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Data update logic finished.\n")
+        logger.info("No new articles were fetched overall in this run to update knowledge bases.")
+    if save_failures:
+        logger.error("Could not save articles for: %s. They will be fetched again next run.", ", ".join(save_failures))
+    update_status["save_failures"] = save_failures
+
+    logger.info("Data update logic finished.")
     return update_status
 
-def trigger_data_update(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param):
-    print(f"Triggering data update with manager: {type(manager_instance)}, raw_dir: {raw_data_dir_base_path}")
-    return asyncio.run(_perform_data_update_logic(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param))
\ No newline at end of file
+def trigger_data_update(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param, job: UpdateJob = None):
+    """Runs the fetch-save-embed pipeline in the calling thread. Prefer start_data_update() from UI code."""
+    logger.debug("Triggering data update with manager: %s, raw_dir: %s", type(manager_instance).__name__, raw_data_dir_base_path)
+    return asyncio.run(_perform_data_update_logic(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param, job=job))
+
+def start_data_update(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param) -> UpdateJob:
+    """Runs the pipeline on the manager's background update worker and returns the job handle right away.
+
+    If an update is already running, its handle is returned instead of starting a second one.
+    """
+    return manager_instance.update_worker.submit(
+        lambda job: trigger_data_update(manager_instance, raw_data_dir_base_path, agent_news_config_dict_param, job=job),
+        description="fetch news and update knowledge"
+    )
\ No newline at end of file
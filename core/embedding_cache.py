@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+from core.metrics import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = get_logger(__name__)
+
+CHUNK_EMBEDDING_CACHE_DIR = os.getenv("CHUNK_EMBEDDING_CACHE_DIR", "embedding_cache/")
+
+
+@contextmanager
+def exclusive_file_lock(path: str):
+    """Holds an exclusive OS lock on path (created if missing) for the duration of the block, across processes."""
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def chunk_key(model_name: str, normalized_text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{normalized_text}".encode('utf-8')).hexdigest()
+
+
+class ChunkEmbeddingCache:
+    """Content-addressed on-disk store of chunk vectors for one embedding model.
+
+    Layout under <cache_dir>/<model_name>/:
+        vectors.f32  row-major float32 matrix, appended to and read through np.memmap
+        keys.txt     append-only; line i is the chunk key of row i
+        meta.json    model_name and vector dimension
+        .lock        held exclusively while appending or repairing, so several processes can share the cache
+
+    Keys are sha256 of (model name, normalized chunk text), so any agent, rebuild or
+    migration that embeds the same chunk with the same model reads the stored row
+    instead of running the model again. Rows appended by other processes are picked
+    up from keys.txt before each append and whenever a lookup misses.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name))
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.keys_path = os.path.join(self.dir, "keys.txt")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.lock_path = os.path.join(self.dir, ".lock")
+        self._lock = threading.Lock()
+        self.dim = None
+        self._rows = {}
+        self._row_count = 0    # lines of keys.txt read so far (a key stored twice keeps its first row)
+        self._keys_offset = 0  # bytes of keys.txt read so far
+        self._matrix = None
+        self.stats = {"hits": 0, "misses": 0, "stored": 0}
+        self._load()
+
+    def _reset_rows(self):
+        self._rows = {}
+        self._row_count = 0
+        self._keys_offset = 0
+        self._matrix = None
+
+    def _read_new_keys(self):
+        """Reads the keys.txt lines appended since the last read; a line still being written is left for later."""
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].decode('utf-8').splitlines():
+            self._rows.setdefault(line.strip(), self._row_count)
+            self._row_count += 1
+        self._keys_offset += complete
+
+    def _load_dim(self):
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            self.dim = json.load(f)["dim"]
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        try:
+            with exclusive_file_lock(self.lock_path):
+                self._load_dim()
+                self._read_new_keys()
+                row_bytes = self.dim * 4
+                vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+                keys_size = os.path.getsize(self.keys_path) if os.path.exists(self.keys_path) else 0
+                rows = min(self._row_count, vectors_size // row_bytes)
+                # A crash between the two appends leaves one file longer than the other; cut both back to the common prefix
+                if rows != self._row_count or rows * row_bytes != vectors_size or keys_size != self._keys_offset:
+                    logger.warning("Chunk embedding cache for %s: truncating to %d consistent rows.", self.model_name, rows)
+                    with open(self.keys_path, 'rb') as f:
+                        lines = f.read()[:self._keys_offset].splitlines(keepends=True)[:rows]
+                    with open(self.keys_path, 'wb') as f:
+                        f.write(b"".join(lines))
+                    with open(self.vectors_path, 'ab') as f:
+                        f.truncate(rows * row_bytes)
+                    self._reset_rows()
+                    self._read_new_keys()
+        except Exception as e:
+            logger.error("Error loading chunk embedding cache %s: %s. Starting with an empty cache.", self.dir, e)
+            self.dim = None
+            self._reset_rows()
+            for path in (self.vectors_path, self.keys_path, self.meta_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _matrix_view(self):
+        """Memmap over the rows read so far, reopened when more have been read."""
+        if self._matrix is None or self._matrix.shape[0] < self._row_count:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._row_count, self.dim))
+        return self._matrix
+
+    def get_many(self, keys: list) -> list:
+        """Stored vector (list of floats) for each key, or None where the key is not cached."""
+        with self._lock:
+            if self.dim is not None and any(key not in self._rows for key in keys) and os.path.exists(self.keys_path) \
+                    and os.path.getsize(self.keys_path) > self._keys_offset:
+                # Another process may have embedded them since
+                with exclusive_file_lock(self.lock_path):
+                    self._read_new_keys()
+            rows = [self._rows.get(key) for key in keys]
+            found = [row for row in rows if row is not None]
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(rows) - len(found)
+            if not found:
+                return [None] * len(keys)
+            vectors = iter(self._matrix_view()[found].tolist())
+            return [next(vectors) if row is not None else None for row in rows]
+
+    def put_many(self, keys: list, vectors: list):
+        with self._lock:
+            os.makedirs(self.dir, exist_ok=True)
+            with exclusive_file_lock(self.lock_path):
+                if self.dim is None and os.path.exists(self.meta_path):
+                    # Another process created the cache after this one started
+                    self._load_dim()
+                self._read_new_keys()
+                new_keys, new_vectors, batch_keys = [], [], set()
+                for key, vector in zip(keys, vectors):
+                    if key in self._rows or key in batch_keys:
+                        continue
+                    if self.dim is None:
+                        self.dim = len(vector)
+                        with open(self.meta_path, 'w', encoding='utf-8') as f:
+                            json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+                    if len(vector) != self.dim:
+                        continue
+                    batch_keys.add(key)
+                    new_keys.append(key)
+                    new_vectors.append(vector)
+                if not new_keys:
+                    return
+                # Rows are numbered by position in the files: drop whatever a crashed writer left past the last whole row
+                with open(self.vectors_path, 'ab') as f:
+                    if f.seek(0, os.SEEK_END) != self._row_count * self.dim * 4:
+                        f.truncate(self._row_count * self.dim * 4)
+                    f.write(np.asarray(new_vectors, dtype=np.float32).tobytes())
+                with open(self.keys_path, 'ab') as f:
+                    if f.seek(0, os.SEEK_END) != self._keys_offset:
+                        f.truncate(self._keys_offset)
+                    f.write("".join(key + "\n" for key in new_keys).encode('utf-8'))
+                self._read_new_keys()
+            self.stats["stored"] += len(new_keys)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, entries=len(self._rows), dim=self.dim,
+                        size_mb=self._row_count * (self.dim or 0) * 4 / (1024 * 1024),
+                        hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
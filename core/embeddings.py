@@ -0,0 +1,262 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+from core.embedding_cache import ChunkEmbeddingCache, CHUNK_EMBEDDING_CACHE_DIR, chunk_key
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+
+
+class BasicEmbedder:
+    """Very basic fallback used when the sentence-transformer cannot be loaded (suboptimal)."""
+    def embed_documents(self, texts): return [[float(ord(c)) for c in t[:10]] for t in texts]
+    def embed_query(self, text): return [float(ord(c)) for c in text[:10]]
+
+
+def normalize_text(text: str) -> str:
+    """Cache key form of a query or chunk: surrounding and repeated whitespace don't change the meaning."""
+    return " ".join(text.split())
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of query vectors keyed by (model_name, normalized query).
+
+    Concurrent misses for the same key wait for the first caller's result instead of
+    embedding the query again, so one query costs at most one forward pass.
+    """
+
+    def __init__(self, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_or_compute(self, key: tuple, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key]
+            waiter = self._inflight.get(key)
+            if waiter is None:
+                self._inflight[key] = threading.Event()
+                self.stats["misses"] += 1
+            else:
+                # Someone else is embedding this exact query right now
+                self.stats["hits"] += 1
+        if waiter is not None:
+            waiter.wait()
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            # The other caller failed (or the entry was already evicted); embed it ourselves
+            return compute()
+
+        try:
+            vector = compute()
+            with self._lock:
+                if self.max_entries > 0:
+                    self._entries[key] = vector
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.stats["evictions"] += 1
+            return vector
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries,
+                        hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
+
+
+class _EmbeddingRequest:
+    def __init__(self, texts: list):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SharedEmbeddingService(Embeddings):
+    """Process-wide embedding model shared by every agent.
+
+    Calls coming from different threads are queued and coalesced by a single
+    worker thread, so concurrent embed_query/embed_documents calls are served
+    by one forward pass of the underlying model.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL_NAME, max_batch_size: int = 64, max_wait_ms: float = 5.0):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000.0
+        self.model = self._load_model(model_name)
+        # The fallback embedder's vectors are not worth persisting (and vary in length)
+        self.chunk_cache = None if isinstance(self.model, BasicEmbedder) else ChunkEmbeddingCache(CHUNK_EMBEDDING_CACHE_DIR, model_name)
+
+        self._queue = []
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "texts_embedded": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "batch_seconds_total": 0.0,
+        }
+        self._worker = threading.Thread(target=self._run, name=f"embedding-batcher-{model_name}", daemon=True)
+        self._worker.start()
+
+    @staticmethod
+    def _load_model(model_name: str):
+        global _models_loaded
+        logger.info("Initializing local embedding model: %s...", model_name)
+        try:
+            from langchain_huggingface import HuggingFaceEmbeddings
+            model = HuggingFaceEmbeddings(
+                model_name=model_name,
+                model_kwargs={'device': 'cpu'},
+                encode_kwargs={'normalize_embeddings': True}
+            )
+            logger.info("Local embedding model %s initialized.", model_name)
+        except Exception as e:
+            logger.error("Error initializing local embedding model %s: %s. Falling back to a very basic tokenizer for RAG (suboptimal).", model_name, e)
+            model = BasicEmbedder()
+        with _registry_lock:
+            _models_loaded += 1
+        return model
+
+    # --- Embeddings interface ---
+    def embed_documents(self, texts: list) -> list:
+        if not texts:
+            return []
+        texts = list(texts)
+        if self.chunk_cache is None:
+            return self._submit(texts)
+        # Only chunks never embedded with this model before go through the model. The model sees the
+        # normalized text the key is computed from, so a cached row never depends on which spelling came first
+        texts = [normalize_text(text) for text in texts]
+        keys = [chunk_key(self.model_name, text) for text in texts]
+        vectors = self.chunk_cache.get_many(keys)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self._submit([texts[i] for i in missing])
+            self.chunk_cache.put_many([keys[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        # Every retriever built on this service goes through the process-wide query cache
+        text = normalize_text(text)
+        return _query_cache.get_or_compute((self.model_name, text), lambda: self._submit([text])[0])
+
+    # --- Batching ---
+    def _submit(self, texts: list) -> list:
+        request = _EmbeddingRequest(texts)
+        with self._cond:
+            self._queue.append(request)
+            self._cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # Give other callers a short window to join this forward pass
+            deadline = time.monotonic() + self.max_wait_s
+            while sum(len(r.texts) for r in self._queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, batch_size = [], 0
+            while self._queue and (not batch or batch_size + len(self._queue[0].texts) <= self.max_batch_size):
+                request = self._queue.pop(0)
+                batch.append(request)
+                batch_size += len(request.texts)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            all_texts = [text for request in batch for text in request.texts]
+            started = time.perf_counter()
+            try:
+                vectors = self.model.embed_documents(all_texts)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            elapsed = time.perf_counter() - started
+
+            offset = 0
+            for request in batch:
+                request.result = vectors[offset:offset + len(request.texts)]
+                offset += len(request.texts)
+                request.done.set()
+
+            with self._stats_lock:
+                self._stats["requests"] += len(batch)
+                self._stats["texts_embedded"] += len(all_texts)
+                self._stats["batches"] += 1
+                self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(all_texts))
+                self._stats["batch_seconds_total"] += elapsed
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["model_name"] = self.model_name
+        stats["avg_batch_size"] = stats["texts_embedded"] / stats["batches"] if stats["batches"] else 0.0
+        stats["avg_requests_per_batch"] = stats["requests"] / stats["batches"] if stats["batches"] else 0.0
+        if self.chunk_cache is not None:
+            stats["chunk_cache"] = self.chunk_cache.get_stats()
+        return stats
+
+
+_registry_lock = threading.Lock()
+# Held while a model is being loaded, so that two agents created at the same time don't both load it.
+_creation_lock = threading.Lock()
+_services = {}
+_models_loaded = 0
+_query_cache = QueryEmbeddingCache()
+
+
+def get_shared_embeddings(model_name: str = DEFAULT_EMBEDDING_MODEL_NAME) -> SharedEmbeddingService:
+    """Returns the process-wide embedding service for model_name, loading the model on first use."""
+    service = _services.get(model_name)
+    if service is not None:
+        return service
+    with _creation_lock:
+        service = _services.get(model_name)
+        if service is None:
+            service = SharedEmbeddingService(model_name)
+            _services[model_name] = service
+    return service
+
+
+def get_embedding_stats() -> dict:
+    """Number of loaded models, per-model batching statistics and query cache hit rate."""
+    with _registry_lock:
+        models_loaded = _models_loaded
+    return {
+        "models_loaded": models_loaded,
+        "services": {name: service.get_stats() for name, service in list(_services.items())},
+        "query_cache": _query_cache.get_stats(),
+    }
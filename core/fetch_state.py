@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import threading
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+
+def article_key(article: dict) -> str:
+    """sha1 of the article URL (falls back to title + publishedAt for the rare article without one)."""
+    identity = article.get("link") or f"{article.get('title')}|{article.get('published_at')}"
+    return hashlib.sha1(identity.strip().encode('utf-8')).hexdigest()
+
+
+def config_key(config_item: dict) -> str:
+    """Stable identifier of one NewsAPI search config (ignores page size and the from date)."""
+    fields = {name: config_item.get(name) for name in ("query", "sources", "category", "country", "language")}
+    return json.dumps(fields, sort_keys=True)
+
+
+class FetchStateStore:
+    """Persistent per-agent fetch state: newest publishedAt seen per query and the URLs already saved.
+
+    watermarks.json holds {agent_id: {config_key: publishedAt}}. Seen URLs are kept as
+    sha1 hashes in an append-only seen_urls/<agent_id>.txt file per agent.
+    """
+
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        self.watermarks_path = os.path.join(state_dir, "watermarks.json")
+        self.seen_urls_dir = os.path.join(state_dir, "seen_urls")
+        os.makedirs(self.seen_urls_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.watermarks = {}
+        self._seen_urls = {}
+        if os.path.exists(self.watermarks_path):
+            try:
+                with open(self.watermarks_path, 'r', encoding='utf-8') as f:
+                    self.watermarks = json.load(f)
+            except Exception as e:
+                logger.error("Error loading fetch watermarks from %s: %s. Starting without watermarks.", self.watermarks_path, e)
+
+    # --- Watermarks ---
+    def get_watermark(self, agent_id: str, config_item: dict) -> str | None:
+        return self.watermarks.get(agent_id, {}).get(config_key(config_item))
+
+    def update_watermark(self, agent_id: str, config_item: dict, articles: list):
+        # ISO-8601 UTC timestamps from NewsAPI compare correctly as strings
+        published = [a.get("published_at") for a in articles if a.get("published_at")]
+        if not published:
+            return
+        key = config_key(config_item)
+        with self._lock:
+            agent_watermarks = self.watermarks.setdefault(agent_id, {})
+            current = agent_watermarks.get(key)
+            newest = max(published)
+            if current is None or newest > current:
+                agent_watermarks[key] = newest
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self.watermarks, indent=2, sort_keys=True)
+        tmp_path = self.watermarks_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.watermarks_path)
+
+    # --- Seen URL index ---
+    def _seen_path(self, agent_id: str) -> str:
+        return os.path.join(self.seen_urls_dir, f"{agent_id}.txt")
+
+    def _seen_for(self, agent_id: str) -> set:
+        seen = self._seen_urls.get(agent_id)
+        if seen is None:
+            seen = set()
+            path = self._seen_path(agent_id)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    seen.update(line.strip() for line in f if line.strip())
+            self._seen_urls[agent_id] = seen
+        return seen
+
+    def filter_unseen(self, agent_id: str, articles: list) -> list:
+        """Drops articles whose URL was already saved for agent_id, and repeats within `articles`."""
+        with self._lock:
+            seen = self._seen_for(agent_id)
+            fresh, batch_keys = [], set()
+            for article in articles:
+                key = article_key(article)
+                if key in seen or key in batch_keys:
+                    continue
+                batch_keys.add(key)
+                fresh.append(article)
+            return fresh
+
+    def mark_seen(self, agent_id: str, articles: list):
+        with self._lock:
+            seen = self._seen_for(agent_id)
+            new_keys = [article_key(a) for a in articles]
+            new_keys = [key for key in dict.fromkeys(new_keys) if key not in seen]
+            if not new_keys:
+                return
+            with open(self._seen_path(agent_id), 'a', encoding='utf-8') as f:
+                f.write("\n".join(new_keys) + "\n")
+            seen.update(new_keys)
@@ -0,0 +1,183 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+from core.near_dedup import NearDuplicateIndex
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class IngestionManifest:
+    """Persistent record of what has already been embedded into one agent's vector store.
+
+    Files are keyed by path and remembered with their size, mtime and content hash,
+    so an unchanged file is skipped with a single os.stat. Chunk hashes let the
+    agent drop chunks that are already in the index even if they come from a new file.
+    store_offset is the last article store seq that has been ingested.
+    SimHash fingerprints of ingested articles and chunks back near-duplicate detection,
+    and near_duplicate_of maps each skipped article to the article it duplicates.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self.files = {}
+        self.chunk_hashes = set()
+        self.store_offset = 0
+        self.article_fingerprints = NearDuplicateIndex()
+        self.chunk_fingerprints = NearDuplicateIndex()
+        self.near_duplicate_of = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.files = data.get("files", {})
+            self.chunk_hashes = set(data.get("chunk_hashes", []))
+            self.store_offset = data.get("store_offset", 0)
+            self.article_fingerprints = NearDuplicateIndex(fingerprints=data.get("article_fingerprints"))
+            self.chunk_fingerprints = NearDuplicateIndex(fingerprints=data.get("chunk_fingerprints"))
+            self.near_duplicate_of = data.get("near_duplicate_of", {})
+        except Exception as e:
+            logger.error("Error loading ingestion manifest %s: %s. Starting with an empty manifest.", self.manifest_path, e)
+            self.files = {}
+            self.chunk_hashes = set()
+            self.store_offset = 0
+            self.article_fingerprints = NearDuplicateIndex()
+            self.chunk_fingerprints = NearDuplicateIndex()
+            self.near_duplicate_of = {}
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        return os.path.normpath(file_path)
+
+    def needs_ingest(self, file_path: str) -> bool:
+        """True if file_path is new or its content changed since it was last ingested."""
+        entry = self.files.get(self._key(file_path))
+        if entry is None:
+            return True
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            return False
+        # Touched but maybe not modified: compare content before re-embedding anything
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                if content_hash(f.read()) != entry.get("sha256"):
+                    return True
+        except Exception:
+            return True
+        with self._lock:
+            entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime
+            self._dirty = True
+        return False
+
+    def record_file(self, file_path: str, text: str, chunks_added: int):
+        try:
+            stat = os.stat(file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+        except OSError:
+            size, mtime = None, None
+        with self._lock:
+            self.files[self._key(file_path)] = {
+                "sha256": content_hash(text),
+                "size": size,
+                "mtime": mtime,
+                "chunks": chunks_added,
+                "ingested_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._dirty = True
+
+    def filter_new_chunks(self, chunks: list) -> list:
+        """Returns (chunk, chunk_hash) pairs for chunks not yet indexed, dropping repeats within the list too."""
+        new_chunks = []
+        seen = set()
+        for chunk in chunks:
+            h = content_hash(chunk)
+            if h in self.chunk_hashes or h in seen:
+                continue
+            seen.add(h)
+            new_chunks.append((chunk, h))
+        return new_chunks
+
+    def record_chunks(self, chunk_hashes: list):
+        with self._lock:
+            self.chunk_hashes.update(chunk_hashes)
+            self._dirty = True
+
+    def record_fingerprints(self, article_fingerprints: dict, chunk_fingerprints: dict, near_duplicate_of: dict):
+        """Merges the SimHash fingerprints (key -> int) and duplicate links of a committed batch."""
+        with self._lock:
+            for key, fingerprint in article_fingerprints.items():
+                self.article_fingerprints.add(key, fingerprint)
+            for key, fingerprint in chunk_fingerprints.items():
+                self.chunk_fingerprints.add(key, fingerprint)
+            self.near_duplicate_of.update(near_duplicate_of)
+            self._dirty = True
+
+    def forget_expired(self, expired_metadatas: list, kept_metadatas: list):
+        """Drops the hashes and fingerprints of chunks compaction removed from the index (and of
+        articles none of whose chunks are left), so that content can be ingested again later."""
+        kept_hashes = {metadata.get("chunk_hash") for metadata in kept_metadatas}
+        kept_articles = {metadata.get("article_key") for metadata in kept_metadatas}
+        chunk_hashes = {metadata.get("chunk_hash") for metadata in expired_metadatas} - kept_hashes - {None}
+        article_keys = {metadata.get("article_key") for metadata in expired_metadatas} - kept_articles - {None}
+        if not chunk_hashes and not article_keys:
+            return
+        with self._lock:
+            self.chunk_hashes -= chunk_hashes
+            self.chunk_fingerprints.remove(chunk_hashes)
+            self.article_fingerprints.remove(article_keys)
+            self.near_duplicate_of = {key: representative for key, representative in self.near_duplicate_of.items()
+                                      if key not in article_keys and representative not in article_keys}
+            self._dirty = True
+
+    def set_store_offset(self, seq: int):
+        with self._lock:
+            self.store_offset = seq
+            self._dirty = True
+
+    def reset(self):
+        with self._lock:
+            self.files = {}
+            self.chunk_hashes = set()
+            self.store_offset = 0
+            self.article_fingerprints = NearDuplicateIndex()
+            self.chunk_fingerprints = NearDuplicateIndex()
+            self.near_duplicate_of = {}
+            self._dirty = True
+        self.save()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                "files": self.files,
+                "chunk_hashes": sorted(self.chunk_hashes),
+                "store_offset": self.store_offset,
+                "article_fingerprints": self.article_fingerprints.to_dict(),
+                "chunk_fingerprints": self.chunk_fingerprints.to_dict(),
+                "near_duplicate_of": self.near_duplicate_of,
+            }
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.manifest_path)
+        except Exception as e:
+            logger.error("Error saving ingestion manifest %s: %s", self.manifest_path, e)
@@ -0,0 +1,239 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Global default; a persona can override any of these under an `llm:` key
+DEFAULT_LLM_CONFIG = {
+    "backend": os.getenv("LLM_BACKEND", "gemini"),   # gemini | stub
+    "model": os.getenv("LLM_MODEL"),                  # None = the backend's default model
+    "temperature": 0.7,
+    # Only used by the stub backend
+    "latency_s": float(os.getenv("LLM_STUB_LATENCY_S", "0.5")),       # time to first token
+    "latency_jitter_s": float(os.getenv("LLM_STUB_JITTER_S", "0.0")),  # plus uniform random 0..jitter
+    "tokens_per_s": float(os.getenv("LLM_STUB_TOKENS_PER_S", "50")),   # 0 = whole reply at once
+    "reply_tokens": int(os.getenv("LLM_STUB_REPLY_TOKENS", "60")),
+    "failure_rate": float(os.getenv("LLM_STUB_FAILURE_RATE", "0.0")),
+    "seed": None,            # seeds latency jitter and failure injection (the reply text is always deterministic)
+}
+# Keys that make up the generation config passed to the model (and into the response cache fingerprint)
+GENERATION_KEYS = ("temperature", "top_p", "top_k", "max_output_tokens")
+
+_STUB_WORDS = ("chính sách", "kinh tế", "hợp tác", "an ninh", "phát triển", "thương mại", "khu vực", "đối thoại",
+               "lợi ích", "ổn định", "đầu tư", "ngoại giao", "quan điểm", "thị trường", "trách nhiệm", "tương lai")
+
+
+class LLMError(Exception):
+    """Raised by a backend when a call fails (including failures injected by the stub).
+
+    retryable tells the dispatcher whether the call may succeed if repeated (overload, 5xx, timeouts).
+    """
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def resolve_llm_config(persona: dict = None, overrides: dict = None) -> dict:
+    """Global defaults, updated with the persona's `llm` section and then explicit overrides."""
+    config = dict(DEFAULT_LLM_CONFIG)
+    if persona and isinstance(persona.get("llm"), dict):
+        config.update(persona["llm"])
+    if overrides:
+        config.update(overrides)
+    if config["backend"] not in BACKENDS:
+        logger.warning("Unknown LLM backend %r. Using gemini.", config['backend'])
+        config["backend"] = "gemini"
+    return config
+
+
+class LLMBackend:
+    """One chat model. history is a list of (user_msg, ai_msg) turns; message is the new user message.
+
+    Subclasses implement generate and generate_stream; the async variants default to running
+    the sync ones on the event loop's executor.
+    """
+
+    name = "base"
+    default_model = None
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.model_name = config.get("model") or self.default_model or self.name
+        self.generation_config = {key: config[key] for key in GENERATION_KEYS if config.get(key) is not None}
+
+    @property
+    def cache_model_name(self) -> str:
+        """Model identity for the response cache, so replies of different backends never mix."""
+        return self.model_name if self.name == "gemini" else f"{self.name}:{self.model_name}"
+
+    def generate(self, message: str, history: list = None) -> str:
+        raise NotImplementedError
+
+    def generate_stream(self, message: str, history: list = None):
+        """Yields the reply text chunk by chunk."""
+        raise NotImplementedError
+
+    async def agenerate(self, message: str, history: list = None) -> str:
+        return await asyncio.get_running_loop().run_in_executor(None, self.generate, message, history)
+
+    async def agenerate_stream(self, message: str, history: list = None):
+        loop = asyncio.get_running_loop()
+        stream = self.generate_stream(message, history)
+        finished = object()
+        while True:
+            chunk = await loop.run_in_executor(None, next, stream, finished)
+            if chunk is finished:
+                return
+            yield chunk
+
+
+_genai_configured = False
+_genai_lock = threading.Lock()
+
+
+def _configure_genai():
+    """Imports and configures google.generativeai on first use, so other backends work without a key."""
+    global _genai_configured
+    import google.generativeai as genai
+    with _genai_lock:
+        if not _genai_configured:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                raise ValueError("GEMINI_API_KEY not found in .env file or environment variables.")
+            genai.configure(api_key=api_key)
+            _genai_configured = True
+    return genai
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+    default_model = "gemini-1.5-flash-latest"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        genai = _configure_genai()
+        self.model = genai.GenerativeModel(
+            model_name=self.model_name,
+            generation_config=genai.types.GenerationConfig(**self.generation_config)
+        )
+
+    @staticmethod
+    def _chat_history(history: list = None) -> list:
+        gemini_history = []
+        for user_msg, ai_msg in history or []:
+            gemini_history.append({'role': 'user', 'parts': [{'text': user_msg}]})
+            gemini_history.append({'role': 'model', 'parts': [{'text': ai_msg}]})
+        return gemini_history
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        try:
+            return chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only safety metadata)
+            return ""
+
+    def generate(self, message: str, history: list = None) -> str:
+        return self.model.start_chat(history=self._chat_history(history)).send_message(message).text
+
+    def generate_stream(self, message: str, history: list = None):
+        for chunk in self.model.start_chat(history=self._chat_history(history)).send_message(message, stream=True):
+            chunk_text = self._chunk_text(chunk)
+            if chunk_text:
+                yield chunk_text
+
+    async def agenerate(self, message: str, history: list = None) -> str:
+        response = await self.model.start_chat(history=self._chat_history(history)).send_message_async(message)
+        return response.text
+
+    async def agenerate_stream(self, message: str, history: list = None):
+        response = await self.model.start_chat(history=self._chat_history(history)).send_message_async(message, stream=True)
+        async for chunk in response:
+            chunk_text = self._chunk_text(chunk)
+            if chunk_text:
+                yield chunk_text
+
+
+class StubBackend(LLMBackend):
+    """Local stand-in for load testing: no network, configurable latency, token rate and failures.
+
+    The reply is derived from a hash of the message and history, so identical prompts get identical
+    replies (and exercise the response cache like a real model would). Each call waits latency_s
+    (+ up to latency_jitter_s), fails with probability failure_rate, then emits reply_tokens
+    words at tokens_per_s.
+    """
+
+    name = "stub"
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.latency_s = float(config.get("latency_s", 0.0))
+        self.latency_jitter_s = float(config.get("latency_jitter_s", 0.0))
+        self.tokens_per_s = float(config.get("tokens_per_s", 0.0))
+        self.reply_tokens = max(1, int(config.get("reply_tokens", 60)))
+        self.failure_rate = float(config.get("failure_rate", 0.0))
+        self._random = random.Random(config.get("seed"))
+        self._random_lock = threading.Lock()
+
+    def _draw(self) -> tuple:
+        """(first token delay, fail?) for one call."""
+        with self._random_lock:
+            jitter = self._random.uniform(0, self.latency_jitter_s) if self.latency_jitter_s > 0 else 0.0
+            fail = self.failure_rate > 0 and self._random.random() < self.failure_rate
+        return self.latency_s + jitter, fail
+
+    def _reply_words(self, message: str, history: list = None) -> list:
+        seed_text = message + "".join(user_msg + ai_msg for user_msg, ai_msg in history or [])
+        words_random = random.Random(hashlib.sha256(seed_text.encode('utf-8')).hexdigest())
+        words = [words_random.choice(_STUB_WORDS) for _ in range(self.reply_tokens)]
+        thought_len = max(1, len(words) // 4)
+        return (["<thinking>"] + words[:thought_len] + ["</thinking>\n"] + words[thought_len:])
+
+    def _pieces(self, message: str, history: list = None) -> list:
+        words = self._reply_words(message, history)
+        return [word + ("" if word.endswith("\n") or index == len(words) - 1 else " ") for index, word in enumerate(words)]
+
+    def generate(self, message: str, history: list = None) -> str:
+        return "".join(self.generate_stream(message, history))
+
+    def generate_stream(self, message: str, history: list = None):
+        delay, fail = self._draw()
+        time.sleep(delay)
+        if fail:
+            raise LLMError(f"Injected failure from the stub backend (failure_rate={self.failure_rate}).")
+        for piece in self._pieces(message, history):
+            if self.tokens_per_s > 0:
+                time.sleep(1.0 / self.tokens_per_s)
+            yield piece
+
+    async def agenerate(self, message: str, history: list = None) -> str:
+        return "".join([piece async for piece in self.agenerate_stream(message, history)])
+
+    async def agenerate_stream(self, message: str, history: list = None):
+        delay, fail = self._draw()
+        await asyncio.sleep(delay)
+        if fail:
+            raise LLMError(f"Injected failure from the stub backend (failure_rate={self.failure_rate}).")
+        for piece in self._pieces(message, history):
+            if self.tokens_per_s > 0:
+                await asyncio.sleep(1.0 / self.tokens_per_s)
+            yield piece
+
+
+BACKENDS = {"gemini": GeminiBackend, "stub": StubBackend}
+
+
+def register_backend(name: str, backend_class):
+    """Makes backend_class selectable as `backend: <name>` (persona `llm` section or LLM_BACKEND)."""
+    backend_class.name = name
+    BACKENDS[name] = backend_class
+
+
+def create_backend(config: dict) -> LLMBackend:
+    return BACKENDS[config["backend"]](config)
@@ -0,0 +1,321 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import threading
+from core.metrics import metrics, get_logger
+
+logger = get_logger(__name__)
+
+# Calls in flight at once, across all agents and sessions, and per model
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("LLM_MAX_CONCURRENCY_PER_MODEL", "8"))
+# Per attempt; for streams, the limit on the wait for each chunk
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "0.5"))
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "8"))
+# A duplicate request is sent if the first has not answered after this long; unset = no hedging
+LLM_HEDGE_AFTER_S = float(os.getenv("LLM_HEDGE_AFTER_S")) if os.getenv("LLM_HEDGE_AFTER_S") else None
+# The breaker opens after this many consecutive retryable failures and lets one probe through after LLM_BREAKER_RESET_S
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+
+# google.api_core exceptions (and HTTP-ish names) that mean "overloaded or briefly unavailable", matched by name
+# so the dispatcher does not depend on the Gemini SDK
+RETRYABLE_ERROR_NAMES = frozenset({
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Aborted",
+})
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the model while its circuit breaker is open."""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if getattr(error, "retryable", None) is not None:
+        return bool(error.retryable)
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+class CircuitBreaker:
+    """closed -> open after failure_threshold consecutive retryable failures -> half_open after reset_s,
+    where a single probe call decides between closed and open again."""
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, reset_s: float = LLM_BREAKER_RESET_S):
+        self.failure_threshold = failure_threshold
+        self.reset_s = reset_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_s:
+                self.state, self._probe_in_flight = "half_open", False
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state, self.failures, self._probe_in_flight = "closed", 0, False
+
+    def abandon_probe(self):
+        """The half-open probe was cancelled before it could tell; let the next call probe instead."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("LLM circuit breaker opened after %d consecutive failures; failing fast for %gs.", self.failures, self.reset_s)
+                self.state, self.opened_at, self._probe_in_flight = "open", time.monotonic(), False
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class LLMDispatcher:
+    """Runs every LLM call on one asyncio loop (a daemon thread), shared by all agents and sessions.
+
+    Calls are capped by a global and a per-model semaphore, time out after timeout_s per attempt,
+    and are retried with exponential backoff and full jitter on retryable errors. With hedge_after_s
+    set, a non-streaming call that has not answered after that long gets a duplicate (only if a slot
+    is free right away); the first answer wins and the other is cancelled. A per-model circuit
+    breaker rejects calls with CircuitOpenError while the provider keeps failing.
+
+    Streams are retried only until their first chunk arrives; after that an error is raised to the
+    consumer, which has already shown part of the reply. Sync callers (generate, stream) block
+    only their own thread; async callers (agenerate, astream) may run on any event loop.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_concurrency_per_model: int = LLM_MAX_CONCURRENCY_PER_MODEL,
+                 timeout_s: float = LLM_TIMEOUT_S, max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base_s: float = LLM_BACKOFF_BASE_S, backoff_max_s: float = LLM_BACKOFF_MAX_S,
+                 hedge_after_s: float = LLM_HEDGE_AFTER_S, breaker_failures: int = LLM_BREAKER_FAILURES,
+                 breaker_reset_s: float = LLM_BREAKER_RESET_S):
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_model = max_concurrency_per_model
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.hedge_after_s = hedge_after_s
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_s = breaker_reset_s
+        self._global_semaphore = asyncio.Semaphore(max_concurrency)
+        self._model_semaphores = {}  # model -> asyncio.Semaphore (only touched on the dispatcher loop)
+        self._breakers = {}          # model -> CircuitBreaker
+        self._breakers_lock = threading.Lock()
+        self._in_flight = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-dispatcher", daemon=True)
+        self._thread.start()
+
+    # --- Building blocks (run on the dispatcher loop) ---
+    def _model_semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._model_semaphores:
+            self._model_semaphores[model] = asyncio.Semaphore(self.max_concurrency_per_model)
+        return self._model_semaphores[model]
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        with self._breakers_lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_reset_s)
+            return self._breakers[model]
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+
+    def _has_free_slot(self, model: str) -> bool:
+        return not self._global_semaphore.locked() and not self._model_semaphore(model).locked()
+
+    async def _acquire(self, model: str):
+        """Takes a per-model and then a global slot (so calls queued on a busy model do not hold global ones);
+        the caller must call _release(model)."""
+        waited_from = time.perf_counter()
+        await self._model_semaphore(model).acquire()
+        try:
+            await self._global_semaphore.acquire()
+        except BaseException:
+            self._model_semaphore(model).release()
+            raise
+        metrics.observe("llm_queue_wait_seconds", time.perf_counter() - waited_from, model=model)
+        self._in_flight += 1
+
+    def _release(self, model: str):
+        self._in_flight -= 1
+        self._global_semaphore.release()
+        self._model_semaphore(model).release()
+
+    async def _attempt(self, backend, message: str, history: list) -> str:
+        model = backend.cache_model_name
+        await self._acquire(model)
+        try:
+            return await asyncio.wait_for(backend.agenerate(message, history), self.timeout_s)
+        finally:
+            self._release(model)
+
+    async def _hedged_attempt(self, backend, message: str, history: list) -> str:
+        model = backend.cache_model_name
+        primary = asyncio.ensure_future(self._attempt(backend, message, history))
+        tasks = [primary]
+        try:
+            if not self.hedge_after_s:
+                return await primary
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after_s)
+            # Under saturation a hedge would only queue behind other calls, so it is skipped
+            if done or not self._has_free_slot(model):
+                return await primary
+            metrics.inc("llm_hedged_requests_total", model=model)
+            hedge = asyncio.ensure_future(self._attempt(backend, message, history))
+            tasks.append(hedge)
+            pending, errors = set(tasks), {}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc("llm_hedge_wins_total", model=model)
+                        return task.result()
+                    errors[task] = task.exception()
+            raise errors[primary]
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _with_retries(self, backend, call, can_retry=None):
+        """Runs call() (one attempt) through the breaker, retrying retryable errors with backoff
+        (only while can_retry(), if given, returns True)."""
+        model = backend.cache_model_name
+        breaker = self._breaker(model)
+        for attempt in range(self.max_retries + 1):
+            if not breaker.allow():
+                metrics.inc("llm_circuit_rejections_total", model=model)
+                raise CircuitOpenError(f"Circuit breaker for {model} is open; not calling the model.")
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                breaker.abandon_probe()
+                raise
+            except Exception as e:
+                retryable = is_retryable(e)
+                if isinstance(e, TimeoutError):
+                    metrics.inc("llm_timeouts_total", model=model)
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    # A non-retryable error (bad request, missing key) means the provider did answer
+                    breaker.record_success()
+                if not retryable or attempt == self.max_retries or (can_retry and not can_retry()):
+                    raise
+                metrics.inc("llm_retries_total", model=model)
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            breaker.record_success()
+            return result
+
+    async def _generate(self, backend, message: str, history: list) -> str:
+        return await self._with_retries(backend, lambda: self._hedged_attempt(backend, message, history))
+
+    async def _stream_attempt(self, backend, message: str, history: list, emit, progress: dict):
+        model = backend.cache_model_name
+        await self._acquire(model)
+        try:
+            stream = backend.agenerate_stream(message, history)
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), self.timeout_s)
+                    except StopAsyncIteration:
+                        return
+                    progress["delivered"] = True
+                    emit(chunk)
+            finally:
+                await stream.aclose()
+        finally:
+            self._release(model)
+
+    async def _stream(self, backend, message: str, history: list, emit):
+        # Once part of the reply is out, repeating the call would duplicate it
+        progress = {"delivered": False}
+        await self._with_retries(backend, lambda: self._stream_attempt(backend, message, history, emit, progress),
+                                 can_retry=lambda: not progress["delivered"])
+
+    # --- Public API (any thread / any event loop) ---
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def generate(self, backend, message: str, history: list = None) -> str:
+        return self._submit(self._generate(backend, message, history)).result()
+
+    async def agenerate(self, backend, message: str, history: list = None) -> str:
+        return await asyncio.wrap_future(self._submit(self._generate(backend, message, history)))
+
+    def stream(self, backend, message: str, history: list = None):
+        """Yields reply chunks as they arrive; raises the call's error (if any) at the end."""
+        chunks, finished = queue.Queue(), object()
+        future = self._submit(self._stream(backend, message, history, chunks.put))
+        future.add_done_callback(lambda _: chunks.put(finished))
+        try:
+            while (chunk := chunks.get()) is not finished:
+                yield chunk
+            future.result()
+        finally:
+            future.cancel()  # the consumer stopped early (no-op once finished)
+
+    async def astream(self, backend, message: str, history: list = None):
+        loop = asyncio.get_running_loop()
+        chunks, finished = asyncio.Queue(), object()
+
+        def put(item):
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+
+        future = self._submit(self._stream(backend, message, history, put))
+        future.add_done_callback(lambda _: put(finished))
+        try:
+            while (chunk := await chunks.get()) is not finished:
+                yield chunk
+            future.result()
+        finally:
+            future.cancel()
+
+    def get_stats(self) -> dict:
+        with self._breakers_lock:
+            breakers = {model: breaker.to_dict() for model, breaker in self._breakers.items()}
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "max_concurrency_per_model": self.max_concurrency_per_model,
+            "timeout_s": self.timeout_s,
+            "max_retries": self.max_retries,
+            "hedge_after_s": self.hedge_after_s,
+            "breakers": breakers,
+        }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_llm_dispatcher() -> LLMDispatcher:
+    """Process-wide dispatcher, so the concurrency caps hold across agents and Streamlit sessions."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = LLMDispatcher()
+        return _dispatcher
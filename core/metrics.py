@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import random
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Seconds; the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Port for the /metrics (Prometheus text) and /metrics.json endpoints; unset = no HTTP exporter
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+# Hot-path log lines (per turn / per retrieval) are logged at DEBUG or INFO and sampled at this rate
+AGENT_LOG_LEVEL = os.getenv("AGENT_LOG_LEVEL", "WARNING").upper()
+AGENT_LOG_SAMPLE_RATE = float(os.getenv("AGENT_LOG_SAMPLE_RATE", "1.0"))
+
+METRIC_HELP = {
+    "agent_stage_seconds": "Time spent per pipeline stage of an agent turn.",
+    "llm_tokens_in_total": "Prompt tokens sent to the LLM (cl100k estimate).",
+    "llm_tokens_out_total": "Reply tokens received from the LLM (cl100k estimate).",
+    "llm_cache_hits_total": "Turns answered from the LLM response cache.",
+    "llm_cache_misses_total": "Turns that had to call the LLM.",
+    "llm_api_errors_total": "Failed LLM calls.",
+    "chunks_ingested_total": "Chunks committed to an agent's knowledge base.",
+    "ingestion_errors_total": "Knowledge ingestion failures, by stage (read, commit, batch).",
+    "retrieval_errors_total": "Turns whose RAG retrieval failed.",
+    "compaction_errors_total": "Agents whose knowledge compaction failed.",
+    "poll_errors_total": "Agents that failed to answer a poll.",
+    "llm_queue_wait_seconds": "Time an LLM call waited for a concurrency slot.",
+    "llm_retries_total": "LLM calls repeated after a retryable error.",
+    "llm_timeouts_total": "LLM call attempts that timed out.",
+    "llm_hedged_requests_total": "Duplicate LLM requests sent because the first was slow.",
+    "llm_hedge_wins_total": "Hedged LLM requests that answered before the original.",
+    "llm_circuit_rejections_total": "LLM calls rejected while the model's circuit breaker was open.",
+}
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (None if that is the +Inf bucket)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float("inf") else None
+        return None
+
+
+class MetricsRegistry:
+    """In-process counters and latency histograms, labelled by agent (and stage).
+
+    Everything is kept in plain dicts under one lock, so recording costs a dict lookup and an
+    addition; exporting (Prometheus text or a JSON snapshot) happens only when something asks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value, labels being a sorted tuple of (key, value)
+        self._histograms = {}  # (name, labels) -> _Histogram
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, stage: str, agent: str, into: dict = None):
+        """with metrics.timer("retrieval", agent_id): ... records the block's duration in agent_stage_seconds
+        (and under into[stage], if a dict is given)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe("agent_stage_seconds", elapsed, agent=agent, stage=stage)
+            if into is not None:
+                into[stage] = elapsed
+
+    def snapshot(self) -> dict:
+        """JSON-friendly copy: counters as {name: [{labels, value}]}, histograms with count/sum/p50/p95/buckets."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count, h.quantile(0.5), h.quantile(0.95))
+                          for key, h in self._histograms.items()}
+        result = {"uptime_s": time.time() - self.started_at, "counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), (counts, total, count, p50, p95) in sorted(histograms.items()):
+            result["histograms"].setdefault(name, []).append({
+                "labels": dict(labels), "count": count, "sum": total,
+                "mean": total / count if count else 0.0, "p50_le": p50, "p95_le": p95,
+                "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], counts)),
+            })
+        return result
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        def label_str(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+        lines, declared = [], set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_str(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{label_str(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{label_str(labels)} {total}")
+            lines.append(f"{name}_count{label_str(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters, self._histograms = {}, {}
+            self.started_at = time.time()
+
+
+metrics = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            body, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), "application/json"
+        elif self.path.startswith("/metrics"):
+            body, content_type = metrics.to_prometheus().encode('utf-8'), "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = "127.0.0.1"):
+    """Serves /metrics and /metrics.json on a daemon thread (once per process). Returns None if port is not set."""
+    global _metrics_server
+    if not port:
+        return None
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logging.getLogger("core.metrics").error("Could not start metrics exporter on %s:%s: %s", host, port, e)
+                return None
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-exporter", daemon=True).start()
+            logging.getLogger("core.metrics").info("Metrics exporter listening on http://%s:%s/metrics (JSON: /metrics.json)", host, port)
+        return _metrics_server
+
+
+# --- Leveled, sampled logging for hot paths ---
+def get_logger(name: str) -> logging.Logger:
+    """Logger under the "core" hierarchy, whose level comes from AGENT_LOG_LEVEL."""
+    return logging.getLogger(name if name.startswith("core") else f"core.{name}")
+
+
+def log_sampled(logger: logging.Logger, level: int, message: str, *args):
+    """logger.log(level, message, *args) for a AGENT_LOG_SAMPLE_RATE share of calls.
+
+    Arguments are only formatted when the record is emitted, so a disabled level costs one check.
+    """
+    if logger.isEnabledFor(level) and (AGENT_LOG_SAMPLE_RATE >= 1.0 or random.random() < AGENT_LOG_SAMPLE_RATE):
+        logger.log(level, message, *args)
+
+
+_core_logger = logging.getLogger("core")
+_core_logger.setLevel(getattr(logging, AGENT_LOG_LEVEL, logging.WARNING))
+if not _core_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _core_logger.addHandler(_handler)
+    _core_logger.propagate = False
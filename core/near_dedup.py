@@ -0,0 +1,91 @@
+import re
+import hashlib
+import numpy as np
+
+SIMHASH_BITS = 64
+# Eight 8-bit bands: two fingerprints within 7 bits of each other always share at least one band exactly
+_BANDS = 8
+_BAND_BITS = SIMHASH_BITS // _BANDS
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Texts shorter than this have too few shingles for a SimHash match to mean much; they are only deduplicated exactly
+NEAR_DUP_MIN_WORDS = 12
+
+
+def _shingles(text: str, size: int) -> list:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+def word_count(text: str) -> int:
+    return len(_WORD_RE.findall(text))
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """64-bit SimHash over word shingles; near-identical texts get fingerprints a few bits apart."""
+    shingles = _shingles(text, shingle_size)
+    if not shingles:
+        return 0
+    digests = b"".join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+    # One row of 64 bits per shingle (bit 0 = least significant bit of the big-endian digest)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), 8)[:, ::-1], axis=1, bitorder='little')
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return int(np.packbits(votes, bitorder='little')[::-1].tobytes().hex(), 16)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateIndex:
+    """SimHash fingerprints keyed by an ID, bucketed by band for sub-linear near-duplicate lookup.
+
+    Two texts are near-duplicates when their fingerprints differ in at most max_distance bits
+    (max_distance must stay below the number of bands for lookups to be exact).
+    """
+
+    def __init__(self, max_distance: int = 6, fingerprints: dict = None):
+        self.max_distance = min(max_distance, _BANDS - 1)
+        self.fingerprints = {}
+        self._buckets = {}
+        for key, fingerprint in (fingerprints or {}).items():
+            self.add(key, int(fingerprint, 16) if isinstance(fingerprint, str) else fingerprint)
+
+    @staticmethod
+    def _bands(fingerprint: int):
+        mask = (1 << _BAND_BITS) - 1
+        return [(band, (fingerprint >> (band * _BAND_BITS)) & mask) for band in range(_BANDS)]
+
+    def find(self, fingerprint: int) -> str | None:
+        """Key of an indexed near-duplicate of fingerprint, or None."""
+        for band in self._bands(fingerprint):
+            for key in self._buckets.get(band, ()):
+                if hamming_distance(self.fingerprints[key], fingerprint) <= self.max_distance:
+                    return key
+        return None
+
+    def add(self, key: str, fingerprint: int):
+        if key in self.fingerprints:
+            return
+        self.fingerprints[key] = fingerprint
+        for band in self._bands(fingerprint):
+            self._buckets.setdefault(band, []).append(key)
+
+    def remove(self, keys):
+        for key in keys:
+            fingerprint = self.fingerprints.pop(key, None)
+            if fingerprint is None:
+                continue
+            for band in self._bands(fingerprint):
+                bucket = self._buckets.get(band)
+                if bucket is not None:
+                    bucket.remove(key)
+                    if not bucket:
+                        del self._buckets[band]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def to_dict(self) -> dict:
+        return {key: f"{fingerprint:016x}" for key, fingerprint in self.fingerprints.items()}
@@ -0,0 +1,174 @@
+import logging
+import os
+import time
+import asyncio
+import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from core.utils import clean_text
+from core.metrics import get_logger, log_sampled
+
+logger = get_logger(__name__)
+
+NEWSAPI_BASE_URL = os.getenv("NEWSAPI_BASE_URL", "https://newsapi.org/v2")
+
+
+class TokenBucket:
+    """Asyncio token bucket: `rate` requests per second with bursts of up to `capacity`.
+
+    Tokens are reserved before sleeping, so callers are released in arrival order
+    without needing a lock (everything runs on one event loop thread).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def parse_newsapi_article(article_newsapi: dict) -> dict:
+    content_for_rag = article_newsapi.get('content', '') or article_newsapi.get('description', '')
+    if content_for_rag and "[+" in content_for_rag and " chars]" in content_for_rag:
+        content_for_rag = content_for_rag.split("[+")[0].strip()
+    return {
+        "title": clean_text(article_newsapi.get('title') or ""),
+        "link": article_newsapi.get('url'),
+        "content": clean_text(content_for_rag or ""),
+        "source": article_newsapi['source']['name'] if article_newsapi.get('source') else "NewsAPI",
+        "published_at": article_newsapi.get('publishedAt'),
+        "fetch_date": datetime.date.today().strftime("%Y-%m-%d")
+    }
+
+
+class NewsFetchEngine:
+    """Runs NewsAPI requests concurrently over one pooled HTTP session.
+
+    Requests are limited by a token bucket (rate_per_sec/burst) and a concurrency cap.
+    Each request's latency is recorded in `request_log`. Point base_url at a local
+    server that mimics /everything and /top-headlines to test without the real API.
+    """
+
+    def __init__(self, api_key: str, base_url: str = NEWSAPI_BASE_URL, rate_per_sec: float = 5.0, burst: float = None,
+                 max_concurrency: int = 8, timeout_s: float = 15.0):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.timeout_s = timeout_s
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"X-Api-Key": api_key or ""})
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="newsapi")
+        self._log_lock = threading.Lock()
+        self.request_log = deque(maxlen=1000)
+
+    def _build_request(self, query: str = None, sources: str = None, category: str = None, language: str = 'en',
+                       country: str = None, page_size: int = 20, from_param: str = None):
+        if query:
+            params = {"q": query, "sources": sources, "language": language, "sortBy": "publishedAt",
+                      "pageSize": page_size, "from": from_param}
+            return f"{self.base_url}/everything", params
+        if sources or category or country:
+            params = {"sources": sources, "category": category, "language": language, "country": country,
+                      "pageSize": page_size}
+            return f"{self.base_url}/top-headlines", params
+        return None, None
+
+    def _get(self, url: str, params: dict) -> dict:
+        params = {key: value for key, value in params.items() if value is not None}
+        response = self.session.get(url, params=params, timeout=self.timeout_s)
+        try:
+            return response.json()
+        except ValueError:
+            return {"status": "error", "code": response.status_code, "message": response.text[:200]}
+
+    async def fetch(self, config_item: dict, agent_id: str = None, rate_limiter: TokenBucket = None) -> list:
+        """Fetches one NewsAPI config (query/sources/category/country/...) and returns parsed articles."""
+        url, params = self._build_request(
+            query=config_item.get('query'), sources=config_item.get('sources'), category=config_item.get('category'),
+            language=config_item.get('language', 'en'), country=config_item.get('country'),
+            page_size=config_item.get('page_size', 10), from_param=config_item.get('from_param')
+        )
+        if url is None:
+            logger.warning("Skipping invalid NewsAPI config for %s: %s", agent_id, config_item)
+            return []
+        if rate_limiter:
+            await rate_limiter.acquire()
+
+        started = time.perf_counter()
+        status, articles_data = "ok", []
+        try:
+            api_response = await asyncio.get_running_loop().run_in_executor(self._executor, self._get, url, params)
+            if api_response.get('status') == 'ok':
+                articles_data = [parse_newsapi_article(a) for a in api_response.get('articles', [])]
+            else:
+                status = f"error:{api_response.get('code')}"
+                logger.error("Error from NewsAPI for %s: %s - %s", agent_id, api_response.get('code'), api_response.get('message'))
+        except Exception as e:
+            status = f"exception:{type(e).__name__}"
+            logger.error("An error occurred while fetching from NewsAPI for %s: %s", agent_id, e)
+        latency_s = time.perf_counter() - started
+
+        with self._log_lock:
+            self.request_log.append({
+                "agent_id": agent_id, "config": config_item, "status": status,
+                "articles": len(articles_data), "latency_s": latency_s,
+            })
+        log_sampled(logger, logging.DEBUG, "NewsAPI [%s] %s %d articles in %.0f ms (%s)", agent_id, status, len(articles_data), latency_s * 1000, config_item)
+        return articles_data
+
+    async def fetch_configs(self, jobs: list) -> list:
+        """Fetches (agent_id, config_item) jobs concurrently. Returns one article list per job, in job order."""
+        rate_limiter = TokenBucket(self.rate_per_sec, self.burst)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_one(agent_id, config_item):
+            async with semaphore:
+                return await self.fetch(config_item, agent_id=agent_id, rate_limiter=rate_limiter)
+
+        return await asyncio.gather(*(run_one(agent_id, config_item) for agent_id, config_item in jobs))
+
+    async def fetch_all(self, agent_news_config: dict) -> dict:
+        """Fetches every config of every agent concurrently. Returns {agent_id: [articles...]} in config order."""
+        jobs = [(agent_id, config_item) for agent_id, configs in agent_news_config.items() for config_item in configs]
+        results = await self.fetch_configs(jobs)
+        articles_by_agent = {agent_id: [] for agent_id in agent_news_config}
+        for (agent_id, _), articles in zip(jobs, results):
+            articles_by_agent[agent_id].extend(articles)
+        return articles_by_agent
+
+    def latency_summary(self) -> dict:
+        with self._log_lock:
+            latencies = sorted(entry["latency_s"] for entry in self.request_log)
+            errors = sum(1 for entry in self.request_log if entry["status"] != "ok")
+        if not latencies:
+            return {"requests": 0, "errors": 0}
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "llm_cache/")
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "86400"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "50"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+def prompt_fingerprint(model_name: str, generation_config: dict, system_prompt: str, message: str,
+                       conversation_history: list = None) -> str:
+    """sha256 over everything that determines the LLM reply for one turn.
+
+    `message` is the full user message sent for the turn, which already embeds the RAG context and the query.
+    """
+    payload = {
+        "model": model_name,
+        "generation_config": generation_config or {},
+        "system_prompt": system_prompt,
+        "message": message,
+        "history": [list(turn) for turn in (conversation_history or [])],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Disk-backed cache of LLM replies, one JSON file per prompt fingerprint.
+
+    Layout: <cache_dir>/<fp[:2]>/<fp>.json holding {"created_at", "model", "response"}.
+    Entries older than ttl_s are treated as misses and deleted. When the cache grows past
+    max_bytes the least recently used entries (by file mtime, refreshed on every hit) are evicted.
+    The index of entries is built from the directory on first use, so it is shared across restarts.
+    """
+
+    def __init__(self, cache_dir: str = LLM_CACHE_DIR, ttl_s: float = LLM_CACHE_TTL_S, max_bytes: int = int(LLM_CACHE_MAX_MB * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # fingerprint -> [size_bytes, last_used]
+        self._total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+    def _path(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, fingerprint[:2], f"{fingerprint}.json")
+
+    def _ensure_index(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        self._total_bytes = 0
+        if not os.path.isdir(self.cache_dir):
+            return
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".json"):
+                    continue
+                stat = entry.stat()
+                self._index[entry.name[:-5]] = [stat.st_size, stat.st_mtime]
+                self._total_bytes += stat.st_size
+
+    def _drop(self, fingerprint: str):
+        size, _ = self._index.pop(fingerprint, (0, 0))
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(fingerprint))
+        except OSError:
+            pass
+
+    def get(self, fingerprint: str) -> str | None:
+        with self._lock:
+            self._ensure_index()
+            if fingerprint not in self._index:
+                self.stats["misses"] += 1
+                return None
+            try:
+                with open(self._path(fingerprint), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except Exception as e:
+                logger.warning("Error reading LLM cache entry %s: %s. Dropping it.", fingerprint, e)
+                self._drop(fingerprint)
+                self.stats["misses"] += 1
+                return None
+            if self.ttl_s and time.time() - entry.get("created_at", 0) > self.ttl_s:
+                self._drop(fingerprint)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            now = time.time()
+            self._index[fingerprint][1] = now
+            try:
+                os.utime(self._path(fingerprint), (now, now))
+            except OSError:
+                pass
+            self.stats["hits"] += 1
+            return entry.get("response")
+
+    def put(self, fingerprint: str, response: str, model_name: str = None):
+        data = json.dumps({"created_at": time.time(), "model": model_name, "response": response}, ensure_ascii=False)
+        path = self._path(fingerprint)
+        with self._lock:
+            self._ensure_index()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error("Error writing LLM cache entry %s: %s", fingerprint, e)
+                return
+            size = os.path.getsize(path)
+            old_size, _ = self._index.get(fingerprint, (0, 0))
+            self._index[fingerprint] = [size, time.time()]
+            self._total_bytes += size - old_size
+            self.stats["stores"] += 1
+            self._evict()
+
+    def _evict(self):
+        if not self.max_bytes or self._total_bytes <= self.max_bytes:
+            return
+        for fingerprint, _ in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._drop(fingerprint)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._ensure_index()
+            for fingerprint in list(self._index):
+                self._drop(fingerprint)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._ensure_index()
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                entries=len(self._index),
+                bytes=self._total_bytes,
+                hit_rate=self.stats["hits"] / lookups if lookups else 0.0,
+            )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Process-wide response cache configured from LLM_CACHE_* env vars, or None when LLM_CACHE_ENABLED is off."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,125 @@
+import re
+
+# The prompt asks for <thinking>; older personas/prompts used <suy_nghĩ>
+THOUGHT_TAGS = ("thinking", "suy_nghĩ")
+# A block left open (e.g. the reply hit the token limit) runs to the end, as it does in StreamingResponseParser
+_THOUGHT_RE = re.compile(r"<(thinking|suy_nghĩ)>(.*?)(?:</\1>|\Z)", re.DOTALL | re.IGNORECASE)
+
+
+def parse_agent_response(response_text: str):
+    """Splits a full agent reply into (inner_thoughts, official_statement)."""
+    thought_match = _THOUGHT_RE.search(response_text)
+    inner_thoughts = None
+    official_statement = response_text
+
+    if thought_match:
+        inner_thoughts = thought_match.group(2).strip()
+        official_statement = response_text[thought_match.end():].strip()
+        if not official_statement and inner_thoughts: # Nếu chỉ có suy nghĩ
+             official_statement = "(Chỉ có suy nghĩ, không có phát biểu chính thức riêng biệt)"
+        elif not official_statement and not inner_thoughts: # Nếu cả hai đều trống sau khi parse
+             official_statement = "(Không có phản hồi nội dung)"
+
+    # Fallback nếu không có tag suy nghĩ nhưng có cấu trúc khác
+    elif "phát biểu chính thức:" in response_text.lower():
+        parts = re.split(r"phát biểu chính thức:", response_text, maxsplit=1, flags=re.IGNORECASE)
+        if len(parts) > 1:
+            potential_thoughts = parts[0].strip()
+            if potential_thoughts and not potential_thoughts.lower().startswith("bạn là"):
+                inner_thoughts = potential_thoughts
+            official_statement = parts[1].strip()
+
+    return inner_thoughts, official_statement
+
+
+def strip_thoughts(response_text: str) -> str:
+    """response_text without its <thinking>/<suy_nghĩ> blocks."""
+    return _THOUGHT_RE.sub("", response_text).strip()
+
+
+class StreamingResponseParser:
+    """Incrementally splits streamed reply chunks into ("thought", text) and ("statement", text) events.
+
+    Text before the opening tag is held back (up to max_preamble_chars) in case the
+    thinking block comes after a short preamble; without a tag everything is statement.
+    Partial tags at chunk boundaries are held back until the next chunk arrives.
+    """
+
+    def __init__(self, max_preamble_chars: int = 200):
+        self.max_preamble_chars = max_preamble_chars
+        self.state = "preamble"
+        self._buffer = ""
+        self._close_tag = None
+        self.thoughts = ""
+        self.statement = ""
+
+    def _emit(self, kind: str, text: str, events: list):
+        if not text:
+            return
+        if kind == "thought":
+            if not self.thoughts:
+                text = text.lstrip()
+                if not text:
+                    return
+            self.thoughts += text
+        else:
+            # The statement starts after the closing tag; drop the whitespace separating them
+            if not self.statement:
+                text = text.lstrip()
+                if not text:
+                    return
+            self.statement += text
+        events.append((kind, text))
+
+    @staticmethod
+    def _partial_tag_suffix(text: str, tags: list) -> int:
+        """Length of the longest suffix of text that is a proper prefix of one of the tags."""
+        lowered = text.lower()
+        longest = 0
+        for tag in tags:
+            for length in range(min(len(tag) - 1, len(lowered)), 0, -1):
+                if lowered.endswith(tag[:length]):
+                    longest = max(longest, length)
+                    break
+        return longest
+
+    def feed(self, chunk: str) -> list:
+        events = []
+        self._buffer += chunk
+        while self._buffer:
+            if self.state == "preamble":
+                lowered = self._buffer.lower()
+                open_positions = [(lowered.find(f"<{tag}>"), tag) for tag in THOUGHT_TAGS if f"<{tag}>" in lowered]
+                if open_positions:
+                    position, tag = min(open_positions)
+                    self._buffer = self._buffer[position + len(tag) + 2:]
+                    self._close_tag = f"</{tag}>"
+                    self.state = "thought"
+                    continue
+                if len(self._buffer) > self.max_preamble_chars:
+                    self.state = "statement"
+                    continue
+                break
+            if self.state == "thought":
+                position = self._buffer.lower().find(self._close_tag)
+                if position >= 0:
+                    self._emit("thought", self._buffer[:position], events)
+                    self._buffer = self._buffer[position + len(self._close_tag):]
+                    self.state = "statement"
+                    continue
+                hold = self._partial_tag_suffix(self._buffer, [self._close_tag])
+                self._emit("thought", self._buffer[:len(self._buffer) - hold], events)
+                self._buffer = self._buffer[len(self._buffer) - hold:]
+                break
+            # statement
+            self._emit("statement", self._buffer, events)
+            self._buffer = ""
+        return events
+
+    def finish(self) -> list:
+        """Flushes whatever is still held back at the end of the stream."""
+        events = []
+        if self._buffer:
+            self._emit("thought" if self.state == "thought" else "statement", self._buffer, events)
+            self._buffer = ""
+        return events
@@ -0,0 +1,79 @@
+import os
+import datetime
+
+
+def _env_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+# Global default (None = unlimited); a persona can override any of these under a `retention:` key
+DEFAULT_RETENTION_POLICY = {
+    "max_age_days": _env_int("RETENTION_MAX_AGE_DAYS"),       # drop articles published longer ago than this
+    "keep_latest_per_source": _env_int("RETENTION_KEEP_LATEST_PER_SOURCE"),  # newest N articles per news source
+    "max_chunks": _env_int("RETENTION_MAX_CHUNKS"),           # cap on the whole index, oldest articles go first
+}
+
+
+def resolve_retention_policy(persona: dict = None) -> dict:
+    policy = dict(DEFAULT_RETENTION_POLICY)
+    if persona and isinstance(persona.get("retention"), dict):
+        policy.update(persona["retention"])
+    return policy
+
+
+def policy_is_unlimited(policy: dict) -> bool:
+    return not any(policy.get(name) for name in ("max_age_days", "keep_latest_per_source", "max_chunks"))
+
+
+def parse_published_at(value) -> datetime.datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def select_expired(metadatas: list, policy: dict, now: datetime.datetime = None) -> set:
+    """Positions (into metadatas) of the chunks that policy no longer retains.
+
+    Only chunks with a parseable published_at (news articles) can expire; persona knowledge
+    files and other undated chunks are always kept. Per-source limits count articles, not chunks.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    dated = []
+    for position, metadata in enumerate(metadatas):
+        published = parse_published_at(metadata.get("published_at"))
+        if published is not None:
+            dated.append((published, position))
+    expired = set()
+
+    if policy.get("max_age_days"):
+        cutoff = now - datetime.timedelta(days=policy["max_age_days"])
+        expired.update(position for published, position in dated if published < cutoff)
+
+    if policy.get("keep_latest_per_source"):
+        articles_by_source = {}
+        for published, position in dated:
+            if position in expired:
+                continue
+            metadata = metadatas[position]
+            article = metadata.get("article_key") or metadata.get("link") or position
+            articles = articles_by_source.setdefault(metadata.get("source"), {})
+            articles.setdefault(article, [published, []])[1].append(position)
+        for articles in articles_by_source.values():
+            by_recency = sorted(articles.values(), key=lambda item: item[0], reverse=True)
+            for _, positions in by_recency[policy["keep_latest_per_source"]:]:
+                expired.update(positions)
+
+    if policy.get("max_chunks"):
+        excess = len(metadatas) - len(expired) - policy["max_chunks"]
+        for published, position in sorted(dated):
+            if excess <= 0:
+                break
+            if position not in expired:
+                expired.add(position)
+                excess -= 1
+    return expired
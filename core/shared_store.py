@@ -0,0 +1,367 @@
+import os
+import time
+import random
+import shutil
+import threading
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from core.vector_index import (
+    resolve_index_profile, target_index_type, index_type_of, create_index, apply_search_params,
+    needs_rebuild, load_profile_state, save_profile_state, benchmark_index_types, documents_in_index_order,
+    measure_search_latency, clone_vector_store
+)
+from core.retention import select_expired
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Chunks owned by this agent ID are visible to every agent
+SHARED_KNOWLEDGE_AGENT_ID = os.getenv("SHARED_KNOWLEDGE_AGENT_ID", "general_knowledge")
+
+
+class SharedStoreRetriever:
+    """Retriever over one agent's slice of a SharedKnowledgeStore (its own chunks plus the shared ones)."""
+
+    def __init__(self, store: "SharedKnowledgeStore", agent_id: str, k: int = 3):
+        self.store = store
+        self.agent_id = agent_id
+        self.k = k
+
+    def invoke(self, query: str) -> list:
+        return self.store.search(self.agent_id, query, k=self.k)
+
+    def invoke_by_vector(self, query_vector) -> list:
+        return self.store.search(self.agent_id, None, k=self.k, query_vector=query_vector)
+
+
+class SharedSnapshot:
+    """One published version of the shared FAISS store plus the owner lookups derived from it; never modified once built."""
+
+    def __init__(self, vector_store, version: int):
+        self.vector_store = vector_store
+        self.version = version
+        self.doc_id_by_hash, self.position_by_doc_id, self.owner_positions = {}, {}, {}
+        for position, doc_id in vector_store.index_to_docstore_id.items():
+            doc = vector_store.docstore.search(doc_id)
+            if isinstance(doc, str):
+                continue
+            self.position_by_doc_id[doc_id] = position
+            if doc.metadata.get("chunk_hash"):
+                self.doc_id_by_hash[doc.metadata["chunk_hash"]] = doc_id
+            for owner in doc.metadata.get("agents", []):
+                self.owner_positions.setdefault(owner, []).append(position)
+        # Filled lazily by searches; only a cache, so concurrent readers may both fill an entry
+        self.selectors = {}
+
+
+class SharedKnowledgeStore:
+    """One FAISS index holding the chunks of every agent, each tagged with its owning agent IDs.
+
+    A chunk is stored once, keyed by its content hash; when another agent ingests the same
+    chunk its ID is just added to the chunk's `agents` metadata. Searches are restricted
+    to the caller's chunks plus SHARED_KNOWLEDGE_AGENT_ID's with a faiss IDSelector, so an
+    agent's retrieval is a single filtered query. Ingestion manifests live under
+    <store_path>/manifests/ instead of one directory per agent.
+
+    Searches take no lock: they read the current SharedSnapshot once. Writers (serialized by
+    self._lock) build the next snapshot on a copy and publish it by swapping the reference; a
+    re-index triggered by a write is built from the published snapshot outside the lock.
+    """
+
+    def __init__(self, store_path: str, embeddings_model, shared_owner_id: str = SHARED_KNOWLEDGE_AGENT_ID):
+        self.store_path = store_path
+        self.embeddings_model = embeddings_model
+        self.shared_owner_id = shared_owner_id
+        self.index_profile = resolve_index_profile()
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._index_trained_on = 0
+        self._reindexing = False  # a re-index is running outside self._lock (see _reindex_and_swap)
+        self._load()
+
+    @property
+    def vector_store(self):
+        return self._snapshot.vector_store
+
+    def _publish(self, vector_store):
+        previous = self._snapshot
+        self._snapshot = SharedSnapshot(vector_store, version=previous.version + 1 if previous else 1)
+
+    def manifest_path(self, agent_id: str) -> str:
+        return os.path.join(self.store_path, "manifests", f"{agent_id}.json")
+
+    # --- Loading / persistence ---
+    def _load(self):
+        vector_store = None
+        if os.path.exists(os.path.join(self.store_path, "index.faiss")):
+            try:
+                logger.info("Loading shared VectorDB from %s", self.store_path)
+                vector_store = FAISS.load_local(self.store_path, self.embeddings_model, allow_dangerous_deserialization=True)
+                if vector_store.index.ntotal != len(vector_store.index_to_docstore_id):
+                    raise ValueError("index.faiss and index.pkl are out of sync")
+                self._index_trained_on = load_profile_state(self.store_path).get("trained_on", vector_store.index.ntotal)
+                apply_search_params(vector_store.index, self.index_profile)
+            except Exception as e:
+                # The per-agent manifests are wiped with it, so the next update re-ingests everything
+                logger.error("Error loading shared VectorDB from %s: %s. Starting with an empty shared store.", self.store_path, e)
+                shutil.rmtree(os.path.join(self.store_path, "manifests"), ignore_errors=True)
+                vector_store = None
+        if vector_store is None:
+            vector_store = self._empty_store()
+        self._publish(vector_store)
+
+    def _empty_store(self, dim: int = None):
+        dim = dim or len(self.embeddings_model.embed_query("dimension probe"))
+        return FAISS(embedding_function=self.embeddings_model, index=faiss.IndexFlatL2(dim),
+                     docstore=InMemoryDocstore(), index_to_docstore_id={})
+
+    def _save(self, vector_store):
+        tmp_dir = f"{self.store_path}.tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        vector_store.save_local(tmp_dir)
+        os.makedirs(self.store_path, exist_ok=True)
+        for file_name in ("index.faiss", "index.pkl"):
+            os.replace(os.path.join(tmp_dir, file_name), os.path.join(self.store_path, file_name))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        save_profile_state(self.store_path, index_type_of(vector_store.index), self._index_trained_on or vector_store.index.ntotal)
+
+    def _maybe_reindex(self, vector_store):
+        """vector_store, or a rebuilt store when its chunk count calls for another index type (or an IVF retrain).
+
+        Only reads vector_store; the caller saves and publishes the result.
+        """
+        index = vector_store.index
+        if not needs_rebuild(self.index_profile, index, self._index_trained_on):
+            return vector_store
+        target = target_index_type(self.index_profile, index.ntotal)
+        logger.info("Re-indexing shared store: %s -> %s (%d chunks)...", index_type_of(index), target, index.ntotal)
+        documents = documents_in_index_order(vector_store.docstore, vector_store.index_to_docstore_id)
+        return self._build(documents, target)
+
+    def _build(self, documents: list, index_type: str):
+        """Fresh store over documents, trained on all of them; vectors are read through the chunk embedding cache (see
+        CharacterAgent._build_vector_store). Touches no store state; the caller records _index_trained_on."""
+        texts = [doc.page_content for doc in documents]
+        embeddings = self.embeddings_model.embed_documents(texts)
+        vector_store = FAISS(embedding_function=self.embeddings_model,
+                             index=create_index(index_type, self.index_profile, np.asarray(embeddings, dtype=np.float32)),
+                             docstore=InMemoryDocstore(), index_to_docstore_id={})
+        vector_store.add_embeddings(list(zip(texts, embeddings)), metadatas=[doc.metadata for doc in documents])
+        return vector_store
+
+    # --- Writes ---
+    def add_chunks(self, agent_id: str, pending_chunks: list, embed_batch_size: int = 256) -> int:
+        """Adds (text, chunk_hash, metadata) triples for agent_id and persists. Returns the number of chunks newly embedded."""
+        if not pending_chunks:
+            return 0
+        known_hashes = self._snapshot.doc_id_by_hash
+        new_chunks = [chunk for chunk in pending_chunks if chunk[1] not in known_hashes]
+        texts = [text for text, _, _ in new_chunks]
+        embeddings = []
+        for start in range(0, len(texts), embed_batch_size):
+            embeddings.extend(self.embeddings_model.embed_documents(texts[start:start + embed_batch_size]))
+
+        with self._lock:
+            snapshot = self._snapshot
+            claimed = 0
+            to_add = []
+            for (text, chunk_hash, metadata), embedding in zip(new_chunks, embeddings):
+                if chunk_hash not in snapshot.doc_id_by_hash:
+                    to_add.append((text, embedding, dict(metadata, chunk_hash=chunk_hash, agents=[agent_id])))
+            new_hashes = {metadata["chunk_hash"] for _, _, metadata in to_add}
+            # Chunks already stored (by another agent) just gain an owner
+            claims = {}
+            for _, chunk_hash, _ in pending_chunks:
+                if chunk_hash in new_hashes or chunk_hash not in snapshot.doc_id_by_hash:
+                    continue
+                doc_id = snapshot.doc_id_by_hash[chunk_hash]
+                doc = snapshot.vector_store.docstore.search(doc_id)
+                if not isinstance(doc, str) and agent_id not in doc.metadata.get("agents", []):
+                    # A new Document, since the published one may be in the middle of being read
+                    claims[doc_id] = Document(page_content=doc.page_content,
+                                              metadata=dict(doc.metadata, agents=doc.metadata.get("agents", []) + [agent_id]))
+            claimed = len(claims)
+            if to_add or claims:
+                vector_store = clone_vector_store(snapshot.vector_store)
+                if claims:
+                    vector_store.docstore.delete(list(claims))
+                    vector_store.docstore.add(claims)
+                if to_add:
+                    vector_store.add_embeddings([(text, embedding) for text, embedding, _ in to_add],
+                                                metadatas=[metadata for _, _, metadata in to_add])
+                self._save(vector_store)
+                self._publish(vector_store)
+            reindex_from = None
+            if to_add and not self._reindexing and needs_rebuild(self.index_profile, self.vector_store.index, self._index_trained_on):
+                self._reindexing = True
+                reindex_from = self.vector_store
+        logger.info("Shared store: %d new chunks for %s, %d existing chunks now shared with it.", len(to_add), agent_id, claimed)
+        if reindex_from is not None:
+            self._reindex_and_swap(reindex_from)
+        return len(to_add)
+
+    def _reindex_and_swap(self, vector_store):
+        """Rebuilds the published vector_store without holding self._lock, then swaps the result in.
+
+        If a write published a newer store in the meantime, the rebuild is redone from that store.
+        """
+        try:
+            while True:
+                rebuilt = self._maybe_reindex(vector_store)
+                with self._lock:
+                    current = self.vector_store
+                    if current is vector_store:
+                        if rebuilt is not vector_store:
+                            self._index_trained_on = rebuilt.index.ntotal
+                            self._save(rebuilt)
+                            self._publish(rebuilt)
+                        self._reindexing = False
+                        return
+                    if not needs_rebuild(self.index_profile, current.index, self._index_trained_on):
+                        self._reindexing = False
+                        return
+                    vector_store = current
+                logger.debug("Shared store re-index raced a write; rebuilding from the newer store.")
+        except Exception as e:
+            with self._lock:
+                self._reindexing = False
+            logger.error("Error re-indexing the shared store: %s. Keeping the current index.", e)
+
+    # --- Reads ---
+    def _selector_for(self, snapshot: SharedSnapshot, agent_id: str):
+        selector = snapshot.selectors.get(agent_id)
+        if selector is None:
+            positions = set(snapshot.owner_positions.get(agent_id, [])) | set(snapshot.owner_positions.get(self.shared_owner_id, []))
+            ids = np.array(sorted(positions), dtype=np.int64)
+            selector = (faiss.IDSelectorBatch(ids), len(ids))
+            snapshot.selectors[agent_id] = selector
+        return selector
+
+    def _search_params(self, index, selector):
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.index_profile["ef_search"])
+        if isinstance(index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=min(self.index_profile["nprobe"], index.nlist))
+        return faiss.SearchParameters(sel=selector)
+
+    def search(self, agent_id: str, query: str, k: int = 3, query_vector=None) -> list:
+        """k nearest chunks visible to agent_id; query_vector (already embedded query) skips embedding query."""
+        if query_vector is None:
+            query_vector = self.embeddings_model.embed_query(query)
+        query_vector = np.asarray([query_vector], dtype=np.float32)
+        snapshot = self._snapshot
+        vector_store = snapshot.vector_store
+        selector, visible = self._selector_for(snapshot, agent_id)
+        if not visible:
+            return []
+        _, positions = vector_store.index.search(query_vector, min(k, visible), params=self._search_params(vector_store.index, selector))
+        documents = []
+        for position in positions[0]:
+            if position < 0:
+                continue
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[int(position)])
+            if not isinstance(doc, str):
+                documents.append(doc)
+        return documents
+
+    def retriever_for(self, agent_id: str, k: int = 3) -> SharedStoreRetriever:
+        return SharedStoreRetriever(self, agent_id, k)
+
+    def index_report(self, n_queries: int = 200, k: int = 3) -> list:
+        vector_store = self.vector_store
+        documents = documents_in_index_order(vector_store.docstore, vector_store.index_to_docstore_id)
+        vectors = np.asarray(self.embeddings_model.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        return benchmark_index_types(vectors, self.index_profile, n_queries=n_queries, k=k)
+
+    def rebuild(self) -> int:
+        with self._lock:
+            documents = documents_in_index_order(self.vector_store.docstore, self.vector_store.index_to_docstore_id)
+            started = time.perf_counter()
+            vector_store = self._build(documents, target_index_type(self.index_profile, len(documents)))
+            self._index_trained_on = len(documents)
+            self._save(vector_store)
+            self._publish(vector_store)
+        logger.info("Rebuilt shared VectorDB: %d documents in %.2fs.", len(documents), time.perf_counter() - started)
+        return len(documents)
+
+    def _index_size_bytes(self) -> int:
+        return sum(os.path.getsize(os.path.join(self.store_path, name)) for name in ("index.faiss", "index.pkl")
+                   if os.path.exists(os.path.join(self.store_path, name)))
+
+    def compact(self, policies: dict, now=None, latency_queries: int = 50, manifests: dict = None) -> dict:
+        """Applies each agent's retention policy ({agent_id: policy}) to the chunks it owns.
+
+        An expired chunk loses that owner; chunks left without owners are removed and the index
+        is rebuilt off to the side and swapped in. The ingestion manifests given as
+        {agent_id: IngestionManifest} forget the chunks their agent lost. Returns a before/after report.
+        """
+        report = {"agents": sorted(policies), "policies": policies}
+        with self._lock:
+            started = time.perf_counter()
+            snapshot = self._snapshot
+            old_store = snapshot.vector_store
+            positions = sorted(old_store.index_to_docstore_id)
+            documents = {position: old_store.docstore.search(old_store.index_to_docstore_id[position]) for position in positions}
+            owners = {position: list(doc.metadata.get("agents", [])) for position, doc in documents.items() if not isinstance(doc, str)}
+            released = 0
+            expired_by_agent = {}
+            for agent_id, policy in policies.items():
+                owned = [position for position in snapshot.owner_positions.get(agent_id, []) if position in owners]
+                expired = select_expired([documents[position].metadata for position in owned], policy, now)
+                for index in expired:
+                    owners[owned[index]].remove(agent_id)
+                    released += 1
+                if expired:
+                    expired_by_agent[agent_id] = (
+                        [documents[owned[index]].metadata for index in expired],
+                        [documents[position].metadata for index, position in enumerate(owned) if index not in expired],
+                    )
+            kept = [Document(page_content=documents[position].page_content, metadata=dict(documents[position].metadata, agents=owners[position]))
+                    for position in positions if owners.get(position)]
+            report.update(chunks_before=len(owners), ownerships_expired=released, bytes_before=self._index_size_bytes())
+            if not released:
+                report.update(chunks_after=len(owners), bytes_after=report["bytes_before"])
+                return report
+
+            if kept:
+                new_store = self._build(kept, target_index_type(self.index_profile, len(kept)))
+            else:
+                new_store = self._empty_store(old_store.index.d)
+            sample = random.sample(kept, min(latency_queries, len(kept)))
+            queries = np.asarray(self.embeddings_model.embed_documents([doc.page_content for doc in sample]), dtype=np.float32).reshape(len(sample), old_store.index.d)
+            report["latency_ms_before"] = measure_search_latency(old_store.index, queries)
+            report["latency_ms_after"] = measure_search_latency(new_store.index, queries)
+
+            self._index_trained_on = len(kept)
+            self._save(new_store)
+            self._publish(new_store)
+            for agent_id, manifest in (manifests or {}).items():
+                if agent_id in expired_by_agent:
+                    manifest.forget_expired(*expired_by_agent[agent_id])
+                    manifest.save()
+            report.update(chunks_after=len(kept), bytes_after=self._index_size_bytes(), seconds=time.perf_counter() - started)
+        logger.info("Compacted shared store: %d -> %d chunks, %.0f -> %.0f KB, %.3f -> %.3f ms/query.",
+                    report['chunks_before'], report['chunks_after'], report['bytes_before'] / 1024, report['bytes_after'] / 1024,
+                    report['latency_ms_before'], report['latency_ms_after'])
+        return report
+
+    def get_stats(self) -> dict:
+        snapshot = self._snapshot
+        vector_store = snapshot.vector_store
+        shared_chunks = 0
+        for doc_id in vector_store.index_to_docstore_id.values():
+            doc = vector_store.docstore.search(doc_id)
+            if not isinstance(doc, str) and len(doc.metadata.get("agents", [])) > 1:
+                shared_chunks += 1
+        return {
+            "chunks": vector_store.index.ntotal,
+            "index_type": index_type_of(vector_store.index),
+            "snapshot_version": snapshot.version,
+            "chunks_shared_by_several_agents": shared_chunks,
+            "chunks_per_agent": {owner: len(positions) for owner, positions in sorted(snapshot.owner_positions.items())},
+        }
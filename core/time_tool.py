@@ -1,5 +1,8 @@
 import datetime
 import pytz
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
 
 def get_current_time_vn():
     """Get current time in Vietnam timezone."""
@@ -14,5 +17,5 @@ def format_timestamp(timestamp: str):
         dt_vn = dt.astimezone(vn_tz)
         return dt_vn.strftime("%Y-%m-%d %H:%M:%S %Z")
     except Exception as e:
-        print(f"Error formatting timestamp {timestamp}: {e}")
+        logger.warning("Error formatting timestamp %s: %s", timestamp, e)
         return timestamp
\ No newline at end of file
@@ -0,0 +1,158 @@
+import time
+import uuid
+import threading
+import traceback
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+PROGRESS_FIELDS = ("fetched", "saved", "chunked", "embedded")
+
+
+class UpdateCancelled(Exception):
+    """Raised inside a job's work function once cancel() has been requested."""
+
+
+class UpdateJob:
+    """Handle for one background knowledge update: state, per-agent progress, result and cancellation.
+
+    The work function reports progress with job.report(agent_id, fetched=..., ...) and calls
+    job.check_cancelled() between steps; cancellation is cooperative, so the current step
+    (e.g. one agent's index commit) always finishes or is discarded as a whole.
+    """
+
+    def __init__(self, description: str = "knowledge update"):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.description = description
+        self.state = "queued"
+        self.phase = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.progress = {} # agent_id -> {"fetched", "saved", "chunked", "embedded"}
+        self._lock = threading.Lock()
+        self._cancel_requested = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def set_phase(self, phase: str):
+        self.phase = phase
+
+    def report(self, agent_id: str, **counts):
+        """Adds counts (fetched/saved/chunked/embedded) to agent_id's progress."""
+        with self._lock:
+            agent_progress = self.progress.setdefault(agent_id, dict.fromkeys(PROGRESS_FIELDS, 0))
+            for name, value in counts.items():
+                agent_progress[name] = agent_progress.get(name, 0) + value
+
+    def cancel(self) -> bool:
+        """Requests cancellation. Returns False if the job had already finished."""
+        if self.done:
+            return False
+        self._cancel_requested.set()
+        return True
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_requested.is_set()
+
+    def check_cancelled(self):
+        if self._cancel_requested.is_set():
+            raise UpdateCancelled(f"Job {self.job_id} was cancelled.")
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks until the job finishes (or timeout). Returns True if it finished."""
+        return self._done.wait(timeout)
+
+    def _finish(self, state: str, result=None, error: str = None):
+        self.state, self.result, self.error = state, result, error
+        self.finished_at = time.time()
+        self._done.set()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            progress = {agent_id: dict(counts) for agent_id, counts in self.progress.items()}
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "description": self.description,
+            "state": self.state,
+            "phase": self.phase,
+            "cancel_requested": self.cancel_requested,
+            "elapsed_s": end - self.started_at if self.started_at else 0.0,
+            "progress": progress,
+            "totals": {name: sum(counts.get(name, 0) for counts in progress.values()) for name in PROGRESS_FIELDS},
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class KnowledgeUpdateWorker:
+    """Runs knowledge updates on one daemon thread, one job at a time.
+
+    submit() while a job is queued or running returns that job instead of starting another,
+    so repeated button clicks and scheduler ticks coalesce into the update already under way.
+    """
+
+    def __init__(self, name: str = "knowledge-update-worker"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._current_job = None
+        self._thread = None
+        self._closed = False
+
+    def submit(self, work, description: str = "knowledge update") -> UpdateJob:
+        """Starts work(job) in the background, or returns the active job if one is still running."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The knowledge update worker has been shut down.")
+            if self._current_job is not None and not self._current_job.done:
+                logger.info("Knowledge update %s is already %s; not starting another.", self._current_job.job_id, self._current_job.state)
+                return self._current_job
+            job = UpdateJob(description)
+            self._current_job = job
+            self._thread = threading.Thread(target=self._run, args=(job, work), name=self.name, daemon=True)
+            self._thread.start()
+            return job
+
+    def _run(self, job: UpdateJob, work):
+        job.state, job.started_at = "running", time.time()
+        logger.info("Knowledge update %s started.", job.job_id)
+        try:
+            job.check_cancelled()
+            result = work(job)
+            job._finish("succeeded", result=result)
+        except UpdateCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            traceback.print_exc()
+            job._finish("failed", error=str(e))
+        (logger.error if job.state == "failed" else logger.info)(
+            "Knowledge update %s %s after %.1fs.", job.job_id, job.state, job.finished_at - job.started_at)
+
+    @property
+    def current_job(self) -> UpdateJob | None:
+        """The running job, or else the most recently finished one (None before the first update)."""
+        with self._lock:
+            return self._current_job
+
+    @property
+    def busy(self) -> bool:
+        job = self.current_job
+        return job is not None and not job.done
+
+    def shutdown(self, timeout: float = 30.0):
+        """Cancels the running job (if any) and waits up to timeout seconds for it to stop."""
+        with self._lock:
+            self._closed = True
+            job, thread = self._current_job, self._thread
+        if job is not None and not job.done:
+            job.cancel()
+        if thread is not None:
+            thread.join(timeout)
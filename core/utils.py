@@ -1,11 +1,48 @@
 import tiktoken
 import re
 import unicodedata
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+_token_encodings = {}
+
+class _ApproximateEncoding:
+    """Stand-in when a tiktoken encoding cannot be loaded (its BPE file is downloaded on first use): ~4 characters per token."""
+    name = "approx_4_chars"
+
+    def encode(self, text: str, **kwargs) -> list:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def encode_ordinary_batch(self, texts: list) -> list:
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+def get_token_encoding(encoding_name: str = "cl100k_base"):
+    """tiktoken encoding, loaded once per process; falls back to a character-based estimate if it cannot be loaded."""
+    encoding = _token_encodings.get(encoding_name)
+    if encoding is None:
+        try:
+            encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logger.warning("Could not load tiktoken encoding %s: %s. Approximating token counts (~4 chars/token).", encoding_name, e)
+            encoding = _ApproximateEncoding()
+        _token_encodings[encoding_name] = encoding
+    return encoding
 
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(get_token_encoding(encoding_name).encode(string, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int, encoding_name: str = "cl100k_base", keep_end: bool = False) -> str:
+    """The longest prefix (or, with keep_end, suffix) of text that fits in max_tokens tokens."""
+    encoding = get_token_encoding(encoding_name)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    max_tokens = max(max_tokens, 0)
+    return encoding.decode(tokens[len(tokens) - max_tokens:] if keep_end else tokens[:max_tokens])
 
 def clean_text(text: str) -> str:
     """Basic text cleaning."""
@@ -15,24 +52,6 @@ def clean_text(text: str) -> str:
     return text
 
 def split_text_into_chunks(text: str, max_tokens_per_chunk: int = 400, overlap: int = 50):
-    """Splits text into chunks with overlap, respecting sentence boundaries if possible."""
-    words = text.split()
-    chunks = []
-    current_chunk_words = []
-    current_tokens = 0
-
-    for word in words:
-        word_tokens = num_tokens_from_string(word + " ")
-        if current_tokens + word_tokens <= max_tokens_per_chunk:
-            current_chunk_words.append(word)
-            current_tokens += word_tokens
-        else:
-            chunks.append(" ".join(current_chunk_words))
-            # Start new chunk with overlap
-            overlap_words = current_chunk_words[-int(len(current_chunk_words) * (overlap / max_tokens_per_chunk)):] if overlap > 0 else [] # Rough overlap
-            current_chunk_words = overlap_words + [word]
-            current_tokens = num_tokens_from_string(" ".join(current_chunk_words) + " ")
-
-    if current_chunk_words:
-        chunks.append(" ".join(current_chunk_words))
-    return chunks
\ No newline at end of file
+    """Splits text into chunks of at most max_tokens_per_chunk tokens with overlap, on sentence boundaries where possible."""
+    from core.chunker import get_shared_chunker  # core.chunker imports this module
+    return get_shared_chunker(max_tokens_per_chunk, overlap).split_text(text)
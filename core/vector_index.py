@@ -0,0 +1,225 @@
+import os
+import time
+import json
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from core.metrics import get_logger
+
+logger = get_logger(__name__)
+
+# Global default; a persona can override any of these under a `vector_index:` key
+DEFAULT_INDEX_PROFILE = {
+    "type": os.getenv("VECTOR_INDEX_TYPE", "flat"),          # flat | hnsw | ivf_flat | ivf_pq
+    "min_chunks": int(os.getenv("VECTOR_INDEX_MIN_CHUNKS", "20000")),  # stay flat (exact) below this many chunks
+    "retrain_factor": 4.0,   # IVF indexes are retrained once they hold this many times the vectors they were trained on
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+    "nlist": 1024,           # upper bound; capped at ~4*sqrt(n) for smaller stores
+    "nprobe": 16,
+    "pq_m": 16,              # sub-quantizers; lowered to a divisor of the vector dimension
+    "pq_nbits": 8,
+}
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+PROFILE_FILE_NAME = "index_profile.json"
+
+
+def resolve_index_profile(persona: dict = None, overrides: dict = None) -> dict:
+    """Global defaults, updated with the persona's `vector_index` section and then explicit overrides."""
+    profile = dict(DEFAULT_INDEX_PROFILE)
+    if persona and isinstance(persona.get("vector_index"), dict):
+        profile.update(persona["vector_index"])
+    if overrides:
+        profile.update(overrides)
+    if profile["type"] not in INDEX_TYPES:
+        logger.warning("Unknown vector index type %r. Using flat.", profile['type'])
+        profile["type"] = "flat"
+    return profile
+
+
+def target_index_type(profile: dict, ntotal: int) -> str:
+    """Index type an agent with ntotal chunks should use under profile."""
+    return profile["type"] if ntotal >= profile["min_chunks"] else "flat"
+
+
+def index_type_of(index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def _nlist_for(profile: dict, ntotal: int) -> int:
+    return max(1, min(profile["nlist"], int(4 * np.sqrt(max(ntotal, 1))), ntotal // 39 or 1))
+
+
+def _pq_m_for(profile: dict, dim: int) -> int:
+    m = min(profile["pq_m"], dim)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def create_index(index_type: str, profile: dict, vectors: np.ndarray):
+    """Empty faiss index of index_type (L2, like LangChain's default), trained on vectors when the type needs it."""
+    dim = vectors.shape[1]
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, profile["hnsw_m"])
+        index.hnsw.efConstruction = profile["ef_construction"]
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = _nlist_for(profile, len(vectors))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            # faiss wants ~39 training points per PQ centroid (2**nbits of them)
+            nbits = min(profile["pq_nbits"], max(1, int(np.log2(max(len(vectors) // 39, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m_for(profile, dim), nbits)
+        index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+    else:
+        index = faiss.IndexFlatL2(dim)
+    apply_search_params(index, profile)
+    return index
+
+
+def apply_search_params(index, profile: dict):
+    """Sets the query-time knobs, which are not reliably restored from index.faiss."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = profile["ef_search"]
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(profile["nprobe"], index.nlist)
+
+
+def needs_rebuild(profile: dict, index, trained_on: int = None) -> bool:
+    ntotal = index.ntotal
+    current, target = index_type_of(index), target_index_type(profile, ntotal)
+    if current != target:
+        return True
+    if target.startswith("ivf") and trained_on and ntotal >= profile["retrain_factor"] * trained_on:
+        return True
+    return False
+
+
+def load_profile_state(vector_db_path: str) -> dict:
+    path = os.path.join(vector_db_path, PROFILE_FILE_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error("Error reading %s: %s", path, e)
+        return {}
+
+
+def save_profile_state(vector_db_path: str, index_type: str, trained_on: int):
+    path = os.path.join(vector_db_path, PROFILE_FILE_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"type": index_type, "trained_on": trained_on}, f)
+    os.replace(tmp_path, path)
+
+
+def documents_in_index_order(docstore, index_to_docstore_id: dict) -> list:
+    """Documents of a LangChain FAISS store ordered by their position in the faiss index."""
+    documents = []
+    for position in sorted(index_to_docstore_id):
+        doc = docstore.search(index_to_docstore_id[position])
+        if not isinstance(doc, str):  # InMemoryDocstore returns an error string for missing ids
+            documents.append(doc)
+    return documents
+
+
+def clone_vector_store(vector_store):
+    """Independent copy of a LangChain FAISS store (index, docstore and id map) that can be written while the original is searched."""
+    return FAISS(embedding_function=vector_store.embedding_function, index=faiss.clone_index(vector_store.index),
+                 docstore=InMemoryDocstore(dict(vector_store.docstore._dict)),
+                 index_to_docstore_id=dict(vector_store.index_to_docstore_id))
+
+
+class IndexSnapshot:
+    """One published version of an agent's FAISS store, never modified after it is published.
+
+    Writers build the next version on a copy (clone_vector_store or a rebuild) and publish
+    it by replacing the owner's snapshot reference. A query reads that reference once, so
+    it keeps searching a complete index even if a newer one is published meanwhile.
+    """
+
+    __slots__ = ("vector_store", "retriever", "version")
+
+    def __init__(self, vector_store, version: int, k: int = 3):
+        self.vector_store = vector_store
+        self.retriever = vector_store.as_retriever(search_kwargs={"k": k})
+        self.version = version
+
+
+def search_retriever(retriever, query: str, query_vector=None) -> list:
+    """retriever.invoke(query), or a search by query_vector (the query embedded once by the caller) when given.
+
+    Handles LangChain vector store retrievers and SharedStoreRetriever; anything else just gets the query.
+    """
+    if query_vector is None:
+        return retriever.invoke(query)
+    if hasattr(retriever, "invoke_by_vector"):
+        return retriever.invoke_by_vector(query_vector)
+    vectorstore = getattr(retriever, "vectorstore", None)
+    if vectorstore is not None and getattr(retriever, "search_type", "similarity") == "similarity":
+        return vectorstore.similarity_search_by_vector(list(query_vector), k=retriever.search_kwargs.get("k", 4))
+    return retriever.invoke(query)
+
+
+def measure_search_latency(index, queries: np.ndarray, k: int = 3) -> float:
+    """Mean milliseconds per single-vector search of queries against index."""
+    if len(queries) == 0 or index.ntotal == 0:
+        return 0.0
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query.reshape(1, -1), k)
+    return (time.perf_counter() - started) * 1000 / len(queries)
+
+
+def index_memory_bytes(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def benchmark_index_types(vectors: np.ndarray, profile: dict, index_types: tuple = INDEX_TYPES,
+                          n_queries: int = 200, k: int = 3, seed: int = 0) -> list:
+    """Recall@k and per-query latency of each index type against the exact flat index, over the given vectors.
+
+    Queries are stored vectors with a little noise added, which is close to how
+    near-duplicate news queries hit an agent's knowledge base.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)]
+    queries = (sample + rng.normal(scale=0.01, size=sample.shape)).astype(np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = create_index(index_type, profile, vectors)
+        index.add(vectors)
+        build_s = time.perf_counter() - started
+        latency_ms = measure_search_latency(index, queries, k)
+        _, found = index.search(queries, k)
+        hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+        report.append({
+            "type": index_type,
+            "recall_at_k": hits / (len(queries) * k),
+            "latency_ms": latency_ms,
+            "build_s": build_s,
+            "memory_mb": index_memory_bytes(index) / (1024 * 1024),
+        })
+    return report
@@ -10,31 +10,54 @@ if project_root_from_main not in sys.path:
 
 from core.agent_manager import AgentManager
 from core.data_pipeline import (
-    trigger_data_update, # Sử dụng hàm wrapper mới
-    AGENT_NEWSAPI_CONFIG # Import config
+    start_data_update, # Chạy cập nhật trên background worker của AgentManager
+    AGENT_NEWSAPI_CONFIG, # Import config
+    get_article_store
 )
+from core.article_store import format_article_text
+from core.chunker import benchmark_chunkers
+from core.metrics import start_metrics_server
+from core.response_parser import parse_agent_response, StreamingResponseParser
 
 # --- Configuration ---
 NATIONAL_PERSONA_DIR = "National/"
 PERSONAL_PERSONA_DIR = "Personal/"
 VECTOR_DB_BASE_DIR = "vector_stores/"
 RAW_DATA_DIR_BASE = "data_sources/raw_news/"
+# Giới hạn số vector store của agent được giữ trong bộ nhớ (không đặt = không giới hạn, không tự unload)
+MAX_LOADED_AGENTS = int(os.getenv("MAX_LOADED_AGENTS")) if os.getenv("MAX_LOADED_AGENTS") else None
+AGENT_IDLE_TIMEOUT_S = float(os.getenv("AGENT_IDLE_TIMEOUT_S")) if os.getenv("AGENT_IDLE_TIMEOUT_S") else None
+AGENT_MEMORY_BUDGET_MB = float(os.getenv("AGENT_MEMORY_BUDGET_MB")) if os.getenv("AGENT_MEMORY_BUDGET_MB") else None
+# per_agent: một FAISS index cho mỗi agent | shared: một index chung, lọc theo agent
+VECTOR_STORE_MODE = os.getenv("VECTOR_STORE_MODE", "per_agent")
+# sequential | parallel_opening | rounds
+DISCUSSION_MODE = os.getenv("DISCUSSION_MODE", "sequential")
+# Chu kỳ xoá các vector hết hạn theo retention policy và build lại index
+COMPACTION_INTERVAL_HOURS = float(os.getenv("COMPACTION_INTERVAL_HOURS", "24"))
 
 # --- Initialize Agent Manager ---
 print("Initializing Agent Manager for main execution...")
-manager = AgentManager(NATIONAL_PERSONA_DIR, PERSONAL_PERSONA_DIR, VECTOR_DB_BASE_DIR)
+manager = AgentManager(
+    NATIONAL_PERSONA_DIR, PERSONAL_PERSONA_DIR, VECTOR_DB_BASE_DIR,
+    max_loaded_agents=MAX_LOADED_AGENTS, idle_timeout_s=AGENT_IDLE_TIMEOUT_S, memory_budget_mb=AGENT_MEMORY_BUDGET_MB,
+    vector_store_mode=VECTOR_STORE_MODE
+)
 print("Agent Manager Initialized.")
+# Prometheus /metrics and /metrics.json, only if METRICS_PORT is set
+start_metrics_server()
 
 # --- Data Update Function for Scheduler ---
 def scheduled_job_wrapper():
     """Wrapper function to be called by the APScheduler."""
     print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] APScheduler is triggering data update...")
     try:
-        trigger_data_update(
+        # Coalesces with an update started by hand; the scheduler thread waits for it to finish
+        job = start_data_update(
             manager_instance=manager,
             raw_data_dir_base_path=RAW_DATA_DIR_BASE,
             agent_news_config_dict_param=AGENT_NEWSAPI_CONFIG
         )
+        job.wait()
     except Exception as e:
         print(f"Error during scheduled data update: {e}")
         import traceback
@@ -51,6 +74,54 @@ scheduler.add_job(
     id='data_update_job'
 )
 
+def compaction_job_wrapper():
+    """Drops vectors expired by the agents' retention policies and rebuilds their indexes (daily)."""
+    print(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] APScheduler is triggering knowledge compaction...")
+    try:
+        manager.compact_knowledge()
+    except Exception as e:
+        print(f"Error during scheduled compaction: {e}")
+        import traceback
+        traceback.print_exc()
+
+scheduler.add_job(
+    compaction_job_wrapper,
+    'interval',
+    hours=COMPACTION_INTERVAL_HOURS,
+    id='compaction_job'
+)
+
+def print_streamed_reply(manager, agent_id, question, conversation_history=None, show_thoughts=True):
+    """Prints an agent's reply as it streams in and returns the full raw text.
+
+    Inner thoughts are split off incrementally and printed on their own (or hidden
+    with show_thoughts=False); the statement follows under the agent's name.
+    """
+    agent_name = manager.get_agent_name(agent_id)
+    stream_parser = StreamingResponseParser()
+    reply_chunks = []
+    current = None
+
+    def print_events(events):
+        nonlocal current
+        for kind, text in events:
+            if kind == "thought" and not show_thoughts:
+                continue
+            if kind != current:
+                print(f"\n({agent_name} nghĩ): " if kind == "thought" else f"\n{agent_name}: ", end="", flush=True)
+                current = kind
+            print(text, end="", flush=True)
+
+    for chunk in manager.ask_single_agent_stream(agent_id, question, conversation_history):
+        reply_chunks.append(chunk)
+        print_events(stream_parser.feed(chunk))
+    print_events(stream_parser.finish())
+    if not stream_parser.statement:
+        # Chỉ có suy nghĩ hoặc trả lời rỗng: dùng thông báo fallback của parse_agent_response
+        print(f"\n{agent_name}: {parse_agent_response(''.join(reply_chunks))[1]}", end="")
+    print()
+    return "".join(reply_chunks)
+
 # --- Main Interaction Loop ---
 def main_cli_interaction():
     print("\nWelcome to the Multi-Agent Interaction System (CLI)!")
@@ -67,8 +138,16 @@ def main_cli_interaction():
         print("  ask <agent_id> \"<question>\"")
         print("  chat <agent_id>                       (Start continuous chat)")
         print("  discuss <agent_id1>,<agent_id2>[,<agent_id3>...] \"<topic>\"")
+        print("  poll <agent_id1>,<agent_id2>,...|all \"<question>\"  (Ask many agents at once; answers as they finish)")
         print("  agents                                (List available agents)")
-        print("  update_now                            (Manually trigger data update)")
+        print("  index_report <agent_id>               (Recall/latency of flat, HNSW, IVF and IVF-PQ indexes)")
+        print("  chunk_benchmark [<file>]              (Chunking throughput in MB/s on a file or the stored articles)")
+        print("  compact [<agent_id>]                  (Drop expired chunks and rebuild the index)")
+        print("  metrics                               (Per-stage latency and pipeline counters)")
+        print("  load_test <n> [<concurrency>] [<agent_id>,...]  (Uncached turns against the configured LLM backend)")
+        print("  update_now                            (Start a data update in the background)")
+        print("  update_status                         (Progress of the running/last data update)")
+        print("  update_cancel                         (Cancel the running data update)")
         print("  exit")
 
         user_input = input("Enter command: ").strip()
@@ -77,34 +156,124 @@ def main_cli_interaction():
             if scheduler.running:
                 print("Shutting down scheduler...")
                 scheduler.shutdown()
+            manager.shutdown()
             print("Exiting system.")
             break
         
         elif user_input.lower() == "agents":
             print("\nAvailable Agents:")
-            if manager.agents:
-                for agent_id, agent_instance in manager.agents.items():
-                    print(f"  - {agent_id} ({agent_instance.persona.get('full_name', 'N/A')})")
+            if manager.list_agent_ids():
+                for agent_id in manager.list_agent_ids():
+                    print(f"  - {agent_id} ({manager.get_agent_name(agent_id)})")
+                print(f"  Stats: {manager.get_agent_stats()}")
+                print(f"  LLM cache: {manager.get_llm_cache_stats()}")
+                print(f"  LLM dispatcher: {manager.get_llm_stats()}")
+                print(f"  Query embedding cache: {manager.get_embedding_stats()['query_cache']}")
             else:
                 print("  No agents loaded.")
 
         elif user_input.lower() == "update_now":
             print("Manually triggering data update...")
             try:
-                trigger_data_update(manager, RAW_DATA_DIR_BASE, AGENT_NEWSAPI_CONFIG)
+                job = start_data_update(manager, RAW_DATA_DIR_BASE, AGENT_NEWSAPI_CONFIG)
+                print(f"Data update {job.job_id} is {job.state}. Use 'update_status' to follow it.")
             except Exception as e:
                 print(f"Error during manual update: {e}")
                 import traceback
                 traceback.print_exc()
 
 
+        elif user_input.startswith("index_report "):
+            agent_id = user_input.split(" ", 1)[1].strip()
+            report = manager.get_index_report(agent_id)
+            if report is None:
+                print(f"Agent {agent_id} not found.")
+                continue
+            print(f"\n{'type':<10}{'recall@3':>10}{'ms/query':>10}{'build s':>10}{'MB':>10}")
+            for row in report:
+                print(f"{row['type']:<10}{row['recall_at_k']:>10.3f}{row['latency_ms']:>10.3f}{row['build_s']:>10.2f}{row['memory_mb']:>10.2f}")
+
+        elif user_input.lower() == "metrics":
+            snapshot = manager.get_metrics()
+            print(f"\n{'agent':<24}{'stage':<18}{'count':>7}{'mean ms':>10}{'p95 <= ms':>11}")
+            for row in snapshot["histograms"].get("agent_stage_seconds", []):
+                p95 = f"{row['p95_le'] * 1000:.0f}" if row["p95_le"] is not None else "inf"
+                print(f"{row['labels']['agent']:<24}{row['labels']['stage']:<18}{row['count']:>7}{row['mean'] * 1000:>10.1f}{p95:>11}")
+            for name, rows in snapshot["counters"].items():
+                print(f"  {name}: " + ", ".join(f"{row['labels'].get('agent', '-')}={row['value']:g}" for row in rows))
+
+        elif user_input.startswith("load_test "):
+            parts = user_input.split()
+            try:
+                n_requests = int(parts[1])
+                concurrency = int(parts[2]) if len(parts) > 2 else 4
+            except (IndexError, ValueError):
+                print("Invalid load_test command. Format: load_test <n> [<concurrency>] [<agent_id>,...]")
+                continue
+            agent_ids = parts[3].split(",") if len(parts) > 3 else manager.list_agent_ids()
+            result = manager.run_load_test(agent_ids, n_requests, concurrency)
+            if not result["requests"]:
+                print("No known agents to load test.")
+                continue
+            print(f"{result['requests']} requests over {result['agents']} agents, concurrency {result['concurrency']}: "
+                  f"{result['requests_per_s']:.1f} req/s, p50 {result['p50_s'] * 1000:.0f} ms, "
+                  f"p95 {result['p95_s'] * 1000:.0f} ms, max {result['max_s'] * 1000:.0f} ms (see 'metrics' for stages)")
+
+        elif user_input.lower() == "update_status":
+            status = manager.get_update_status()
+            if status is None:
+                print("No data update has run yet.")
+                continue
+            print(f"Update {status['job_id']}: {status['state']} ({status['phase']}), {status['elapsed_s']:.0f}s")
+            print(f"  {'agent':<28}{'fetched':>9}{'saved':>9}{'chunked':>9}{'embedded':>9}")
+            for agent_id, counts in status["progress"].items():
+                print(f"  {agent_id:<28}{counts['fetched']:>9}{counts['saved']:>9}{counts['chunked']:>9}{counts['embedded']:>9}")
+            if status["error"]:
+                print(f"  Error: {status['error']}")
+            if status["result"] and status["result"].get("ingest_failures"):
+                print(f"  Ingestion {status['result']['status']}, failed for: {', '.join(status['result']['ingest_failures'])}")
+
+        elif user_input.lower() == "update_cancel":
+            print("Cancellation requested." if manager.cancel_knowledge_update() else "No data update is running.")
+
+        elif user_input == "chunk_benchmark" or user_input.startswith("chunk_benchmark "):
+            path = user_input[len("chunk_benchmark"):].strip()
+            if path:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        texts = [f.read()]
+                except Exception as e:
+                    print(f"Could not read {path}: {e}")
+                    continue
+            else:
+                store = get_article_store(RAW_DATA_DIR_BASE)
+                texts = [format_article_text(record) for agent_id in store.agent_ids() for record in store.iter_records(agent_id)]
+            if not texts:
+                print("No text to benchmark: pass a file or run update_now first.")
+                continue
+            print(f"\n{'splitter':<30}{'chunks':>8}{'seconds':>10}{'MB/s':>10}")
+            for row in benchmark_chunkers(texts):
+                print(f"{row['splitter']:<30}{row['chunks']:>8}{row['seconds']:>10.3f}{row['mb_per_s']:>10.2f}")
+
+        elif user_input == "compact" or user_input.startswith("compact "):
+            agent_id = user_input[len("compact"):].strip()
+            if agent_id and not manager.has_agent(agent_id):
+                print(f"Agent {agent_id} not found.")
+                continue
+            reports = manager.compact_knowledge([agent_id] if agent_id else None)
+            for report in reports:
+                name = report.get("agent_id") or ",".join(report.get("agents", []))
+                print(f"  {name}: {report['chunks_before']} -> {report['chunks_after']} chunks, "
+                      f"{report['bytes_before'] / 1024:.0f} -> {report['bytes_after'] / 1024:.0f} KB"
+                      + (f", {report['latency_ms_before']:.3f} -> {report['latency_ms_after']:.3f} ms/query" if "latency_ms_after" in report else ""))
+
         elif user_input.startswith("ask "):
             try:
                 parts = user_input.split(" ", 2)
                 if len(parts) < 3: raise IndexError("Not enough parts")
                 agent_id = parts[1]
                 question = parts[2].strip('"')
-                manager.ask_single_agent(agent_id, question)
+                print_streamed_reply(manager, agent_id, question)
             except IndexError:
                 print("Invalid ask command. Format: ask <agent_id> \"<question>\"")
         
@@ -122,22 +291,42 @@ def main_cli_interaction():
 
                 print(f"\n--- Starting chat with {agent_to_chat.persona.get('full_name', agent_id_chat)} ---")
                 print("Type '!!endchat' to stop.")
-                chat_session_history = [] 
+                # Recent turns verbatim, older ones in a rolling summary (MEMORY_RECENT_TURNS / MEMORY_SUMMARY_EVERY)
+                chat_memory = agent_to_chat.new_conversation_memory()
                 while True:
                     user_chat_input = input(f"You ({agent_id_chat}): ")
                     if user_chat_input.lower() == "!!endchat":
                         print(f"--- Ending chat with {agent_id_chat} ---")
                         break
-                    ai_response_text = manager.ask_single_agent(agent_id_chat, user_chat_input, chat_session_history)
-                    chat_session_history.append((user_chat_input, ai_response_text))
-                    if len(chat_session_history) > 5: 
-                        chat_session_history.pop(0)
+                    ai_response_text = print_streamed_reply(manager, agent_id_chat, user_chat_input, chat_memory.history())
+                    chat_memory.add_turn(user_chat_input, parse_agent_response(ai_response_text)[1])
             except IndexError:
                 print("Invalid chat command. Format: chat <agent_id>")
             except ValueError as ve:
                 print(f"Error in chat command: {ve}")
 
 
+        elif user_input.startswith("poll "):
+            parts = user_input.split(" ", 2)
+            if len(parts) < 3:
+                print("Invalid poll command. Format: poll <agent_id1>,<agent_id2>,...|all \"<question>\"")
+                continue
+            agent_ids_list = manager.list_agent_ids() if parts[1] == "all" else [aid.strip() for aid in parts[1].split(',') if aid.strip()]
+            unknown = [aid for aid in agent_ids_list if not manager.has_agent(aid)]
+            if unknown:
+                print(f"Unknown agents skipped: {', '.join(unknown)}")
+            for event in manager.poll_agents_stream(agent_ids_list, parts[2].strip('"')):
+                if event["type"] == "start":
+                    print(f"Polling {len(event['agents'])} agents (question embedded once in {event['embedding_s'] * 1000:.0f} ms)...")
+                elif event["type"] == "result":
+                    timings = event["timings"]
+                    stages = ", ".join(f"{stage} {timings[stage] * 1000:.0f}"
+                                       for stage in ("retrieval", "llm_call", "turn_total") if stage in timings)
+                    print(f"\n>>> {event['name']} [{event['elapsed_s']:.2f}s; {stages} ms]")
+                    print(f"Error: {event['error']}" if event["error"] else parse_agent_response(event["text"])[1], flush=True)
+                elif event["type"] == "end":
+                    print(f"\nPoll finished in {event['elapsed_s']:.2f}s.")
+
         elif user_input.startswith("discuss "):
             try:
                 parts = user_input.split(" ", 2)
@@ -147,7 +336,11 @@ def main_cli_interaction():
                 agent_ids_list = [aid.strip() for aid in agent_ids_str.split(',') if aid.strip()]
                 if not agent_ids_list: raise ValueError("No agent IDs provided for discussion")
                 if len(agent_ids_list) < 2 : raise ValueError("Need at least two agents for discussion")
-                manager.simulate_discussion(agent_ids_list, topic, max_turns_per_agent=2) # Sửa tên tham số ở đây
+                for event in manager.simulate_discussion_stream(agent_ids_list, topic, max_turns_per_agent=2, mode=DISCUSSION_MODE):
+                    if event["type"] == "turn":
+                        print(f"\n>>> {event['statement']}\n", flush=True)
+                    elif event["type"] == "error":
+                        print(event["message"])
             except IndexError:
                 print("Invalid discuss command. Format: discuss <agent_id1>,<agent_id2> \"<topic>\"")
             except ValueError as ve:
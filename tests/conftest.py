@@ -0,0 +1,58 @@
+import os
+import sys
+
+# Offline test run: stub LLM, no API keys
+os.environ["LLM_BACKEND"] = "stub"
+os.environ.pop("GEMINI_API_KEY", None)
+os.environ.pop("NEWS_API_KEY", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hashlib
+import pytest
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_DIM = 16
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic offline embedder: a unit vector derived from the sha256 of the text."""
+
+    def __init__(self):
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _vector(self, text: str) -> list:
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        vector = [byte - 127.5 for byte in digest[:EMBEDDING_DIM]]
+        norm = sum(value * value for value in vector) ** 0.5
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+@pytest.fixture
+def embeddings():
+    return HashEmbeddings()
+
+
+@pytest.fixture
+def make_agent(tmp_path, monkeypatch, embeddings):
+    """Builds CharacterAgents in tmp_path with the stub LLM, the hash embedder and no response cache."""
+    from core import agent as agent_module
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(agent_module, "get_shared_embeddings", lambda model_name: embeddings)
+    monkeypatch.setattr(agent_module, "get_response_cache", lambda: None)
+
+    def make(agent_id: str = "test_agent", shared_store=None, persona_extra: str = ""):
+        persona_path = tmp_path / f"{agent_id}.yaml"
+        persona_path.write_text(f"full_name: Test {agent_id}\nsystem_prompt: You are a test agent.\n{persona_extra}",
+                                encoding='utf-8')
+        return agent_module.CharacterAgent(agent_id, str(persona_path), str(tmp_path / "vector_db"), shared_store=shared_store)
+
+    return make
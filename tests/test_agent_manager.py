@@ -0,0 +1,118 @@
+import time
+import threading
+import pytest
+from core import agent_manager as agent_manager_module
+from core.agent_manager import AgentManager
+
+QUESTION = "What do you think about the new trade agreement?"
+
+
+@pytest.fixture
+def manager(make_agent, embeddings, tmp_path, monkeypatch):
+    """AgentManager over three test personas, built with the stub LLM and the hash embedder."""
+    monkeypatch.setattr(agent_manager_module, "get_shared_embeddings", lambda model_name: embeddings)
+    national, personal = tmp_path / "National", tmp_path / "Personal"
+    national.mkdir()
+    personal.mkdir()
+    for agent_id in ("slow", "fast", "late"):
+        (national / f"{agent_id}.yaml").write_text(f"full_name: {agent_id.title()}\nsystem_prompt: Test.\n", encoding='utf-8')
+    return AgentManager(str(national), str(personal), str(tmp_path / "vector_db"))
+
+
+def test_poll_embeds_the_question_once_and_answers_every_agent(manager, embeddings, monkeypatch):
+    embedded = []
+    embed_query = embeddings.embed_query
+    monkeypatch.setattr(embeddings, "embed_query", lambda text: embedded.append(text) or embed_query(text))
+
+    results = manager.poll_agents(["slow", "fast", "late"], QUESTION, use_cache=False)
+    assert embedded == [QUESTION]
+    assert set(results) == {"slow", "fast", "late"}
+    assert all(results.values())
+
+
+def test_poll_caps_concurrency_and_yields_in_completion_order(manager, embeddings):
+    delays = {"slow": 0.3, "fast": 0.05, "late": 0.01}
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+    vectors = []
+
+    for agent_id, delay in delays.items():
+        def think_and_respond(question, use_cache=True, timings=None, query_vector=None, agent_id=agent_id, delay=delay):
+            with lock:
+                in_flight["now"] += 1
+                in_flight["max"] = max(in_flight["max"], in_flight["now"])
+                vectors.append(query_vector)
+            time.sleep(delay)
+            with lock:
+                in_flight["now"] -= 1
+            return f"{agent_id} answer"
+        manager.get_agent(agent_id).think_and_respond = think_and_respond
+
+    events = list(manager.poll_agents_stream(["slow", "fast", "late"], QUESTION, max_concurrency=2))
+    assert [event["type"] for event in events] == ["start", "result", "result", "result", "end"]
+    # slow and fast start together; late takes fast's slot and still finishes before slow
+    assert [event["agent_id"] for event in events[1:4]] == ["fast", "late", "slow"]
+    assert in_flight["max"] == 2
+    assert vectors == [embeddings.embed_query(QUESTION)] * 3
+
+    queued = {event["agent_id"]: event["timings"]["queued_s"] for event in events[1:4]}
+    assert queued["slow"] < 0.05 and queued["fast"] < 0.05
+    assert queued["late"] >= delays["fast"] * 0.9
+    assert events[-1]["results"] == {agent_id: f"{agent_id} answer" for agent_id in delays}
+
+
+@pytest.fixture
+def scripted_agents(manager):
+    """Replaces each agent's reply with "<agent_id> says <n>" and records (agent_id, question, history) per call."""
+    calls = []
+    lock = threading.Lock()
+    for agent_id in ("slow", "fast", "late"):
+        def think_and_respond(question, conversation_history=None, use_cache=True, agent_id=agent_id):
+            with lock:
+                calls.append((agent_id, question, list(conversation_history or [])))
+                return f"{agent_id} says {sum(1 for call in calls if call[0] == agent_id)}"
+        manager.get_agent(agent_id).think_and_respond = think_and_respond
+    return calls
+
+
+def discuss(manager, mode: str) -> list:
+    events = list(manager.simulate_discussion_stream(["slow", "fast", "late"], "Tariffs", max_turns_per_agent=2, mode=mode))
+    assert events[0]["type"] == "start" and events[-1]["type"] == "end"
+    return [(event["round"], event["agent_id"]) for event in events[1:-1]]
+
+
+def test_sequential_discussion_takes_turns_round_robin(manager, scripted_agents):
+    turns = discuss(manager, "sequential")
+
+    assert turns == [(1, "slow"), (1, "fast"), (1, "late"), (2, "slow"), (2, "fast"), (2, "late")]
+    # Each speaker sees what the others just said, and its own earlier turn in its history
+    agent_id, question, history = scripted_agents[1]
+    assert agent_id == "fast" and "Slow: slow says 1" in question
+    agent_id, question, history = scripted_agents[3]
+    assert agent_id == "slow" and "Fast: fast says 1" in question and "Late: late says 1" in question
+    assert [answer for _, answer in history] == ["slow says 1"]
+
+
+def test_parallel_opening_answers_together_then_round_robin(manager, scripted_agents):
+    turns = discuss(manager, "parallel_opening")
+
+    assert turns == [(1, "slow"), (1, "fast"), (1, "late"), (2, "slow"), (2, "fast"), (2, "late")]
+    # Nobody sees another opening statement before giving their own
+    for _, question, history in scripted_agents[:3]:
+        assert " says " not in question and history == []
+    agent_id, question, _ = scripted_agents[4]
+    assert agent_id == "fast" and "Slow: slow says 2" in question
+
+
+def test_rounds_react_to_the_previous_round_only(manager, scripted_agents):
+    turns = discuss(manager, "rounds")
+
+    assert turns == [(1, "slow"), (1, "fast"), (1, "late"), (2, "slow"), (2, "fast"), (2, "late")]
+    second_round = {agent_id: question for agent_id, question, _ in scripted_agents[3:]}
+    assert set(second_round) == {"slow", "fast", "late"}
+    for agent_id, question in second_round.items():
+        others = {"slow", "fast", "late"} - {agent_id}
+        # The others' first-round statements, not its own and nothing from the round in progress
+        assert all(f"{other.title()}: {other} says 1" in question for other in others)
+        assert f"{agent_id.title()}: {agent_id} says 1" not in question
+        assert " says 2" not in question
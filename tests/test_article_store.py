@@ -0,0 +1,80 @@
+import builtins
+import pytest
+from core import article_store as article_store_module
+from core.article_store import ArticleStore
+
+
+def make_article(n: int) -> dict:
+    return {"title": f"Article {n}", "link": f"https://example.com/{n}", "content": f"Body {n}"}
+
+
+@pytest.fixture
+def partial_write(monkeypatch):
+    """Calling it makes the next segment append write only its first record and half of the second, then fail."""
+    real_open = builtins.open
+
+    class TornFile:
+        def __init__(self, f):
+            self.f = f
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.f.close()
+
+        def write(self, text):
+            lines = text.split("\n")
+            self.f.write(lines[0] + "\n" + lines[1][:len(lines[1]) // 2])
+            self.f.flush()
+            raise OSError("No space left on device")
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        f = real_open(path, mode, *args, **kwargs)
+        if str(path).endswith(".jsonl") and mode == 'a':
+            monkeypatch.setattr(article_store_module, "open", real_open, raising=False)
+            return TornFile(f)
+        return f
+
+    return lambda: monkeypatch.setattr(article_store_module, "open", failing_open, raising=False)
+
+
+def assert_stored_once(store: ArticleStore, agent_id: str, articles: list):
+    records = list(store.iter_records(agent_id))
+    assert sorted(record["title"] for record in records) == sorted(article["title"] for article in articles)
+    assert [record["seq"] for record in records] == list(range(1, len(articles) + 1))
+    assert store.last_seq(agent_id) == len(articles)
+
+
+def test_a_partial_append_is_rolled_back_and_retried_once(tmp_path, partial_write):
+    store = ArticleStore(str(tmp_path / "store"))
+    store.append_many("agent_a", [make_article(1)], day="2024-05-01")
+    articles = [make_article(n) for n in range(2, 5)]
+
+    partial_write()
+    with pytest.raises(OSError):
+        store.append_many("agent_a", articles, day="2024-05-01")
+    assert len(store.append_many("agent_a", articles, day="2024-05-01")) == 3
+    segment = tmp_path / "store" / "agent_a" / "segments" / "2024-05-01.jsonl"
+    assert len(segment.read_text(encoding='utf-8').splitlines()) == 4
+    assert_stored_once(store, "agent_a", [make_article(1)] + articles)
+    # A fresh process agrees with what this one read
+    assert_stored_once(ArticleStore(str(tmp_path / "store")), "agent_a", [make_article(1)] + articles)
+
+
+def test_a_partial_append_that_cannot_be_rolled_back_is_recovered(tmp_path, partial_write, monkeypatch):
+    def failing_truncate(path, length):
+        raise OSError("read-only file system")
+    monkeypatch.setattr(article_store_module.os, "truncate", failing_truncate)
+    store = ArticleStore(str(tmp_path / "store"))
+    articles = [make_article(n) for n in range(1, 4)]
+
+    partial_write()
+    with pytest.raises(OSError):
+        store.append_many("agent_a", articles, day="2024-05-01")
+    # The record that reached the segment is kept under its seq; the torn one is dropped and written again
+    retried = store.append_many("agent_a", articles, day="2024-05-01")
+    assert [record["title"] for record in retried] == ["Article 2", "Article 3"]
+    assert [record["seq"] for record in retried] == [2, 3]
+    assert_stored_once(store, "agent_a", articles)
+    assert_stored_once(ArticleStore(str(tmp_path / "store")), "agent_a", articles)
@@ -0,0 +1,60 @@
+import pytest
+from core.chunker import TokenChunker, _sentences
+from core.utils import get_token_encoding
+
+SENTENCES = [f"Sentence {n} says the trade talks moved {'forward' if n % 2 else 'slowly'} this week." for n in range(30)]
+TEXT = " ".join(SENTENCES)
+
+
+def sentence_tokens(chunk: str) -> int:
+    encoding = get_token_encoding()
+    return sum(len(encoding.encode(sentence)) for sentence in _sentences(chunk))
+
+
+def chunk_sentences(chunk: str) -> list:
+    return [sentence.strip() for sentence in _sentences(chunk)]
+
+
+def test_chunks_fit_the_budget_and_end_on_sentence_boundaries():
+    chunker = TokenChunker(chunk_tokens=60, overlap_tokens=20)
+    chunks = chunker.split_text(TEXT)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert sentence_tokens(chunk) <= 60
+        assert all(sentence in SENTENCES for sentence in chunk_sentences(chunk))
+
+    # Every sentence is kept, in order, once the overlapping sentences are dropped
+    covered = []
+    for chunk in chunks:
+        covered.extend(sentence for sentence in chunk_sentences(chunk) if sentence not in covered)
+    assert covered == SENTENCES
+
+
+def test_consecutive_chunks_overlap_by_whole_sentences_within_overlap_tokens():
+    chunker = TokenChunker(chunk_tokens=60, overlap_tokens=20)
+    chunks = chunker.split_text(TEXT)
+    encoding = get_token_encoding()
+    overlapping = 0
+    for previous, current in zip(chunks, chunks[1:]):
+        previous_sentences, current_sentences = chunk_sentences(previous), chunk_sentences(current)
+        shared = [sentence for sentence in current_sentences if sentence in previous_sentences]
+        assert shared == previous_sentences[len(previous_sentences) - len(shared):]
+        assert shared == current_sentences[:len(shared)]
+        assert sum(len(encoding.encode(sentence + " ")) for sentence in shared) <= 20
+        overlapping += bool(shared)
+    assert overlapping == len(chunks) - 1
+
+
+def test_a_sentence_longer_than_the_budget_is_cut_on_token_offsets():
+    chunker = TokenChunker(chunk_tokens=16, overlap_tokens=4)
+    long_sentence = " ".join(f"word{n}" for n in range(60)) + "."
+    chunks = chunker.split_text(long_sentence)
+    assert len(chunks) > 1
+    encoding = get_token_encoding()
+    assert all(len(encoding.encode(chunk)) <= 16 for chunk in chunks)
+    assert "".join(chunks).replace(" ", "") == long_sentence.replace(" ", "")
+
+
+def test_overlap_must_be_smaller_than_the_chunk():
+    with pytest.raises(ValueError):
+        TokenChunker(chunk_tokens=32, overlap_tokens=32)
@@ -0,0 +1,64 @@
+import logging
+import pytest
+from core.context_packer import pack_context, format_rag_context, SYSTEM_PROMPT_MIN_TOKENS
+from core.utils import num_tokens_from_string
+
+SYSTEM_PROMPT = "You are a careful negotiator who weighs every offer. " * 40
+INSTRUCTIONS = "Answer the question below in your own voice.\nQuestion: what is the outlook on tariffs?"
+
+
+def make_chunks(count: int) -> list:
+    return [f"Chunk {n}: " + f"fact number {n} about trade policy. " * 12 for n in range(count)]
+
+
+def make_history(count: int) -> list:
+    return [(f"Question {n} " + "about the economy " * 10, f"Answer {n} " + "with some detail " * 10) for n in range(count)]
+
+
+@pytest.mark.parametrize("budget", [200, 400, 800, 1600])
+def test_the_budget_is_never_exceeded(budget):
+    packed = pack_context(SYSTEM_PROMPT, INSTRUCTIONS, make_chunks(10), make_history(10), budget=budget)
+
+    assert packed.total_tokens <= budget
+    # The counts cover the text that actually goes into the prompt, framing included
+    prompt_tokens = (num_tokens_from_string(packed.system_prompt) + num_tokens_from_string(INSTRUCTIONS)
+                     + num_tokens_from_string(format_rag_context(packed.chunks))
+                     + sum(num_tokens_from_string(u) + num_tokens_from_string(a) for u, a in packed.history))
+    assert prompt_tokens <= budget + 2
+
+
+def test_history_is_dropped_oldest_first():
+    history = make_history(10)
+    packed = pack_context("Short persona.", INSTRUCTIONS, [], history, budget=500)
+
+    assert 0 < len(packed.history) < len(history)
+    assert packed.history == history[-len(packed.history):]
+    assert packed.dropped["history"] == len(history) - len(packed.history)
+
+
+def test_chunks_are_kept_in_relevance_order():
+    chunks = make_chunks(10)
+    packed = pack_context("Short persona.", INSTRUCTIONS, chunks, [], budget=600)
+
+    assert 0 < len(packed.chunks) < len(chunks)
+    # A prefix of the ranked list, the last one possibly cut short
+    assert packed.chunks[:-1] == chunks[:len(packed.chunks) - 1]
+    assert chunks[len(packed.chunks) - 1].startswith(packed.chunks[-1])
+
+
+def test_the_system_prompt_is_never_emptied_and_truncation_is_logged(caplog):
+    long_instructions = INSTRUCTIONS + " Context: " + "background detail " * 400
+
+    with caplog.at_level(logging.WARNING, logger="core.context_packer"):
+        packed = pack_context(SYSTEM_PROMPT, long_instructions, make_chunks(3), make_history(3), budget=300)
+
+    assert packed.system_prompt
+    assert SYSTEM_PROMPT.startswith(packed.system_prompt)
+    assert packed.tokens["system"] >= SYSTEM_PROMPT_MIN_TOKENS - 1
+    assert any("System prompt truncated" in record.getMessage() for record in caplog.records)
+
+
+def test_a_short_system_prompt_is_kept_whole():
+    packed = pack_context("Short persona.", INSTRUCTIONS + " " + "filler " * 600, [], [], budget=300)
+
+    assert packed.system_prompt == "Short persona."
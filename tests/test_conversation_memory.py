@@ -0,0 +1,72 @@
+import time
+import threading
+from core.conversation_memory import ConversationMemory, RollingSummary
+
+
+def test_readers_are_not_blocked_by_the_summarizer():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_summarizer(previous_summary, lines, max_tokens):
+        started.set()
+        release.wait(5)
+        return f"{previous_summary} + {len(lines)} lines".strip()
+
+    memory = ConversationMemory(slow_summarizer, recent=1, summary_every=1)
+    memory.add_turn("q1", "a1")
+    adder = threading.Thread(target=memory.add_turn, args=("q2", "a2"))
+    adder.start()
+    assert started.wait(5)
+
+    # While the summary is being written the old turns are still served verbatim, and adds go through
+    assert memory.history() == [("q1", "a1"), ("q2", "a2")]
+    memory.add_turn("q3", "a3")
+    release.set()
+    adder.join(5)
+    assert memory.wait_idle(5)
+
+    assert memory.history()[0][1] == "+ 1 lines"
+    assert memory.recent_entries() == [("q2", "a2"), ("q3", "a3")]
+    assert memory.get_stats()["summarized"] == 1
+
+
+def test_clear_drops_a_summary_started_before_it():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_summarizer(previous_summary, lines, max_tokens):
+        started.set()
+        release.wait(5)
+        return "stale"
+
+    memory = RollingSummary(slow_summarizer, recent=0, summary_every=1)
+    adder = threading.Thread(target=memory.add, args=("entry",))
+    adder.start()
+    assert started.wait(5)
+    memory.clear()
+    release.set()
+    adder.join(5)
+    assert memory.wait_idle(5)
+
+    assert memory.summary == ""
+    assert memory.recent_entries() == []
+
+
+def test_add_does_not_wait_for_a_slow_summarizer():
+    release = threading.Event()
+
+    def slow_summarizer(previous_summary, lines, max_tokens):
+        release.wait(5)
+        return "summary"
+
+    memory = ConversationMemory(slow_summarizer, recent=1, summary_every=1)
+    started = time.perf_counter()
+    for n in range(4):
+        memory.add_turn(f"q{n}", f"a{n}")
+    assert time.perf_counter() - started < 1
+    # Until the summary is ready every turn is still there verbatim
+    assert memory.history() == [(f"q{n}", f"a{n}") for n in range(4)]
+    assert not memory.wait_idle(0.05)
+
+    release.set()
+    assert memory.wait_idle(5)
+    assert memory.history()[0][1] == "summary"
+    assert memory.recent_entries() == [(f"q{n}", f"a{n}") for n in range(1, 4)]
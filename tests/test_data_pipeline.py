@@ -0,0 +1,218 @@
+import asyncio
+import pytest
+from core import data_pipeline
+from core.article_store import ArticleStore
+from core.fetch_state import FetchStateStore
+from core.update_worker import KnowledgeUpdateWorker
+
+CONFIG = {"query": "economy", "language": "en", "page_size": 10}
+
+
+def make_article(n: int) -> dict:
+    return {"title": f"Article {n}", "link": f"https://example.com/{n}", "content": f"Body {n}",
+            "published_at": f"2024-05-0{n}T00:00:00Z"}
+
+
+class FakeEngine:
+    def __init__(self, articles):
+        self.articles = articles
+
+    async def fetch_configs(self, jobs):
+        return [list(self.articles) for _ in jobs]
+
+    def latency_summary(self):
+        return {}
+
+
+class FakeManager:
+    def has_agent(self, agent_id):
+        return True
+
+
+@pytest.fixture
+def raw_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_pipeline, "NEWS_API_KEY", "test-key")
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    monkeypatch.setattr(data_pipeline, "update_agents_knowledge_from_raw_data",
+                        lambda manager, raw_dir, job=None: {"status": "success"})
+    return str(tmp_path / "raw_news")
+
+
+def run_update(raw_dir, articles):
+    data_pipeline._news_fetch_engine = FakeEngine(articles)
+    try:
+        return asyncio.run(data_pipeline._perform_data_update_logic(FakeManager(), raw_dir, {"agent_a": [CONFIG]}))
+    finally:
+        data_pipeline._news_fetch_engine = None
+
+
+def fetch_state(raw_dir) -> FetchStateStore:
+    return FetchStateStore(data_pipeline.get_fetch_state_dir(raw_dir))
+
+
+def test_failed_save_keeps_watermark_and_seen_urls(raw_dir, monkeypatch):
+    articles = [make_article(1), make_article(2)]
+    real_append = ArticleStore.append_many
+
+    def failing_append(self, agent_id, articles, day=None):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ArticleStore, "append_many", failing_append)
+    status = run_update(raw_dir, articles)
+
+    state = fetch_state(raw_dir)
+    assert status["save_failures"] == ["agent_a"]
+    assert state.get_watermark("agent_a", CONFIG) is None
+    assert state.filter_unseen("agent_a", articles) == articles
+
+    # Next run the store works again: the same articles are saved and the watermark advances
+    monkeypatch.setattr(ArticleStore, "append_many", real_append)
+    status = run_update(raw_dir, articles)
+
+    state = fetch_state(raw_dir)
+    assert status["save_failures"] == []
+    assert state.get_watermark("agent_a", CONFIG) == "2024-05-02T00:00:00Z"
+    assert state.filter_unseen("agent_a", articles) == []
+    assert data_pipeline.get_article_store(raw_dir).last_seq("agent_a") == 2
+
+
+def test_failed_save_marks_only_already_stored_articles_seen(raw_dir, monkeypatch):
+    store = data_pipeline.get_article_store(raw_dir)
+    store.append_many("agent_a", [make_article(1)])
+    real_append = ArticleStore.append_many
+
+    def failing_append(self, agent_id, articles, day=None):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(ArticleStore, "append_many", failing_append)
+    run_update(raw_dir, [make_article(1), make_article(2)])
+
+    state = fetch_state(raw_dir)
+    assert state.filter_unseen("agent_a", [make_article(1), make_article(2)]) == [make_article(2)]
+    assert state.get_watermark("agent_a", CONFIG) is None
+    monkeypatch.setattr(ArticleStore, "append_many", real_append)
+    assert [r["link"] for r in store.append_many("agent_a", [make_article(1), make_article(2)])] == ["https://example.com/2"]
+
+
+def test_failed_write_does_not_claim_keys(tmp_path, monkeypatch):
+    store = ArticleStore(str(tmp_path))
+    store.append_many("agent_a", [make_article(1)])
+    real_open = open
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        if str(path).endswith(".jsonl") and 'a' in mode:
+            raise OSError("disk full")
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", failing_open)
+    with pytest.raises(OSError):
+        store.append_many("agent_a", [make_article(2)])
+    monkeypatch.undo()
+
+    assert not store.contains("agent_a", make_article(2))
+    records = store.append_many("agent_a", [make_article(2)])
+    assert [record["seq"] for record in records] == [2]
+
+
+class AgentsManager:
+    def __init__(self, agents):
+        self.agents = agents
+
+    def has_agent(self, agent_id):
+        return agent_id in self.agents
+
+    def get_agent(self, agent_id):
+        return self.agents.get(agent_id)
+
+    def ingested_store_offset(self, agent_id):
+        return self.agents[agent_id].ingestion_manifest.store_offset
+
+
+def test_an_agent_that_fails_to_ingest_is_reported_and_keeps_its_offset(make_agent, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    raw_dir = str(tmp_path / "raw_news")
+    store = data_pipeline.get_article_store(raw_dir)
+    agents = {agent_id: make_agent(agent_id) for agent_id in ("agent_a", "agent_b")}
+    for agent_id in agents:
+        store.append_many(agent_id, [make_article(1), make_article(2)])
+
+    def failing_bulk_ingest(*args, **kwargs):
+        raise RuntimeError("embedding service unavailable")
+    monkeypatch.setattr(agents["agent_b"], "bulk_ingest", failing_bulk_ingest)
+    status = data_pipeline.update_agents_knowledge_from_raw_data(AgentsManager(agents), raw_dir)
+
+    assert status["status"] == "partial"
+    assert status["ingest_failures"] == ["agent_b"]
+    assert status["articles_processed"] == 2
+    assert agents["agent_a"].ingestion_manifest.store_offset == 2
+    assert agents["agent_b"].ingestion_manifest.store_offset == 0
+
+    # When every agent with new articles fails, the run failed
+    store.append_many("agent_a", [make_article(3)])
+    monkeypatch.setattr(agents["agent_a"], "bulk_ingest", failing_bulk_ingest)
+    status = data_pipeline.update_agents_knowledge_from_raw_data(AgentsManager(agents), raw_dir)
+    assert status["status"] == "failed"
+    assert sorted(status["ingest_failures"]) == ["agent_a", "agent_b"]
+
+
+def test_agents_with_nothing_new_are_not_loaded_for_an_update(make_agent, embeddings, tmp_path, monkeypatch):
+    from core import agent_manager as agent_manager_module
+    monkeypatch.setattr(agent_manager_module, "get_shared_embeddings", lambda model_name: embeddings)
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    national, personal = tmp_path / "National", tmp_path / "Personal"
+    national.mkdir()
+    personal.mkdir()
+    for agent_id in ("agent_a", "agent_b"):
+        (national / f"{agent_id}.yaml").write_text(f"full_name: {agent_id}\nsystem_prompt: Test.\n", encoding='utf-8')
+    raw_dir = str(tmp_path / "raw_news")
+    store = data_pipeline.get_article_store(raw_dir)
+    for agent_id in ("agent_a", "agent_b"):
+        store.append_many(agent_id, [make_article(1)])
+
+    def new_manager():
+        return agent_manager_module.AgentManager(str(national), str(personal), str(tmp_path / "vector_db"))
+
+    assert data_pipeline.update_agents_knowledge_from_raw_data(new_manager(), raw_dir)["articles_processed"] == 2
+    # After a restart only the agent with a new article is built
+    store.append_many("agent_a", [make_article(2)])
+    manager = new_manager()
+    status = data_pipeline.update_agents_knowledge_from_raw_data(manager, raw_dir)
+    assert status["articles_processed"] == 1
+    assert list(manager.agents) == ["agent_a"]
+
+
+def test_a_cancelled_job_discards_uncommitted_chunks_and_keeps_the_offset(make_agent, embeddings, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    raw_dir = str(tmp_path / "raw_news")
+    data_pipeline.get_article_store(raw_dir).append_many("agent_a", [make_article(n) for n in range(1, 5)])
+    agent = make_agent("agent_a")
+    manager = AgentsManager({"agent_a": agent})
+    chunks_before, embedded_before = agent.vector_store.index.ntotal, embeddings.texts_embedded
+    worker = KnowledgeUpdateWorker()
+
+    # Cancel once the second article has been queued, i.e. in the middle of the agent's batch
+    format_article_text = data_pipeline.format_article_text
+    formatted = []
+    def format_and_cancel(record):
+        formatted.append(record["seq"])
+        if len(formatted) == 2:
+            worker.current_job.cancel()
+        return format_article_text(record)
+    monkeypatch.setattr(data_pipeline, "format_article_text", format_and_cancel)
+    job = worker.submit(lambda job: data_pipeline.update_agents_knowledge_from_raw_data(manager, raw_dir, job=job))
+    assert job.wait(10)
+
+    assert job.state == "cancelled"
+    assert formatted == [1, 2]
+    assert agent.vector_store.index.ntotal == chunks_before
+    assert embeddings.texts_embedded == embedded_before
+    assert agent.ingestion_manifest.store_offset == 0
+    assert make_agent("agent_a").ingestion_manifest.store_offset == 0
+
+    # The next run ingests every article
+    monkeypatch.setattr(data_pipeline, "format_article_text", format_article_text)
+    job = worker.submit(lambda job: data_pipeline.update_agents_knowledge_from_raw_data(manager, raw_dir, job=job))
+    assert job.wait(10) and job.state == "succeeded"
+    assert job.result["articles_processed"] == 4
+    assert agent.ingestion_manifest.store_offset == 4
+    worker.shutdown()
@@ -0,0 +1,54 @@
+import multiprocessing
+import hashlib
+from core.embedding_cache import ChunkEmbeddingCache
+
+DIM = 8
+ROWS_PER_WRITER = 40
+
+
+def vector_for(key: str) -> list:
+    return [float(byte) for byte in hashlib.sha256(key.encode('utf-8')).digest()[:DIM]]
+
+
+def write_rows(cache_dir: str, writer: int):
+    cache = ChunkEmbeddingCache(cache_dir, "test-model")
+    for n in range(ROWS_PER_WRITER):
+        # Every writer also stores a key the others store, to exercise the cross-process duplicate check
+        keys = [f"writer{writer}-{n}", f"shared-{n}"]
+        cache.put_many(keys, [vector_for(key) for key in keys])
+
+
+def test_processes_appending_at_once_keep_keys_and_rows_aligned(tmp_path):
+    cache_dir = str(tmp_path / "embedding_cache")
+    cache = ChunkEmbeddingCache(cache_dir, "test-model")
+    cache.put_many(["seed"], [vector_for("seed")])
+
+    context = multiprocessing.get_context("spawn")
+    writers = [context.Process(target=write_rows, args=(cache_dir, writer)) for writer in range(3)]
+    for process in writers:
+        process.start()
+    for process in writers:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    keys = ["seed"] + [f"writer{w}-{n}" for w in range(3) for n in range(ROWS_PER_WRITER)] + [f"shared-{n}" for n in range(ROWS_PER_WRITER)]
+    # The instance that was open all along picks the other processes' rows up, as does a fresh one
+    for reader in (cache, ChunkEmbeddingCache(cache_dir, "test-model")):
+        assert reader.get_many(keys) == [vector_for(key) for key in keys]
+    assert ChunkEmbeddingCache(cache_dir, "test-model").get_stats()["entries"] == len(keys)
+
+
+def test_rows_a_crashed_writer_left_behind_are_dropped(tmp_path):
+    cache_dir = str(tmp_path / "embedding_cache")
+    cache = ChunkEmbeddingCache(cache_dir, "test-model")
+    cache.put_many(["a"], [vector_for("a")])
+    # A writer died after appending its vector and half a key
+    with open(cache.vectors_path, 'ab') as f:
+        f.write(b"\0" * DIM * 4)
+    with open(cache.keys_path, 'a', encoding='utf-8') as f:
+        f.write("torn")
+
+    cache.put_many(["b"], [vector_for("b")])
+    reopened = ChunkEmbeddingCache(cache_dir, "test-model")
+    assert reopened.get_many(["a", "b", "torn"]) == [vector_for("a"), vector_for("b"), None]
+    assert reopened.get_stats()["entries"] == 2
@@ -0,0 +1,118 @@
+import time
+import threading
+import pytest
+from core import embeddings as embeddings_module
+from core.embeddings import SharedEmbeddingService, QueryEmbeddingCache
+
+
+class RecordingEmbeddings:
+    """Records every batch the service sends to the model."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return self.inner.embed_documents(texts)
+
+
+@pytest.fixture
+def make_service(tmp_path, monkeypatch, embeddings):
+    """Builds SharedEmbeddingServices over the hash embedder with a chunk cache in tmp_path and an empty query cache."""
+    monkeypatch.setattr(embeddings_module, "CHUNK_EMBEDDING_CACHE_DIR", str(tmp_path / "embedding_cache"))
+    monkeypatch.setattr(embeddings_module, "_query_cache", QueryEmbeddingCache())
+
+    def make(**settings) -> SharedEmbeddingService:
+        model = RecordingEmbeddings(embeddings)
+        monkeypatch.setattr(SharedEmbeddingService, "_load_model", staticmethod(lambda model_name: model))
+        return SharedEmbeddingService("test-model", **settings)
+
+    return make
+
+
+def test_the_model_embeds_the_text_the_cache_key_is_computed_from(make_service, embeddings):
+    service = make_service()
+
+    first = service.embed_documents(["Trade  talks\nresumed today."])
+    second = service.embed_documents(["Trade talks resumed today. "])
+    query = service.embed_query("  Trade talks resumed today.")
+
+    # Once for the chunk cache, once for the query cache
+    assert service.model.batches == [["Trade talks resumed today."]] * 2
+    expected = embeddings.embed_query("Trade talks resumed today.")
+    # The second call is read back from the float32 chunk cache
+    assert first[0] == query == expected
+    assert second[0] == pytest.approx(expected, abs=1e-6)
+
+
+class GatedEmbeddings(RecordingEmbeddings):
+    """Holds the first batch until released, so the calls made meanwhile queue up behind it."""
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.started, self.release = threading.Event(), threading.Event()
+
+    def embed_documents(self, texts):
+        self.started.set()
+        self.release.wait(5)
+        return super().embed_documents(texts)
+
+
+def test_concurrent_calls_are_merged_into_one_batch(make_service, embeddings, monkeypatch):
+    service = make_service(max_batch_size=64, max_wait_ms=50)
+    service.model = gated = GatedEmbeddings(embeddings)
+    monkeypatch.setattr(service, "chunk_cache", None)
+    blocker = threading.Thread(target=service.embed_documents, args=(["warm-up"],))
+    blocker.start()
+    assert gated.started.wait(5)
+
+    results = {}
+    def call(name, fn, arg):
+        results[name] = fn(arg)
+    callers = [threading.Thread(target=call, args=(f"docs{n}", service.embed_documents, [f"doc {n} a", f"doc {n} b"])) for n in range(3)]
+    callers += [threading.Thread(target=call, args=(f"query{n}", service.embed_query, f"query {n}")) for n in range(3)]
+    for caller in callers:
+        caller.start()
+    time.sleep(0.2)
+    gated.release.set()
+    for thread in callers + [blocker]:
+        thread.join(5)
+
+    # Everything that queued behind the first batch went through the model in one forward pass
+    assert len(gated.batches) == 2
+    assert sorted(gated.batches[1]) == sorted([f"doc {n} {part}" for n in range(3) for part in "ab"] + [f"query {n}" for n in range(3)])
+    for n in range(3):
+        assert results[f"docs{n}"] == embeddings.embed_documents([f"doc {n} a", f"doc {n} b"])
+        assert results[f"query{n}"] == embeddings.embed_query(f"query {n}")
+    stats = service.get_stats()
+    assert stats["batches"] == 2 and stats["requests"] == 7
+
+
+def test_repeated_queries_are_served_from_the_query_cache(make_service):
+    service = make_service()
+
+    first = service.embed_query("What about tariffs?")
+    assert service.embed_query("What about  tariffs? ") == first
+    assert service.model.batches == [["What about tariffs?"]]
+    assert embeddings_module._query_cache.get_stats()["hits"] == 1
+
+
+def test_requests_larger_than_the_batch_size_are_not_split_or_starved(make_service, embeddings, monkeypatch):
+    service = make_service(max_batch_size=4, max_wait_ms=20)
+    monkeypatch.setattr(service, "chunk_cache", None)
+    texts = [f"text {n}" for n in range(10)]
+
+    results = {}
+    callers = [threading.Thread(target=lambda: results.update(big=service.embed_documents(texts)))]
+    callers += [threading.Thread(target=lambda n=n: results.update({n: service.embed_documents([f"small {n}"])})) for n in range(3)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join(5)
+
+    assert results["big"] == embeddings.embed_documents(texts)
+    assert all(results[n] == embeddings.embed_documents([f"small {n}"]) for n in range(3))
+    # The oversized request goes through in one batch of its own; the small ones are never packed past the cap with it
+    assert texts in service.model.batches
+    assert all(len(batch) <= 4 for batch in service.model.batches if batch != texts)
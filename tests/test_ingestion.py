@@ -0,0 +1,209 @@
+import logging
+import threading
+from core.metrics import metrics
+from core.shared_store import SharedKnowledgeStore
+from core.vector_index import resolve_index_profile, index_type_of
+
+TEXT = ("Trade talks resumed this week after a long pause. Both delegations said the first round was constructive. "
+        "Negotiators will meet again next month to discuss tariffs on steel and agricultural goods.")
+
+
+def ingested_total(agent_id: str) -> float:
+    counters = metrics.snapshot()["counters"].get("chunks_ingested_total", [])
+    return sum(entry["value"] for entry in counters if entry["labels"].get("agent") == agent_id)
+
+
+def test_reingesting_the_same_text_is_a_no_op(make_agent, embeddings):
+    agent = make_agent("reingest_agent")
+    first = agent.add_knowledge_from_text(TEXT, source_name="news")
+    assert first > 0
+    embedded_before, chunks_before = embeddings.texts_embedded, agent.vector_store.index.ntotal
+
+    assert agent.add_knowledge_from_text(TEXT, source_name="news") == 0
+    assert embeddings.texts_embedded == embedded_before
+    assert agent.vector_store.index.ntotal == chunks_before
+
+
+def test_reingesting_an_unchanged_file_is_a_no_op(make_agent, embeddings, tmp_path, monkeypatch):
+    agent = make_agent("reingest_file_agent")
+    path = tmp_path / "article.txt"
+    path.write_text(TEXT, encoding='utf-8')
+    assert agent.add_knowledge_from_files([str(path)]) > 0
+    embedded_before = embeddings.texts_embedded
+
+    # A new agent instance reads the manifest back from disk and skips the file before chunking it
+    agent = make_agent("reingest_file_agent")
+    chunked = []
+    split_text = agent.text_splitter.split_text
+    monkeypatch.setattr(agent.text_splitter, "split_text", lambda text: chunked.append(text) or split_text(text))
+    assert agent.add_knowledge_from_files([str(path)]) == 0
+    assert chunked == []
+    assert embeddings.texts_embedded == embedded_before
+
+    # A changed file is chunked again
+    path.write_text(TEXT + " Markets rallied on the news.", encoding='utf-8')
+    agent.add_knowledge_from_files([str(path)])
+    assert len(chunked) == 1
+
+
+def test_shared_store_counts_only_newly_embedded_chunks(make_agent, embeddings, tmp_path):
+    store = SharedKnowledgeStore(str(tmp_path / "shared_db"), embeddings)
+    first, second = make_agent("shared_a", shared_store=store), make_agent("shared_b", shared_store=store)
+
+    added = first.add_knowledge_from_text(TEXT, source_name="news")
+    assert added > 0
+    assert ingested_total("shared_a") == added
+
+    # The same chunks are only claimed by the second agent, not embedded again
+    assert second.add_knowledge_from_text(TEXT, source_name="news") == 0
+    assert ingested_total("shared_b") == 0
+    assert [doc.page_content for doc in second.retriever.invoke("trade talks")]
+
+
+def test_knowledge_bytes_follows_the_index_on_disk(make_agent):
+    agent = make_agent("size_agent")
+    size_empty = agent.knowledge_bytes
+    assert size_empty == agent.knowledge_size_bytes() > 0
+
+    agent.add_knowledge_from_text(TEXT, source_name="news")
+    assert agent.knowledge_bytes == agent.knowledge_size_bytes() > size_empty
+
+    # Reloading after an unload measures the files again
+    agent.unload_knowledge()
+    agent.ensure_knowledge_loaded()
+    assert agent.knowledge_bytes == agent.knowledge_size_bytes()
+
+
+def test_compaction_skips_unlimited_agents_and_forgets_expired_chunks(make_agent, tmp_path):
+    from core.agent_manager import AgentManager
+    national, personal = tmp_path / "National", tmp_path / "Personal"
+    national.mkdir()
+    personal.mkdir()
+    (national / "limited.yaml").write_text("full_name: Limited\nsystem_prompt: Test.\nretention:\n  max_age_days: 30\n", encoding='utf-8')
+    (personal / "unlimited.yaml").write_text("full_name: Unlimited\nsystem_prompt: Test.\n", encoding='utf-8')
+    metadata = {"published_at": "2020-01-01T00:00:00Z", "article_key": "old-article"}
+
+    manager = AgentManager(str(national), str(personal), str(tmp_path / "vector_db"))
+    with manager.get_agent("limited").bulk_ingest() as batch:
+        assert batch.near_duplicate_of("old-article", TEXT) is None
+        batch.add_text(TEXT, source_name="news", metadata=metadata)
+    added = batch.chunks_added
+    assert added > 0
+
+    manager = AgentManager(str(national), str(personal), str(tmp_path / "vector_db"))
+    [report] = manager.compact_knowledge()
+    assert report["expired"] == added
+    assert set(manager.agents) == {"limited"}
+    agent = manager.agents["limited"]
+    assert not agent.knowledge_loaded
+    manifest = agent.ingestion_manifest
+    assert not manifest.chunk_hashes and not manifest.chunk_fingerprints and not manifest.article_fingerprints
+
+    # The expired article is no longer a duplicate of anything, so it can be ingested again
+    with manager.get_agent("limited").bulk_ingest() as batch:
+        assert batch.near_duplicate_of("old-article", TEXT) is None
+        batch.add_text(TEXT, source_name="news", metadata=dict(metadata, published_at="2099-01-01T00:00:00Z"))
+    assert batch.chunks_added == added
+
+
+def test_unreadable_files_are_logged_and_counted(make_agent, tmp_path, caplog):
+    agent = make_agent("error_agent")
+    path = tmp_path / "broken.txt"
+    path.write_bytes(b"\xff\xfe not utf-8 \xff")
+    errors = lambda: sum(entry["value"] for entry in metrics.snapshot()["counters"].get("ingestion_errors_total", [])
+                         if entry["labels"] == {"agent": "error_agent", "stage": "read"})
+    before = errors()
+    with caplog.at_level(logging.ERROR, logger="core"):
+        assert agent.add_knowledge_from_files([str(path)]) == 0
+    assert errors() == before + 1
+    assert any("broken.txt" in record.getMessage() for record in caplog.records)
+
+
+def test_reindexing_runs_outside_the_write_lock(make_agent, monkeypatch):
+    agent = make_agent("reindex_agent")
+    agent.index_profile = resolve_index_profile(overrides={"type": "hnsw", "min_chunks": 4})
+    started, release = threading.Event(), threading.Event()
+    build = agent._build_vector_store
+
+    def slow_build(documents, index_type=None):
+        started.set()
+        release.wait(5)
+        return build(documents, index_type)
+    monkeypatch.setattr(agent, "_build_vector_store", slow_build)
+
+    def ingest(first, last):
+        with agent.bulk_ingest() as batch:
+            for n in range(first, last):
+                # Distinct enough not to be dropped as near-duplicates
+                batch.add_text(" ".join(f"topic{n}word{i}" for i in range(20)), source_name=f"news{n}")
+
+    committer = threading.Thread(target=ingest, args=(0, 4))
+    committer.start()
+    assert started.wait(5)
+
+    # The chunks are already searchable on the flat index, and other commits go through meanwhile
+    assert index_type_of(agent.vector_store.index) == "flat"
+    assert agent.vector_store.index.ntotal == 5
+    assert agent.retriever.invoke("trade talks")
+    ingest(4, 6)
+    assert agent.vector_store.index.ntotal == 7
+    release.set()
+    committer.join(10)
+
+    # The rebuild that raced the second commit was redone from the newer store
+    assert index_type_of(agent.vector_store.index) == "hnsw"
+    assert agent.vector_store.index.ntotal == 7
+    assert not agent._reindexing
+
+
+def distinct_text(n: int) -> str:
+    return " ".join(f"subject{n}term{i}" for i in range(20))
+
+
+def test_a_reader_holding_a_snapshot_is_unaffected_by_a_commit(make_agent):
+    agent = make_agent("snapshot_agent")
+    agent.add_knowledge_from_text(distinct_text(0), source_name="news0")
+    snapshot = agent._snapshot
+    positions = dict(snapshot.vector_store.index_to_docstore_id)
+    found = [doc.page_content for doc in snapshot.retriever.invoke(distinct_text(0))]
+
+    # Readers keep searching whatever snapshot is current while commits publish new ones
+    errors, stop = [], threading.Event()
+    def read():
+        while not stop.is_set():
+            try:
+                assert agent.retriever.invoke(distinct_text(0))
+            except Exception as e:
+                errors.append(e)
+    reader = threading.Thread(target=read)
+    reader.start()
+    for n in range(1, 4):
+        agent.add_knowledge_from_text(distinct_text(n), source_name=f"news{n}")
+    stop.set()
+    reader.join(5)
+
+    assert errors == []
+    assert agent._snapshot.version == snapshot.version + 3
+    assert agent.vector_store.index.ntotal == len(positions) + 3
+    assert snapshot.vector_store.index.ntotal == len(positions)
+    assert snapshot.vector_store.index_to_docstore_id == positions
+    assert [doc.page_content for doc in snapshot.retriever.invoke(distinct_text(0))] == found
+
+
+def test_a_shared_store_snapshot_is_unaffected_by_new_chunks_and_claims(make_agent, embeddings, tmp_path):
+    store = SharedKnowledgeStore(str(tmp_path / "shared_db"), embeddings)
+    first, second = make_agent("snap_a", shared_store=store), make_agent("snap_b", shared_store=store)
+    first.add_knowledge_from_text(TEXT, source_name="news")
+    snapshot = store._snapshot
+    owners = {position: list(doc.metadata["agents"]) for position, doc in
+              ((p, snapshot.vector_store.docstore.search(d)) for p, d in snapshot.vector_store.index_to_docstore_id.items())}
+
+    second.add_knowledge_from_text(TEXT, source_name="news")
+    second.add_knowledge_from_text(distinct_text(0), source_name="news0")
+
+    assert store._snapshot.version == snapshot.version + 2
+    assert snapshot.vector_store.index.ntotal == len(owners)
+    assert {position: doc.metadata["agents"] for position, doc in
+            ((p, snapshot.vector_store.docstore.search(d)) for p, d in snapshot.vector_store.index_to_docstore_id.items())} == owners
+    assert "snap_b" not in snapshot.owner_positions
+    assert store.search("snap_b", TEXT)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+import pytest
+from core import llm_backend
+from core.llm_backend import StubBackend, LLMError, resolve_llm_config
+
+
+def make_backend(**overrides) -> StubBackend:
+    settings = dict(backend="stub", latency_s=0.0, latency_jitter_s=0.0, tokens_per_s=0, reply_tokens=8, failure_rate=0.0, seed=1)
+    settings.update(overrides)
+    return StubBackend(resolve_llm_config(overrides=settings))
+
+
+def timed(call) -> float:
+    started = time.perf_counter()
+    call()
+    return time.perf_counter() - started
+
+
+def test_the_first_token_waits_for_the_configured_latency():
+    backend = make_backend(latency_s=0.2)
+
+    assert 0.2 <= timed(lambda: backend.generate("hello")) < 1.0
+    stream = backend.generate_stream("hello")
+    assert 0.2 <= timed(lambda: next(stream)) < 1.0
+    assert timed(lambda: list(stream)) < 0.1
+    assert 0.2 <= timed(lambda: asyncio.run(backend.agenerate("hello"))) < 1.0
+
+
+def test_tokens_are_emitted_at_the_configured_rate():
+    backend = make_backend(reply_tokens=10, tokens_per_s=50)
+
+    pieces = []
+    elapsed = timed(lambda: pieces.extend(backend.generate_stream("hello")))
+    # reply_tokens words plus the two thinking tags, each one paced at 1/tokens_per_s
+    assert len(pieces) == 12
+    assert 12 / 50 <= elapsed < 1.0
+
+
+def test_jitter_stays_within_its_bound_and_is_reproducible_with_a_seed():
+    delays = [make_backend(latency_s=0.1, latency_jitter_s=0.05, seed=7)._draw()[0] for _ in range(2)]
+    backend = make_backend(latency_s=0.1, latency_jitter_s=0.05, seed=7)
+    draws = [backend._draw()[0] for _ in range(200)]
+
+    assert delays[0] == delays[1] == draws[0]
+    assert all(0.1 <= delay <= 0.15 for delay in draws)
+    assert len(set(draws)) > 100
+
+
+def test_a_failure_rate_of_one_fails_every_call_before_any_token():
+    backend = make_backend(failure_rate=1.0)
+
+    with pytest.raises(LLMError) as error:
+        backend.generate("hello")
+    assert error.value.retryable
+    stream = backend.generate_stream("hello")
+    with pytest.raises(LLMError):
+        next(stream)
+
+    async def read_stream():
+        return [piece async for piece in backend.agenerate_stream("hello")]
+    with pytest.raises(LLMError):
+        asyncio.run(read_stream())
+
+
+def test_failures_are_injected_at_the_configured_rate():
+    def outcomes(seed):
+        backend = make_backend(failure_rate=0.3, seed=seed)
+        results = []
+        for _ in range(400):
+            try:
+                backend.generate("hello")
+                results.append(False)
+            except LLMError:
+                results.append(True)
+        return results
+
+    failed = outcomes(seed=3)
+    assert 0.2 < sum(failed) / len(failed) < 0.4
+    assert outcomes(seed=3) == failed
+
+
+def test_the_persona_llm_section_selects_and_configures_the_stub(make_agent, monkeypatch):
+    # Default to gemini, so only the persona can pick the stub
+    monkeypatch.setitem(llm_backend.DEFAULT_LLM_CONFIG, "backend", "gemini")
+    agent = make_agent(persona_extra="llm:\n  backend: stub\n  latency_s: 0.05\n  failure_rate: 1.0\n  reply_tokens: 5\n")
+
+    assert isinstance(agent.llm, StubBackend)
+    assert agent.llm.cache_model_name == "stub:stub"
+    assert (agent.llm.latency_s, agent.llm.failure_rate, agent.llm.reply_tokens) == (0.05, 1.0, 5)
+    with pytest.raises(LLMError):
+        agent.llm.generate("hello")
+
+
+def test_an_unknown_backend_falls_back_to_gemini(caplog):
+    with caplog.at_level(logging.WARNING, logger="core.llm_backend"):
+        config = resolve_llm_config({"llm": {"backend": "no-such-model"}})
+
+    assert config["backend"] == "gemini"
+    assert any("Unknown LLM backend" in record.getMessage() for record in caplog.records)
@@ -0,0 +1,121 @@
+import asyncio
+import time
+import pytest
+from core.llm_backend import StubBackend, LLMError, resolve_llm_config
+from core.llm_dispatcher import LLMDispatcher, CircuitOpenError
+
+
+def stub_config(**overrides) -> dict:
+    settings = dict(backend="stub", latency_s=0.0, latency_jitter_s=0.0, tokens_per_s=0, reply_tokens=8, failure_rate=0.0, seed=1)
+    settings.update(overrides)
+    return resolve_llm_config(overrides=settings)
+
+
+def make_backend(**overrides) -> StubBackend:
+    return StubBackend(stub_config(**overrides))
+
+
+class ScriptedBackend(StubBackend):
+    """Stub whose calls fail with the queued errors first, then answer normally."""
+
+    def __init__(self, errors=(), **overrides):
+        super().__init__(stub_config(**overrides))
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def agenerate(self, message, history=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return await super().agenerate(message, history)
+
+
+def make_dispatcher(**settings) -> LLMDispatcher:
+    defaults = dict(timeout_s=5, max_retries=2, backoff_base_s=0.001, backoff_max_s=0.001, breaker_failures=5, breaker_reset_s=30)
+    defaults.update(settings)
+    return LLMDispatcher(**defaults)
+
+
+def test_stub_reply_is_deterministic():
+    dispatcher, backend = make_dispatcher(), make_backend()
+    assert dispatcher.generate(backend, "hello") == dispatcher.generate(backend, "hello")
+    assert "".join(dispatcher.stream(backend, "hello")) == dispatcher.generate(backend, "hello")
+
+
+def test_attempt_times_out_and_is_retried():
+    dispatcher, backend = make_dispatcher(timeout_s=0.05, max_retries=1), make_backend(latency_s=1.0)
+    started = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        dispatcher.generate(backend, "slow")
+    assert time.perf_counter() - started < 0.5
+    assert dispatcher.get_stats()["breakers"][backend.cache_model_name]["consecutive_failures"] == 2
+    assert dispatcher.get_stats()["in_flight"] == 0
+
+
+def test_stream_times_out_before_the_first_chunk():
+    dispatcher, backend = make_dispatcher(timeout_s=0.05, max_retries=0), make_backend(latency_s=1.0)
+    with pytest.raises(TimeoutError):
+        list(dispatcher.stream(backend, "slow"))
+
+
+def test_retryable_errors_are_retried_until_success():
+    dispatcher = make_dispatcher(max_retries=2)
+    backend = ScriptedBackend(errors=[LLMError("overloaded"), LLMError("overloaded")])
+    assert dispatcher.generate(backend, "hello")
+    assert backend.calls == 3
+    assert dispatcher.get_stats()["breakers"][backend.cache_model_name] == {"state": "closed", "consecutive_failures": 0}
+
+
+def test_non_retryable_error_is_raised_at_once():
+    dispatcher = make_dispatcher(max_retries=2, breaker_failures=1)
+    backend = ScriptedBackend(errors=[LLMError("bad request", retryable=False)])
+    with pytest.raises(LLMError):
+        dispatcher.generate(backend, "hello")
+    assert backend.calls == 1
+    # The provider answered, so the breaker stays closed
+    assert dispatcher.generate(backend, "hello")
+
+
+def test_breaker_opens_fails_fast_and_recovers_after_a_probe():
+    dispatcher = make_dispatcher(max_retries=0, breaker_failures=2, breaker_reset_s=0.2)
+    backend = ScriptedBackend(errors=[LLMError("down"), LLMError("down")])
+    for _ in range(2):
+        with pytest.raises(LLMError):
+            dispatcher.generate(backend, "hello")
+
+    with pytest.raises(CircuitOpenError):
+        dispatcher.generate(backend, "hello")
+    assert backend.calls == 2
+    assert dispatcher.get_stats()["breakers"][backend.cache_model_name]["state"] == "open"
+
+    time.sleep(0.25)
+    assert dispatcher.generate(backend, "hello")
+    assert backend.calls == 3
+    assert dispatcher.get_stats()["breakers"][backend.cache_model_name]["state"] == "closed"
+
+
+def test_failed_probe_reopens_the_breaker():
+    dispatcher = make_dispatcher(max_retries=0, breaker_failures=1, breaker_reset_s=0.1)
+    backend = ScriptedBackend(errors=[LLMError("down"), LLMError("still down")])
+    with pytest.raises(LLMError):
+        dispatcher.generate(backend, "hello")
+    time.sleep(0.15)
+    with pytest.raises(LLMError):
+        dispatcher.generate(backend, "hello")
+    with pytest.raises(CircuitOpenError):
+        dispatcher.generate(backend, "hello")
+    assert backend.calls == 2
+
+
+def test_concurrency_is_capped_per_model():
+    dispatcher, backend = make_dispatcher(max_concurrency=16, max_concurrency_per_model=4), make_backend(latency_s=0.1)
+
+    async def run_all():
+        return await asyncio.gather(*(dispatcher.agenerate(backend, f"question {n}") for n in range(12)))
+
+    started = time.perf_counter()
+    replies = asyncio.run(run_all())
+    elapsed = time.perf_counter() - started
+    assert len(replies) == 12
+    # 12 calls of 0.1s through 4 slots take three rounds
+    assert 0.28 < elapsed < 1.0
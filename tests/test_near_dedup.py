@@ -0,0 +1,90 @@
+from core import data_pipeline
+from core.fetch_state import article_key
+from core.near_dedup import word_count, NEAR_DUP_MIN_WORDS
+
+WIRE_STORY = ("The central bank raised interest rates by a quarter point on Wednesday, citing persistent inflation in services "
+              "and a labour market that remains tight. Officials signalled that further increases were possible if price "
+              "pressures did not ease over the coming months, while markets had largely expected the move. "
+              "The decision was unanimous and the bank said it would continue to reduce its balance sheet.")
+OTHER_STORY = ("Heavy rain flooded several districts of the capital overnight, forcing schools to close and cutting power "
+               "to thousands of homes. Emergency services evacuated residents from low-lying streets as the river rose "
+               "above its banks, and forecasters warned more storms would arrive before the weekend.")
+
+
+def make_article(n: int, content: str, outlet: str = "Outlet") -> dict:
+    return {"title": f"Story {n}", "link": f"https://example.com/{outlet}/{n}", "content": content,
+            "source": outlet, "published_at": "2024-05-01T00:00:00Z"}
+
+
+class AgentsManager:
+    def __init__(self, agents):
+        self.agents = agents
+
+    def has_agent(self, agent_id):
+        return agent_id in self.agents
+
+    def get_agent(self, agent_id):
+        return self.agents.get(agent_id)
+
+    def ingested_store_offset(self, agent_id):
+        return self.agents[agent_id].ingestion_manifest.store_offset
+
+
+def ingest(make_agent, raw_dir: str, articles: list) -> tuple:
+    """Stores articles for test_agent and runs the knowledge update on a freshly loaded agent."""
+    data_pipeline.get_article_store(raw_dir).append_many("test_agent", articles)
+    agent = make_agent("test_agent")
+    status = data_pipeline.update_agents_knowledge_from_raw_data(AgentsManager({"test_agent": agent}), raw_dir)
+    return agent, status["dedup"]
+
+
+def test_wire_copies_are_dropped_and_distinct_articles_kept(make_agent, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    articles = [
+        make_article(1, WIRE_STORY, "wire"),
+        make_article(2, "LONDON (Reuters) - " + WIRE_STORY, "daily"),
+        make_article(3, WIRE_STORY + " (Reuters)", "weekly"),
+        make_article(4, OTHER_STORY, "wire"),
+    ]
+    agent, dedup = ingest(make_agent, str(tmp_path / "raw_news"), articles)
+
+    assert dedup["documents"] == 4
+    assert dedup["documents_near_duplicate"] == 2
+    manifest = agent.ingestion_manifest
+    original_key, other_key = article_key(articles[0]), article_key(articles[3])
+    assert set(manifest.near_duplicate_of.values()) == {original_key}
+    assert set(manifest.article_fingerprints.fingerprints) == {original_key, other_key}
+
+
+def test_texts_under_the_word_minimum_are_only_deduplicated_exactly(make_agent):
+    short_a = "Markets rose on Monday after the rate decision."
+    short_b = "Markets rose on Tuesday after the rate decision."
+    assert word_count(short_a) < NEAR_DUP_MIN_WORDS
+
+    agent = make_agent()
+    with agent.bulk_ingest() as batch:
+        assert batch.near_duplicate_of("a", short_a) is None
+        assert batch.near_duplicate_of("b", short_b) is None
+        batch.add_text(short_a)
+        batch.add_text(short_b)
+        batch.add_text(short_a)
+    assert batch.stats["chunks_near_duplicate"] == 0
+    assert batch.stats["chunks_exact_duplicate"] == 1
+    assert batch.chunks_added == 2
+
+
+def test_fingerprints_persist_through_the_manifest_between_runs(make_agent, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_pipeline, "_article_stores", {})
+    raw_dir = str(tmp_path / "raw_news")
+    first, dedup = ingest(make_agent, raw_dir, [make_article(1, WIRE_STORY, "wire")])
+    assert dedup["documents_near_duplicate"] == 0
+    embedded_before = len(first.ingestion_manifest.chunk_hashes)
+
+    # A new process: the agent and its manifest are loaded again from disk
+    second, dedup = ingest(make_agent, raw_dir, [make_article(2, "LONDON (Reuters) - " + WIRE_STORY, "daily"),
+                                                 make_article(3, OTHER_STORY, "wire")])
+    assert second is not first
+    assert dedup["documents"] == 2
+    assert dedup["documents_near_duplicate"] == 1
+    assert len(second.ingestion_manifest.article_fingerprints) == 2
+    assert len(second.ingestion_manifest.chunk_hashes) > embedded_before
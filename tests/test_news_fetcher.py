@@ -0,0 +1,125 @@
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+from core.news_fetcher import NewsFetchEngine
+
+RESPONSE_DELAY_S = 0.05
+
+
+def newsapi_article(title: str) -> dict:
+    return {"title": title, "url": f"https://example.com/{title.replace(' ', '-')}", "content": f"{title} body",
+            "source": {"name": "Stand-in"}, "publishedAt": "2024-05-01T00:00:00Z"}
+
+
+class StandInNewsAPI(ThreadingHTTPServer):
+    """Local /everything and /top-headlines that record arrival times and requests in flight."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.arrivals = []
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.arrivals.append(time.monotonic())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(RESPONSE_DELAY_S)
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == "/everything":
+                body = {"status": "ok", "articles": [newsapi_article(f"{params['q'][0]} story")]}
+            elif url.path == "/top-headlines":
+                body = {"status": "ok", "articles": [newsapi_article(f"{params['category'][0]} headline")]}
+            else:
+                body = {"status": "error", "code": "notFound", "message": url.path}
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(200 if body["status"] == "ok" else 404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def newsapi():
+    server = StandInNewsAPI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_engine(server, **settings) -> NewsFetchEngine:
+    return NewsFetchEngine("test-key", base_url=server.base_url, **settings)
+
+
+def test_fetch_all_runs_configs_concurrently_up_to_the_cap(newsapi):
+    engine = make_engine(newsapi, rate_per_sec=0, max_concurrency=3)
+    config = {
+        "agent_a": [{"query": f"topic{n}"} for n in range(4)],
+        "agent_b": [{"category": f"cat{n}"} for n in range(4)],
+    }
+    try:
+        articles = asyncio.run(engine.fetch_all(config))
+    finally:
+        engine.close()
+
+    assert [a["title"] for a in articles["agent_a"]] == [f"topic{n} story" for n in range(4)]
+    assert [a["title"] for a in articles["agent_b"]] == [f"cat{n} headline" for n in range(4)]
+    assert 1 < newsapi.max_in_flight <= 3
+    # Eight requests three at a time take at least three rounds
+    assert newsapi.arrivals[-1] - newsapi.arrivals[0] >= 2 * RESPONSE_DELAY_S * 0.9
+
+
+def test_token_bucket_spaces_requests_out(newsapi):
+    engine = make_engine(newsapi, rate_per_sec=20, burst=1, max_concurrency=8)
+    try:
+        asyncio.run(engine.fetch_configs([("agent_a", {"query": f"topic{n}"}) for n in range(5)]))
+    finally:
+        engine.close()
+
+    # Connection setup can delay a single arrival, so check the spread rather than each gap
+    assert len(newsapi.arrivals) == 5
+    assert newsapi.arrivals[-1] - newsapi.arrivals[0] >= 4 / 20 * 0.8
+
+
+def test_request_log_reports_per_request_latency_and_errors(newsapi):
+    engine = make_engine(newsapi, rate_per_sec=0)
+    engine.base_url += "/missing"
+    try:
+        asyncio.run(engine.fetch_configs([("agent_a", {"query": "ok"})]))
+        engine.base_url = newsapi.base_url
+        asyncio.run(engine.fetch_configs([("agent_a", {"query": "ok"}), ("agent_b", {"category": "business"})]))
+    finally:
+        engine.close()
+
+    log = list(engine.request_log)
+    assert [entry["status"] for entry in log] == ["error:notFound", "ok", "ok"]
+    assert all(entry["latency_s"] >= RESPONSE_DELAY_S * 0.9 for entry in log)
+    summary = engine.latency_summary()
+    assert summary["requests"] == 3 and summary["errors"] == 1
+    assert summary["max_ms"] >= RESPONSE_DELAY_S * 1000 * 0.9
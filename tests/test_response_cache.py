@@ -0,0 +1,79 @@
+import os
+import types
+import pytest
+from core import response_cache as response_cache_module
+from core.response_cache import ResponseCache, prompt_fingerprint
+
+TURN = dict(model_name="gemini-test", generation_config={"temperature": 0.7}, system_prompt="You are a test agent.",
+            message="What about tariffs?", conversation_history=[("Hi", "Hello")])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the cache's wall clock with one the test moves by hand."""
+    clock = types.SimpleNamespace(now=1_700_000_000.0)
+    monkeypatch.setattr(response_cache_module, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttl_s=60, max_bytes=0)
+    cache.put("ab" * 32, "cached reply")
+
+    clock.now += 59
+    assert cache.get("ab" * 32) == "cached reply"
+    clock.now += 2
+    assert cache.get("ab" * 32) is None
+    assert cache.get_stats()["expired"] == 1
+    assert not os.path.exists(cache._path("ab" * 32))
+
+
+def test_least_recently_used_entries_are_evicted_at_the_size_cap(tmp_path, clock):
+    entry_bytes = len('{"created_at": 1700000000.0, "model": null, "response": "' + "x" * 100 + '"}')
+    cache = ResponseCache(str(tmp_path), ttl_s=0, max_bytes=3 * entry_bytes)
+    for n in range(3):
+        clock.now += 1
+        cache.put(f"{n:02d}" * 32, "x" * 100)
+    clock.now += 1
+    assert cache.get("00" * 32)  # now the most recently used
+
+    clock.now += 1
+    cache.put("03" * 32, "x" * 100)
+    assert cache.get("01" * 32) is None
+    for n in (3, 2, 0):
+        clock.now += 1
+        assert cache.get(f"{n:02d}" * 32)
+    assert cache.get_stats()["evictions"] == 1
+
+    # Recency survives a restart through the file mtimes
+    clock.now += 1
+    restarted = ResponseCache(str(tmp_path), ttl_s=0, max_bytes=3 * entry_bytes)
+    restarted.put("04" * 32, "x" * 100)
+    assert restarted.get("03" * 32) is None
+    assert restarted.get("02" * 32) and restarted.get("00" * 32)
+
+
+def test_corrupt_entries_are_dropped(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttl_s=0, max_bytes=0)
+    cache.put("cd" * 32, "cached reply")
+    with open(cache._path("cd" * 32), 'w', encoding='utf-8') as f:
+        f.write('{"created_at": 17')
+
+    assert cache.get("cd" * 32) is None
+    assert not os.path.exists(cache._path("cd" * 32))
+    assert cache.get_stats()["entries"] == 0
+    cache.put("cd" * 32, "fresh reply")
+    assert cache.get("cd" * 32) == "fresh reply"
+
+
+@pytest.mark.parametrize("change", [
+    {"model_name": "gemini-other"},
+    {"generation_config": {"temperature": 0.2}},
+    {"system_prompt": "You are another agent."},
+    {"message": "What about taxes?"},
+    {"conversation_history": [("Hi", "Hello"), ("And?", "More.")]},
+    {"conversation_history": None},
+])
+def test_the_fingerprint_changes_with_every_input(change):
+    assert prompt_fingerprint(**TURN) == prompt_fingerprint(**dict(TURN))
+    assert prompt_fingerprint(**dict(TURN, **change)) != prompt_fingerprint(**TURN)
@@ -0,0 +1,55 @@
+import pytest
+from core.response_parser import parse_agent_response, StreamingResponseParser
+
+REPLIES = {
+    "thinking": "<thinking>\nTariffs hurt our farmers.\nStay firm.\n</thinking>\n\nWe will not back down on trade.",
+    "suy_nghĩ": "<suy_nghĩ>Cần giữ lập trường cứng rắn.</suy_nghĩ>\nChúng tôi sẽ không nhượng bộ.",
+    "preamble": "Sure. <THINKING>Keep it short.</THINKING> The answer is no.",
+    "no_tag": "We welcome the agreement and expect more trade.",
+}
+
+
+def split_into(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream(chunks: list) -> tuple:
+    """(thoughts, statement) rebuilt from the events, checked against the parser's own accumulators."""
+    parser = StreamingResponseParser()
+    events = [event for chunk in chunks for event in parser.feed(chunk)] + parser.finish()
+    thoughts = "".join(text for kind, text in events if kind == "thought")
+    statement = "".join(text for kind, text in events if kind == "statement")
+    assert (thoughts, statement) == (parser.thoughts, parser.statement)
+    return thoughts, statement
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 10_000])
+@pytest.mark.parametrize("name", sorted(REPLIES))
+def test_streamed_chunks_split_like_the_full_reply(name, size):
+    reply = REPLIES[name]
+    thoughts, statement = stream(split_into(reply, size))
+
+    expected_thoughts, expected_statement = parse_agent_response(reply)
+    assert (thoughts.strip() or None) == expected_thoughts
+    assert statement.strip() == expected_statement
+
+
+@pytest.mark.parametrize("tag", ["thinking", "suy_nghĩ"])
+def test_a_tag_split_across_chunks_is_not_leaked(tag):
+    reply = f"<{tag}>Weigh the offer.</{tag}>Accepted."
+    # Cut inside both the opening and the closing tag
+    chunks = [reply[:3], reply[3:len(tag) + 5], reply[len(tag) + 5:-len(tag) - 11], reply[-len(tag) - 11:]]
+    thoughts, statement = stream(chunks)
+
+    assert (thoughts, statement) == ("Weigh the offer.", "Accepted.")
+
+
+@pytest.mark.parametrize("size", [1, 2, 5])
+def test_a_missing_closing_tag_leaves_everything_in_the_thoughts(size):
+    reply = "<thinking>The reply was cut off before the statement"
+    thoughts, statement = stream(split_into(reply, size))
+
+    expected_thoughts, expected_statement = parse_agent_response(reply)
+    assert thoughts == expected_thoughts == "The reply was cut off before the statement"
+    assert statement == ""
+    assert expected_statement == "(Chỉ có suy nghĩ, không có phát biểu chính thức riêng biệt)"